@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bakes a layer from the command line through the remote API.
+
+Builds the division tree in local memory and writes it back in large batches,
+which is much faster than the task queue baker for large layers. Needs the App
+Engine SDK on the Python path and an administrator account of the application.
+
+Usage:
+  bake_offline.py <application id> <layer id> [<host>]
+"""
+
+import getpass
+import sys
+from google.appengine.ext.remote_api import remote_api_stub
+
+
+def _GetCredentials():
+  return raw_input('Email: '), getpass.getpass('Password: ')
+
+
+def main(argv):
+  if len(argv) not in (3, 4):
+    print __doc__
+    return 1
+  app_id, layer_id = argv[1], int(argv[2])
+  host = len(argv) == 4 and argv[3] or '%s.appspot.com' % app_id
+  remote_api_stub.ConfigureRemoteApi(app_id, '/remote_api', _GetCredentials,
+                                     host)
+
+  # Imported after the stubs are configured, as they touch App Engine APIs.
+  # pylint: disable-msg=C6204
+  from handlers import baker
+  import model
+
+  layer = model.Layer.get_by_id(layer_id)
+  if not layer or not layer.auto_managed:
+    print 'Layer %d does not exist or is not auto-managed.' % layer_id
+    return 1
+  baker.BakeInMemory(layer)
+  print 'Layer %d baked.' % layer_id
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -16,31 +16,156 @@
 
 """The layer auto-regionation mechanism."""
 
+import collections
+import datetime
+import logging
+import time
+from django.utils import simplejson as json
 from google.appengine import runtime
 from google.appengine.api.labs import taskqueue
 from google.appengine.ext import db
 from google.appengine.runtime import apiproxy_errors
 import handlers.base
+from lib.geo import geocell
 from lib.geo import geotypes
 import model
 import settings
 import util
 
 
+# The models reset by the setup stage, by kind name, and the order in which
+# their keys are walked. Entities lose their baked flags, and geocell counts
+# count all their entities as unbaked again. Divisions are not reset; each
+# baking run builds a new generation of them, and the collect stage deletes the
+# old one.
+_SETUP_MODELS = {'Entity': model.Entity, 'GeocellCount': model.GeocellCount}
+_SETUP_KINDS = ('Entity', 'GeocellCount')
+# The kinds walked by the count stage, in order. The old counts of the layer
+# are deleted before its entities are counted again.
+_COUNT_KINDS = ('GeocellCount', 'Entity')
+# The maximum number of objects to delete or put in a single datastore call.
+_BATCH_SIZE = 500
+# The sharded counters kept for each baking run. See _GetCounterName(). The
+# scheduled, completed and retried counters count subdivide tasks, divisions
+# counts the divisions created, entities the entities to place, assigned
+# those placed into a division, rendered the divisions whose KML was
+# generated by the render stage and setup_shards the setup shards finished.
+_COUNTERS = ('scheduled', 'completed', 'retried', 'divisions', 'entities',
+             'assigned', 'rendered', 'setup_shards')
+
+
 class Baker(handlers.base.PageHandler):
   """A handler to show a regionation form."""
 
   PERMISSION_REQUIRED = model.Permission.MANAGE
   FORM_TEMPLATE = 'baker'
 
+  def ShowForm(self, layer):
+    """Shows a regionation form, with the outcome of the latest baking run."""
+    report = model.BakeReport.get_by_key_name(
+        model.BakeReport.GetKeyName(layer))
+    return {'report': report}
+
+  def ShowStatus(self, layer):
+    """Writes out a JSON description of the progress of the latest baking run.
+
+    All the figures come from the sharded counters of the run, so checking the
+    status is cheap even for huge layers. The output has these keys:
+      busy: Whether the layer is still being baked.
+      elapsed: The number of seconds since the run started, or that it took.
+      divisions: The number of divisions created.
+      entities: The number of entities to place. Includes entities without a
+          location, which are never placed.
+      assigned: The number of entities placed into a division.
+      remaining: The number of entities not placed yet.
+      tasks_in_flight: The number of subdivide tasks scheduled but not
+          completed.
+      tasks_retried: The number of subdivide tasks rescheduled after running out
+          of time.
+      entities_per_second: The average rate at which entities were placed.
+      eta: The estimated number of seconds until all entities are placed at
+          that rate. None if it cannot be estimated or baking is done.
+      rendered: The number of divisions whose KML has been generated by the
+          render stage, which runs once baking is done.
+
+    Args:
+      layer: The layer whose baking status to show.
+    """
+    report = model.BakeReport.get_by_key_name(
+        model.BakeReport.GetKeyName(layer))
+    values = model.GetCounters([_GetCounterName(layer, i) for i in _COUNTERS])
+    counters = dict(zip(_COUNTERS, values))
+    if report:
+      elapsed = (report.finished or datetime.datetime.now()) - report.started
+      elapsed = elapsed.days * 86400 + elapsed.seconds
+    else:
+      elapsed = 0
+    remaining = max(counters['entities'] - counters['assigned'], 0)
+    in_flight = max(counters['scheduled'] - counters['completed'], 0)
+    if elapsed:
+      rate = float(counters['assigned']) / elapsed
+    else:
+      rate = 0.0
+    if layer.busy and rate:
+      eta = int(remaining / rate)
+    else:
+      eta = None
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(json.dumps({
+        'busy': bool(layer.busy),
+        'elapsed': elapsed,
+        'divisions': counters['divisions'],
+        'entities': counters['entities'],
+        'assigned': counters['assigned'],
+        'remaining': remaining,
+        'tasks_in_flight': in_flight,
+        'tasks_retried': counters['retried'],
+        'entities_per_second': rate,
+        'eta': eta,
+        'rendered': counters['rendered']
+    }))
+
   def Create(self, layer):
-    """Starts a regionation run on an auto-managed layer."""
+    """Starts a regionation run on an auto-managed layer.
+
+    POST Args:
+      incremental: If non-empty and the layer has been baked before, only
+          places the entities added or changed since then into the existing
+          divisions instead of rebaking the whole layer.
+      recount: If non-empty, rebuilds the geocell counts of the layer's
+          entities (see model.GeocellCount) instead of baking it.
+
+    A full baking run builds a new generation of divisions next to the served
+    one, so a baked layer stays servable until the new generation replaces it.
+
+    Args:
+      layer: The layer to bake.
+    """
     if not layer.auto_managed:
       raise util.BadRequest('Only auto-managed layers can be baked.')
-    layer.baked = False
+    if self.request.get('recount'):
+      taskqueue.add(url=_GetBakerURL(layer), params={'stage': 'count'})
+      return
+    if self.request.get('incremental') and layer.baked:
+      # The layer stays baked and servable while the new entities are placed.
+      layer.busy = True
+      layer.put()
+      _ResetBakeRecords(layer)
+      taskqueue.add(url=_GetBakerURL(layer), params={'stage': 'incremental'})
+      return
+    abandoned_generation = layer.baking_generation
+    layer.baking_generation = max(layer.division_generation or 0,
+                                  layer.baking_generation or 0) + 1
     layer.busy = True
     layer.put()
-    layer.ClearCache()
+    _ResetBakeRecords(layer)
+    model.BakeSetupBarrier.Reset(layer)
+    if abandoned_generation is not None:
+      # Left behind by a baking run that never finished.
+      taskqueue.add(url=_GetBakerURL(layer), params={
+          'stage': 'collect',
+          'generation': abandoned_generation
+      })
     taskqueue.add(url=_GetBakerURL(layer), params={'stage': 'setup'})
 
 
@@ -61,23 +186,58 @@ class BakerApprentice(handlers.base.PageHandler):
 
     POST Args:
       stage: Which stage is currently being run. Takes one of these values:
-        'setup': Reset all entities' baking status and delete all Division
-            objects. Reschedules itself if setup can't be completed in one run.
-            Once done, schedules the initial subdivide stage and the monitor.
+        'setup': Walks the keys of all Entity and GeocellCount objects in the
+            layer and schedules a setup_shard task for each range of them.
+            Reschedules itself if the walk can't be completed in one run.
             There should be at most one setup task per layer running at a time.
+        'setup_shard': Resets the baking status of the Entity or GeocellCount
+            objects in a range of keys. Once the last shard has finished,
+            schedules the initial subdivide stage and the monitor. There may be
+            any number of setup_shard tasks running in parallel.
         'subdivide': Creates a new Division object based on the north, south,
             east, west and parent POST parameters, and schedules further
             subdivide tasks. There may be any number of subdivide tasks running
             in parallel.
-        'monitor': Checks whether the baking has finished. If it has, marks the
-            layer as baked and not busy. Otherwise reschedules itself.
+        'incremental': Places the unbaked entities of a baked layer into the
+            existing divisions, and schedules subdivide tasks for the regions
+            that have no room for them, followed by the monitor. Reschedules
+            itself if it can't be completed in one run.
+        'monitor': A watchdog for baking runs that stall, for example because
+            a subdivide task was lost. Baking normally finishes as soon as the
+            last subdivide task completes. If no subdivide task has completed
+            since the previous check, records the stall in the layer's
+            BakeReport and stops, leaving the served divisions untouched.
+            Otherwise reschedules itself.
+        'collect': Deletes a generation of divisions that is no longer served.
+            Reschedules itself if it can't be completed in one run.
+        'render': Generates and caches the KML of the served divisions once
+            baking is done. Reschedules itself if it can't be completed in one
+            run.
+        'count': Rebuilds the geocell counts of the layer's entities.
+            Reschedules itself if it can't be completed in one run.
+      kind: For setup and count tasks, the kind whose keys are being walked.
+          For setup_shard tasks, the kind of the keys in the range.
+      cursor: For setup, render and count tasks, the cursor from which to
+          continue the walk.
+      shards: For setup tasks, the number of shards scheduled so far.
+      shard: For setup_shard tasks, the index of the shard.
+      first: For setup_shard tasks, the first key in the range.
+      last: For setup_shard tasks, the last key in the range.
+      completed: For monitor tasks, the number of subdivide tasks that had
+          completed at the previous check.
+      generation: For collect and render tasks, the generation of divisions to
+          delete or render. Empty for divisions created before divisions had
+          generations.
       north: For subdivide tasks, the maximum latitude of the bounding box.
       south: For subdivide tasks, the minimum latitude of the bounding box.
       east: For subdivide tasks, the maximum longitude of the bounding box.
       west: For subdivide tasks, the minimum longitude of the bounding box.
-      parent: For subdivide tasks, the ID of the parent Division. Empty for root
-          divisions.
-      retry_division: The ID of a division to try processing again. Only
+      parent: For subdivide tasks, the key of the parent Division. Empty for
+          root divisions.
+      path: For subdivide tasks, the quad path of the division to create.
+          Empty if the parent division has none, in which case the division
+          gets a numeric ID.
+      retry_division: The key of a division to try processing again. Only
           specified for subdivide tasks that previously failed due to time
           constraints.
       retry_has_children: Whether this subdivision should be subdivided further.
@@ -90,124 +250,711 @@ class BakerApprentice(handlers.base.PageHandler):
     """
     stage = self.request.get('stage')
     if stage == 'setup':
-      # TODO: Parallelize setup. Rebaking is too slow now due to this.
-      _PrepareLayerForBaking(layer)
+      try:
+        kind = self.request.get('kind')
+        if kind and kind not in _SETUP_MODELS:
+          raise ValueError('Invalid kind.')
+        shard_count = self.GetArgument('shards', int) or 0
+      except (TypeError, ValueError):
+        raise util.BadRequest('Invalid baking parameters.')
+      _PrepareLayerForBaking(layer, kind, self.request.get('cursor'),
+                             shard_count)
+    elif stage == 'setup_shard':
+      try:
+        kind = self.request.get('kind')
+        shard = int(self.request.get('shard'))
+        first = self.request.get('first')
+        last = self.request.get('last')
+        if kind not in _SETUP_MODELS or not (first and last):
+          raise ValueError('Invalid shard.')
+      except (TypeError, ValueError):
+        raise util.BadRequest('Invalid baking parameters.')
+      _PrepareShardForBaking(layer, kind, shard, first, last)
+    elif stage == 'incremental':
+      _BakeIncrementally(layer)
     elif stage == 'monitor':
-      _CheckIfLayerIsDone(layer)
+      try:
+        last_completed = self.GetArgument('completed', int)
+      except (TypeError, ValueError):
+        raise util.BadRequest('Invalid baking parameters.')
+      _CheckIfLayerIsDone(layer, last_completed)
+    elif stage == 'collect':
+      try:
+        generation = self.GetArgument('generation', int)
+      except (TypeError, ValueError):
+        raise util.BadRequest('Invalid baking parameters.')
+      _CollectDivisions(layer, generation)
+    elif stage == 'render':
+      try:
+        generation = self.GetArgument('generation', int)
+      except (TypeError, ValueError):
+        raise util.BadRequest('Invalid baking parameters.')
+      _RenderDivisions(layer, generation, self.request.get('cursor'))
+    elif stage == 'count':
+      kind = self.request.get('kind')
+      if kind and kind not in _COUNT_KINDS:
+        raise util.BadRequest('Invalid baking parameters.')
+      _RebuildGeocellCounts(layer, kind, self.request.get('cursor'))
     elif stage == 'subdivide':
       try:
         north = self.GetArgument('north', float)
         south = self.GetArgument('south', float)
         east = self.GetArgument('east', float)
         west = self.GetArgument('west', float)
-        parent = self.GetArgument('parent', int)
+        parent = self.request.get('parent')
         if parent:
-          parent = model.Division.get_by_id(parent)
+          parent = model.Division.get(parent)
         else:
           parent = None
-        retry_division = self.GetArgument('retry_division', int)
+        path = self.request.get('path') or None
+        retry_division = self.request.get('retry_division')
         if retry_division:
-          retry_division = model.Division.get_by_id(retry_division)
+          retry_division = model.Division.get(retry_division)
         else:
           retry_division = None
         retry_has_children = bool(self.request.get('retry_has_children'))
-      except (TypeError, ValueError):
+      except (TypeError, ValueError, db.BadKeyError):
         raise util.BadRequest('Invalid baking parameters.')
-      _Subdivide(layer, north, south, east, west,
-                 parent, retry_division, retry_has_children)
+      _Subdivide(layer, north, south, east, west, parent, path,
+                 retry_division, retry_has_children)
     else:
       raise util.BadRequest('Invalid baking stage.')
 
 
-def _PrepareLayerForBaking(layer):
-  """Prepares the layer for subdivision steps.
-
-  Removes all existing divisions in this layer and clears the baked flag on
-  all entities.
+def _PrepareLayerForBaking(layer, kind, cursor, shard_count):
+  """Fans out the preparation of the layer for subdivision steps.
 
-  If App Engine interrupts this function before all the preparations are
-  finished, it is rescheduled to be called again immediately, where it
-  continues from where it left off.
+  Walks the keys of the layer's entities with keys-only queries, and schedules
+  a setup_shard task for every settings.BAKER_SETUP_SHARD_SIZE consecutive
+  keys. The entities walked are
+  counted as entities to place. Once all keys have been
+  walked, records the final number of shards in the layer's setup barrier.
 
-  Once preparations are finished, schedules an initial subdivision step to be
-  run immediately and a monitoring check to be run after
-  settings.BAKER_MONITOR_DELAY seconds.
+  If App Engine interrupts this function before the walk is finished, it is
+  rescheduled to be called again immediately, where it continues from where it
+  left off.
 
   Args:
     layer: The layer to prepare.
+    kind: The name of the model whose keys are being walked, one of
+        _SETUP_MODELS. Empty to start from the beginning.
+    cursor: The cursor of the keys query, from which to continue the walk.
+        Empty to start from the first key of the kind.
+    shard_count: The number of shards scheduled so far.
   """
+  kind = kind or _SETUP_KINDS[0]
   try:
-    division_query = layer.division_set
     while True:
-      divisions = division_query.fetch(1000)
-      if not divisions:
-        break
-      for division in divisions:
-        division.delete()
-      division_query.with_cursor(division_query.cursor())
+      query = _SETUP_MODELS[kind].all(keys_only=True).filter('layer', layer)
+      query.order('__key__')
+      if cursor:
+        query.with_cursor(cursor)
+      keys = query.fetch(settings.BAKER_SETUP_SHARD_SIZE)
+      if keys:
+        taskqueue.add(url=_GetBakerURL(layer), params={
+            'stage': 'setup_shard',
+            'kind': kind,
+            'shard': shard_count,
+            'first': str(keys[0]),
+            'last': str(keys[-1])
+        })
+        shard_count += 1
+        if kind == 'Entity':
+          model.IncrementCounter(_GetCounterName(layer, 'entities'), len(keys))
+        cursor = query.cursor()
+      if len(keys) < settings.BAKER_SETUP_SHARD_SIZE:
+        next_kind_index = _SETUP_KINDS.index(kind) + 1
+        if next_kind_index == len(_SETUP_KINDS):
+          break
+        kind = _SETUP_KINDS[next_kind_index]
+        cursor = None
+  except (runtime.DeadlineExceededError, db.Error,
+          apiproxy_errors.OverQuotaError):
+    taskqueue.add(url=_GetBakerURL(layer), params={
+        'stage': 'setup',
+        'kind': kind,
+        'cursor': cursor or '',
+        'shards': shard_count
+    })
+  else:
+    _UpdateSetupBarrier(layer, expected_shards=shard_count)
+
 
-    entity_query = layer.entity_set.filter('baked', True)
+def _PrepareShardForBaking(layer, kind, shard, first, last):
+  """Prepares a range of keys in the layer for subdivision steps.
+
+  Clears the baked flag on the entities in the range, or resets the unbaked
+  counts of the geocell counts in the range to their totals, with batched puts.
+  Each shard only touches its own keys, so any number of shards can run in
+  parallel. Once done, counts the shard as finished towards the layer's setup
+  barrier.
+
+  If App Engine interrupts this function, it is rescheduled to be called again
+  immediately. Repeating a shard is harmless.
+
+  Args:
+    layer: The layer to prepare.
+    kind: The name of the model to which the keys belong, one of _SETUP_MODELS.
+    shard: The index of this shard.
+    first: The first key of the range, as a string.
+    last: The last key of the range, as a string.
+  """
+  query = _SETUP_MODELS[kind].all().filter('layer', layer)
+  query.filter('__key__ >=', db.Key(first)).filter('__key__ <=', db.Key(last))
+  try:
     while True:
-      entities = entity_query.fetch(1000)
-      if not entities:
+      results = query.fetch(_BATCH_SIZE)
+      if not results:
         break
-      for entity in entities:
-        entity.baked = None
-        entity.put()
-      entity_query.with_cursor(entity_query.cursor())
+      if kind == 'GeocellCount':
+        changed = [i for i in results if i.unbaked != i.count]
+        for count in changed:
+          count.unbaked = count.count
+      else:
+        changed = [i for i in results if i.baked]
+        for entity in changed:
+          entity.baked = None
+      if changed:
+        db.put(changed)
+      query.with_cursor(query.cursor())
   except (runtime.DeadlineExceededError, db.Error,
           apiproxy_errors.OverQuotaError):
-    taskqueue.add(url=_GetBakerURL(layer), params={'stage': 'setup'})
+    taskqueue.add(url=_GetBakerURL(layer), params={
+        'stage': 'setup_shard',
+        'kind': kind,
+        'shard': shard,
+        'first': first,
+        'last': last
+    })
+  else:
+    _UpdateSetupBarrier(layer, shard_finished=True)
+
+
+def _UpdateSetupBarrier(layer, expected_shards=None, shard_finished=False):
+  """Records setup progress and starts subdividing once setup is complete.
+
+  Setup is complete when the walk over the layer's keys has finished and every
+  shard it scheduled has finished. Finished shards are counted with a sharded
+  counter, so that shards finishing at the same time do not contend for the
+  barrier, which is only written by the walk. Each side writes its part before
+  reading the other's, so whichever of them comes last sees setup complete.
+
+  At that point, schedules an initial subdivision step to be run immediately
+  and a monitoring check to be run after settings.BAKER_MONITOR_DELAY seconds,
+  then releases the barrier so that a later call does not schedule them again.
+  A repeated release is tolerated: its initial subdivision step is named like
+  the first one and rejected by the task queue.
+
+  Args:
+    layer: The layer being prepared.
+    expected_shards: The total number of shards, if known.
+    shard_finished: Whether a shard has just finished.
+  """
+  key_name = model.BakeSetupBarrier.GetKeyName(layer)
+  if shard_finished:
+    model.IncrementCounter(_GetCounterName(layer, 'setup_shards'))
+
+  if expected_shards is None:
+    barrier = model.BakeSetupBarrier.get_by_key_name(key_name)
   else:
+    def Update():
+      barrier = model.BakeSetupBarrier.get_by_key_name(key_name)
+      if barrier is not None and not barrier.released:
+        barrier.expected_shards = expected_shards
+        barrier.put()
+      return barrier
+    barrier = db.run_in_transaction(Update)
+
+  if (barrier is not None and not barrier.released and
+      barrier.expected_shards is not None and
+      model.GetCounter(_GetCounterName(layer, 'setup_shards')) >=
+      barrier.expected_shards):
+    model.IncrementCounter(_GetCounterName(layer, 'scheduled'))
     args = {
         'stage': 'subdivide',
         'north': 90,
         'south': -90,
         'east': 180,
-        'west': -180
+        'west': -180,
+        'path': model.Division.ROOT_PATH
     }
-    taskqueue.add(url=_GetBakerURL(layer), params=args)
+    _AddSubdivideTask(layer, args)
 
     args = {'stage': 'monitor'}
     taskqueue.add(url=_GetBakerURL(layer), params=args,
                   countdown=settings.BAKER_MONITOR_DELAY)
 
+    # A duplicate root subdivide task from a repeated release is rejected by
+    # the task queue, so releasing last is safe.
+    barrier = model.BakeSetupBarrier.get_by_key_name(key_name)
+    barrier.released = True
+    barrier.put()
+
+
+def _BakeIncrementally(layer):
+  """Places the entities added or changed since the last bake.
+
+  Each unbaked entity is added to the deepest existing division whose bounds
+  contain it, as long as that division has no children and is below the hard
+  maximum size. Otherwise a subdivide step is scheduled for the slice of that
+  division that contains the entity, which creates a new child division from
+  all the unbaked entities in the slice. Only the divisions that receive
+  entities or children have their cached KML cleared.
+
+  Unlike a full bake, this does not reorder entities by priority across
+  existing divisions, so a full rebake may still be worthwhile after large
+  changes.
+
+  If there is nothing to subdivide, finishes baking right away.
+
+  If App Engine interrupts this function, it is rescheduled to be called again
+  immediately. Entities already placed are not placed twice, but those left for
+  subdivide steps are counted again as entities to place.
+
+  Args:
+    layer: The baked layer to update.
+  """
+  division_size = (layer.division_size or settings.DEFAULT_DIVISION_SIZE)
+  ratio = (1 + settings.DIVISION_SIZE_GROWTH_LIMIT)
+  max_size = int(division_size * ratio)
+
+  children = {}
 
-def _CheckIfLayerIsDone(layer):
-  """Checks whether a layer has finished baking.
+  def GetChildren(division):
+    division_key = division and division.key()
+    if division_key not in children:
+      if division:
+        children[division_key] = list(division.division_set)
+      else:
+        root = layer.GetRootDivision()
+        children[division_key] = root and [root] or []
+    return children[division_key]
 
-  Checks whether there are any entities in the layer that have not been marked
-  as baked yet. If there are, reschedules a new monitoring check after
-  settings.BAKER_MONITOR_DELAY seconds. Otherwise sets the layer's baked
-  flag and clears its busy flag.
+  def Contains(bounds, point):
+    north, south, east, west = bounds
+    return south <= point.lat <= north and west <= point.lon <= east
+
+  subdivisions = set()
+  try:
+    query = layer.entity_set.filter('baked', None)
+    while True:
+      entities = query.fetch(_BATCH_SIZE)
+      if not entities:
+        break
+      placed_entities = []
+      changed_divisions = {}
+      newly_placed_count = 0
+      for entity in entities:
+        if not entity.location:
+          continue
+        division = None
+        while True:
+          candidates = [i for i in GetChildren(division)
+                        if Contains((i.north, i.south, i.east, i.west),
+                                    entity.location)]
+          if not candidates:
+            break
+          division = candidates[0]
+        entity_id = entity.key().id()
+        if division is None:
+          subdivisions.add((None, model.Division.ROOT_PATH,
+                            (90.0, -90.0, 180.0, -180.0)))
+        elif entity_id in division.entities:
+          # Placed by an earlier, interrupted run.
+          placed_entities.append(entity)
+        elif (not GetChildren(division) and
+              len(division.entities) < max_size):
+          division.entities.append(entity_id)
+          division.cached_kml = None
+          changed_divisions[division.key()] = division
+          placed_entities.append(entity)
+          newly_placed_count += 1
+        else:
+          slices = _GetChildSlices(division.north, division.south,
+                                   division.east, division.west,
+                                   division.split_latitude,
+                                   division.split_longitude)
+          for index, child_slice in enumerate(slices):
+            bounds = (child_slice['north'], child_slice['south'],
+                      child_slice['east'], child_slice['west'])
+            if Contains(bounds, entity.location):
+              subdivisions.add((str(division.key()),
+                                _GetChildPath(division.GetPath(), index),
+                                bounds))
+              break
+      # Save the divisions before flagging their new entities, so that an
+      # interruption never leaves a baked entity out of every division.
+      if changed_divisions:
+        db.put(changed_divisions.values())
+      model.MarkGeocellsBaked(layer, [i.location for i in placed_entities])
+      for entity in placed_entities:
+        entity.baked = True
+      for start in xrange(0, len(placed_entities), _BATCH_SIZE):
+        db.put(placed_entities[start:start + _BATCH_SIZE])
+      model.IncrementCounter(_GetCounterName(layer, 'entities'), len(entities))
+      if newly_placed_count:
+        model.IncrementCounter(_GetCounterName(layer, 'assigned'),
+                               newly_placed_count)
+      query.with_cursor(query.cursor())
+  except (runtime.DeadlineExceededError, db.Error,
+          apiproxy_errors.OverQuotaError):
+    taskqueue.add(url=_GetBakerURL(layer), params={'stage': 'incremental'})
+    return
+
+  layer.ClearDocumentCache()
+  if not subdivisions:
+    _FinishBaking(layer)
+    return
+  model.IncrementCounter(_GetCounterName(layer, 'scheduled'), len(subdivisions))
+  for parent_key, path, (north, south, east, west) in subdivisions:
+    _AddSubdivideTask(layer, {
+        'stage': 'subdivide',
+        'parent': parent_key or '',
+        'path': path or '',
+        'north': north,
+        'south': south,
+        'east': east,
+        'west': west
+    })
+  args = {'stage': 'monitor'}
+  taskqueue.add(url=_GetBakerURL(layer), params=args,
+                countdown=settings.BAKER_MONITOR_DELAY)
+
+
+def _CheckIfLayerIsDone(layer, last_completed):
+  """Finishes baking a layer once all its subdivide tasks have completed.
+
+  Does nothing if baking has already finished. Finishes baking if all the
+  scheduled subdivide tasks have completed. If none has completed since the
+  previous check, baking has stalled: records the stall and the entities not
+  yet assigned to any division in the layer's BakeReport, and stops checking
+  without switching generations. If the stalled tasks are eventually retried,
+  the last one to complete still finishes baking. Otherwise schedules a new
+  check after settings.BAKER_MONITOR_DELAY seconds.
 
   Args:
     layer: The layer to check.
+    last_completed: The number of completed subdivide tasks at the previous
+        check. None for the first check.
   """
-  if layer.entity_set.filter('baked', None).get():
-    args = {'stage': 'monitor'}
+  if not layer.busy:
+    return
+  completed = model.GetCounter(_GetCounterName(layer, 'completed'))
+  scheduled = model.GetCounter(_GetCounterName(layer, 'scheduled'))
+  if completed == scheduled:
+    _FinishBaking(layer)
+  elif completed == last_completed:
+    logging.warning('Baking layer %d stalled with %d of %d subdivide tasks '
+                    'completed.', layer.key().id(), completed, scheduled)
+    key_name = model.BakeReport.GetKeyName(layer)
+    report = (model.BakeReport.get_by_key_name(key_name) or
+              model.BakeReport(key_name=key_name))
+    report.stalled = datetime.datetime.now()
+    report.stalled_tasks = scheduled - completed
+    report.unassigned_entities = _FindUnassignedEntities(layer)
+    report.put()
+  else:
+    args = {'stage': 'monitor', 'completed': completed}
     taskqueue.add(url=_GetBakerURL(layer), params=args,
                   countdown=settings.BAKER_MONITOR_DELAY)
+
+
+def _CompleteSubdivideTask(layer):
+  """Counts a completed subdivide task and finishes baking after the last one.
+
+  Each subdivide task counts the tasks it schedules before it counts itself as
+  completed. The completed tasks are therefore read before the scheduled ones:
+  if the counts are then equal, no task was outstanding when the completed
+  tasks were read, and none can have been scheduled since.
+
+  Args:
+    layer: The layer being baked.
+  """
+  model.IncrementCounter(_GetCounterName(layer, 'completed'))
+  completed = model.GetCounter(_GetCounterName(layer, 'completed'))
+  if completed == model.GetCounter(_GetCounterName(layer, 'scheduled')):
+    _FinishBaking(layer)
+
+
+def _FinishBaking(layer):
+  """Marks a layer as baked and reports entities left out of every division.
+
+  If a new generation of divisions was being built, switches the layer over to
+  it with a single put, and schedules the collection of the replaced
+  generation after settings.BAKER_COLLECT_DELAY seconds. Then schedules the
+  render stage for the served divisions, unless the layer is uncacheable.
+
+  Looks for unassigned entities with _FindUnassignedEntities(), and records them
+  in the layer's BakeReport. Repeated calls are harmless.
+
+  Args:
+    layer: The layer to finish.
+  """
+  unassigned = _FindUnassignedEntities(layer)
+  replaced_generation = layer.division_generation
+  switched = layer.baking_generation is not None
+  if switched:
+    layer.division_generation = layer.baking_generation
+    layer.baking_generation = None
+  layer.baked = True
+  layer.busy = False
+  layer.put()
+  if switched:
+    layer.ClearDocumentCache()
+    taskqueue.add(url=_GetBakerURL(layer), params={
+        'stage': 'collect',
+        'generation': replaced_generation or ''
+    }, countdown=settings.BAKER_COLLECT_DELAY)
+  if not layer.uncacheable:
+    if layer.division_generation is None:
+      generation = ''
+    else:
+      generation = layer.division_generation
+    taskqueue.add(url=_GetBakerURL(layer), params={
+        'stage': 'render',
+        'generation': generation
+    })
+
+  key_name = model.BakeReport.GetKeyName(layer)
+  report = (model.BakeReport.get_by_key_name(key_name) or
+            model.BakeReport(key_name=key_name))
+  report.finished = datetime.datetime.now()
+  report.unassigned_entities = unassigned
+  report.division_count, report.depth = _MeasureDivisionTree(layer)
+  report.put()
+
+
+def _FindUnassignedEntities(layer):
+  """Returns the IDs of entities of a layer not assigned to any division.
+
+  Uses a single query limited to settings.BAKER_RECONCILE_LIMIT results, and
+  logs the IDs found.
+
+  Args:
+    layer: The layer whose entities to look for.
+
+  Returns:
+    A list of up to settings.BAKER_RECONCILE_LIMIT entity IDs.
+  """
+  query = model.Entity.all(keys_only=True).filter('layer', layer)
+  query.filter('baked', None)
+  unassigned = [i.id() for i in query.fetch(settings.BAKER_RECONCILE_LIMIT)]
+  if unassigned:
+    logging.warning('Entities of layer %d not assigned to any division: %s',
+                    layer.key().id(), unassigned)
+  return unassigned
+
+
+def _CollectDivisions(layer, generation):
+  """Deletes a generation of divisions of a layer with batched deletes.
+
+  Never deletes the served generation or the one being baked. If App Engine
+  interrupts this function, it is rescheduled to be called again immediately.
+
+  Args:
+    layer: The layer whose divisions to delete.
+    generation: The generation of the divisions to delete. None for divisions
+        created before divisions had generations.
+  """
+  if (generation == layer.division_generation or
+      (generation is not None and generation == layer.baking_generation)):
+    return
+  query = model.Division.all(keys_only=(generation is not None))
+  _FilterByGeneration(query.filter('layer', layer), generation)
+  try:
+    while True:
+      results = query.fetch(_BATCH_SIZE)
+      if not results:
+        break
+      if generation is None:
+        results = [i.key() for i in results if i.generation is None]
+      if results:
+        db.delete(results)
+      query.with_cursor(query.cursor())
+  except (runtime.DeadlineExceededError, db.Error,
+          apiproxy_errors.OverQuotaError):
+    if generation is None:
+      generation = ''
+    taskqueue.add(url=_GetBakerURL(layer), params={
+        'stage': 'collect',
+        'generation': generation
+    })
+
+
+def _RenderDivisions(layer, generation, cursor):
+  """Generates and caches the KML of the served divisions of a layer.
+
+  Walks the divisions in batches of settings.BAKER_RENDER_BATCH_SIZE. The
+  entities of each batch are loaded together with their geometries, styles
+  and other references (see model.PrefetchDivisionEntities()), and the cached
+  KML of the whole batch is saved with batched puts. The time each division
+  took to render and the size of its KML are recorded on the division.
+  Divisions whose cached KML is still valid are skipped, so after an
+  incremental bake only the divisions that changed are rendered.
+
+  Does nothing if the layer is uncacheable or has switched to another
+  generation since. If App Engine interrupts this function, it is rescheduled
+  to continue after the last batch saved.
+
+  Args:
+    layer: The layer whose divisions to render.
+    generation: The generation of the divisions to render. None for divisions
+        created before divisions had generations.
+    cursor: The cursor of the divisions query from which to continue. Empty to
+        start from the first division.
+  """
+  if generation != layer.division_generation or layer.uncacheable:
+    return
+  query = model.Division.all().filter('layer', layer)
+  _FilterByGeneration(query, generation)
+  if cursor:
+    query.with_cursor(cursor)
+  try:
+    while True:
+      divisions = query.fetch(settings.BAKER_RENDER_BATCH_SIZE)
+      if not divisions:
+        break
+      divisions = [i for i in divisions
+                   if i.generation == generation and i.baked]
+      cache = collections.defaultdict(dict)
+      model.PrefetchDivisionEntities(divisions, cache, [layer])
+      rendered = 0
+      for division in divisions:
+        if division.HasValidKMLCache(cache):
+          continue
+        start = time.time()
+        kml = division.GenerateKML(cache)
+        division.render_time = time.time() - start
+        division.kml_size = len(kml.encode('utf8'))
+        rendered += 1
+      model.FlushCacheFills(cache)
+      if rendered:
+        model.IncrementCounter(_GetCounterName(layer, 'rendered'), rendered)
+      cursor = query.cursor()
+      query.with_cursor(cursor)
+  except (runtime.DeadlineExceededError, db.Error,
+          apiproxy_errors.OverQuotaError):
+    if generation is None:
+      generation = ''
+    taskqueue.add(url=_GetBakerURL(layer), params={
+        'stage': 'render',
+        'generation': generation,
+        'cursor': cursor or ''
+    })
+
+
+def _RebuildGeocellCounts(layer, kind, cursor):
+  """Rebuilds the geocell counts of a layer from its entities.
+
+  Deletes the layer's model.GeocellCount objects with batched deletes, then
+  walks its entities in batches and counts each batch with
+  model.UpdateGeocellCounts(). Repairs counts that have drifted because of
+  concurrent updates, and builds them for entities created before they were
+  kept. Entities changed during the walk may be counted twice or not at all.
+
+  If App Engine interrupts this function, it is rescheduled to continue from
+  the last batch counted.
+
+  Args:
+    layer: The layer whose entities to count.
+    kind: The name of the kind being walked, one of _COUNT_KINDS. Empty to
+        start from the beginning.
+    cursor: For the Entity walk, the cursor of the query from which to
+        continue. Empty to start from the first entity.
+  """
+  kind = kind or _COUNT_KINDS[0]
+  try:
+    if kind == 'GeocellCount':
+      query = model.GeocellCount.all(keys_only=True).filter('layer', layer)
+      while True:
+        keys = query.fetch(_BATCH_SIZE)
+        if not keys:
+          break
+        db.delete(keys)
+        query.with_cursor(query.cursor())
+      kind = 'Entity'
+      cursor = None
+    query = model.Entity.all().filter('layer', layer)
+    if cursor:
+      query.with_cursor(cursor)
+    while True:
+      entities = query.fetch(_BATCH_SIZE)
+      if not entities:
+        break
+      model.UpdateGeocellCounts(layer, entities)
+      cursor = query.cursor()
+      query.with_cursor(cursor)
+  except (runtime.DeadlineExceededError, db.Error,
+          apiproxy_errors.OverQuotaError):
+    taskqueue.add(url=_GetBakerURL(layer), params={
+        'stage': 'count',
+        'kind': kind,
+        'cursor': cursor or ''
+    })
+
+
+def _MeasureDivisionTree(layer):
+  """Counts the divisions of a layer and the levels of its division tree.
+
+  Only the served generation of divisions is measured.
+
+  Args:
+    layer: The layer whose divisions to measure.
+
+  Returns:
+    A (division count, depth) tuple. The depth of a layer without divisions is
+    0, and that of a layer with only a root division is 1.
+  """
+  division_count = 0
+  query = model.Division.all(keys_only=True).filter('layer', layer)
+  _FilterByGeneration(query, layer.division_generation)
+  while True:
+    keys = query.fetch(_BATCH_SIZE)
+    if not keys:
+      break
+    division_count += len(keys)
+    query.with_cursor(query.cursor())
+  query = model.Division.all().filter('layer', layer)
+  _FilterByGeneration(query, layer.division_generation)
+  deepest = query.order('-depth').get()
+  if deepest:
+    depth = (deepest.depth or 0) + 1
   else:
-    layer.baked = True
-    layer.busy = False
-    layer.put()
+    depth = 0
+  return division_count, depth
 
 
-def _Subdivide(layer, north, south, east, west,
-               parent, retry_division, retry_has_children):
+def _Subdivide(layer, north, south, east, west, parent, path,
+               retry_division, retry_has_children):
   """Performs a subdivision step.
 
   Either starts a new subdivision or completes a previously interrupted one.
   If the function is interrupted, reschedules itself immediately. If the
   geospatial query has completed before the interruption, its results are
-  saved and not recalculated.
+  saved and not recalculated. A step whose division already exists is an
+  unscheduled rerun and does nothing. Divisions with a quad path are keyed by
+  it, so that takes a single get.
 
   Gets the most prioritized N entities in the specified bounding box, and puts
-  them in a new Division object. If the number of entities is above the hard
-  maximum, limits the number of entities in the new division to the soft
-  maximum and schedules further subdivisions immediately. Otherwise puts all
-  the entities in the new division and does not schedule any further actions.
+  them in a new Division object. The entities are flagged as baked with batched
+  puts, after the unbaked counts of their geocells are decremented. If the
+  number of entities is above the hard maximum, limits the number of entities
+  in the new division to the soft maximum, chooses where to split the region
+  (see _ChooseSplitFromCounts()) and schedules further subdivisions
+  immediately. Otherwise puts all the entities in the new division and does not
+  schedule any further actions. Whether the region holds more than the hard
+  maximum is first read from the unbaked counts of the geocells inside it (see
+  _GetInnerCountCells()). If it does, only the soft maximum of entities is
+  fetched; otherwise up to the hard maximum is fetched, which also settles the
+  question when the counts fall short, for example because they have never been
+  built (see _RebuildGeocellCounts()). If the layer has division_clusters set,
+  a division with children also gets cluster placemarks made from the layer's
+  geocell counts (see _GetClusters()).
+  Either way, the step is then counted as completed, which finishes baking if
+  it was the last one. The new division and the entities flagged are counted
+  as they are saved, and a rescheduled step is counted as retried. The KML of
+  the division is left to the render stage, so the step only does spatial
+  work.
 
   Args:
     layer: The layer to subdivide.
@@ -216,6 +963,8 @@ def _Subdivide(layer, north, south, east, west,
     east: The maximum longitude of the region to subdivide.
     west: the minimum longitude of the region to subdivide.
     parent: The parent Division. None for root divisions.
+    path: The quad path of the new division. None if the parent has none, in
+        which case the division gets a numeric ID.
     retry_division: The division to try processing again. Only specified for
         subdivide tasks that previously failed due to time constraints.
     retry_has_children: Whether this subdivision should be subdivided further.
@@ -223,9 +972,19 @@ def _Subdivide(layer, north, south, east, west,
         constrains. For normal subdivide tasks, calculated based on datastore
         query results.
   """
-  query = layer.division_set.filter('north', north).filter('south', south)
-  query = query.filter('east', east).filter('west', west)
-  if query.get():
+  generation = _GetBakingGeneration(layer)
+  key_name = None
+  if generation is not None and path is not None:
+    key_name = model.Division.GetKeyName(layer, generation, path)
+  if retry_division:
+    existing = None
+  elif key_name:
+    existing = model.Division.get_by_key_name(key_name)
+  else:
+    query = layer.division_set.filter('north', north).filter('south', south)
+    query = query.filter('east', east).filter('west', west)
+    existing = _FilterByGeneration(query, generation).get()
+  if existing:
     # This was an unscheduled rerun. Cancel it.
     return
 
@@ -235,6 +994,7 @@ def _Subdivide(layer, north, south, east, west,
 
   has_children = False
   division = None
+  saved = bool(retry_division)
 
   try:
     if retry_division:
@@ -247,40 +1007,74 @@ def _Subdivide(layer, north, south, east, west,
       west = division.west
     else:
       box = geotypes.Box(north, east, south, west)
-      entities = layer.entity_set.filter('baked', None).order('-priority')
-      entities = model.Entity.bounding_box_fetch(entities, box, max_results)
+      query = layer.entity_set.filter('baked', None).order('-priority')
+      cells = _GetInnerCountCells(north, south, east, west)
+      unbaked_counts = dict(zip(cells,
+                                model.GetUnbakedGeocellCounts(layer, cells)))
+      if sum(unbaked_counts.itervalues()) >= max_results:
+        # The region is full, so only the entities that go into the division
+        # are fetched. Fewer come back if the counts are out of date.
+        entities = model.Entity.bounding_box_fetch(query, box, division_size)
+        has_children = (len(entities) == division_size)
+      else:
+        entities = model.Entity.bounding_box_fetch(query, box, max_results)
+        has_children = (len(entities) == max_results)
       if not entities:
+        _CompleteSubdivideTask(layer)
         return
-      has_children = (len(entities) == max_results)
+      split_latitude = split_longitude = None
       if has_children:
+        leftovers = [i.location for i in entities[division_size:]]
         entities = entities[:division_size]
+        split_latitude, split_longitude = _ChooseSplitFromCounts(
+            layer.division_split, north, south, east, west, unbaked_counts,
+            [i.location for i in entities], leftovers)
       entity_ids = [i.key().id() for i in entities]
+      if parent:
+        depth = (parent.depth or 0) + 1
+      else:
+        depth = 0
+      clusters = {}
+      if has_children and layer.division_clusters:
+        clusters = _GetClusters(
+            north, south, east, west,
+            lambda cells: model.GetGeocellAggregates(layer, cells))
 
-      division = model.Division(layer=layer, north=north, south=south,
-                                east=east, west=west, entities=entity_ids,
-                                parent_division=parent, baked=False)
+      division = model.Division(key_name=key_name, layer=layer, north=north,
+                                south=south, east=east, west=west,
+                                entities=entity_ids, parent_division=parent,
+                                depth=depth, generation=generation,
+                                split_latitude=split_latitude,
+                                split_longitude=split_longitude, baked=False,
+                                **clusters)
       division.put()
+      saved = True
+      model.IncrementCounter(_GetCounterName(layer, 'divisions'))
 
-    for entity in entities:
-      if not entity.baked:
-        entity.baked = True
-        entity.put()
+    unbaked_entities = [i for i in entities if not i.baked]
+    model.MarkGeocellsBaked(layer, [i.location for i in unbaked_entities])
+    for entity in unbaked_entities:
+      entity.baked = True
+    for start in xrange(0, len(unbaked_entities), _BATCH_SIZE):
+      db.put(unbaked_entities[start:start + _BATCH_SIZE])
+    if unbaked_entities:
+      model.IncrementCounter(_GetCounterName(layer, 'assigned'),
+                             len(unbaked_entities))
 
     if parent: parent.ClearCache()
     division.baked = True
     division.put()
-    division.GenerateKML()  # Build KML cache.
   except (runtime.DeadlineExceededError, db.Error,
           apiproxy_errors.OverQuotaError):
-    # If division does not exist or isn't saved, this raises an error and causes
-    # the request to be rescheduled with the original parameters.
-    retry_division_id = division.key().id()
-    if retry_division_id:
+    # If the division isn't saved, raising causes the request to be
+    # rescheduled with the original parameters.
+    if saved:
       taskqueue.add(url=_GetBakerURL(layer), params={
           'stage': 'subdivide',
-          'retry_division': retry_division_id,
+          'retry_division': str(division.key()),
           'retry_has_children': '1'[:has_children]
       })
+      model.IncrementCounter(_GetCounterName(layer, 'retried'))
     else:
       raise
   else:
@@ -290,15 +1084,16 @@ def _Subdivide(layer, north, south, east, west,
     except runtime.DeadlineExceededError:
       if has_children:
         _ScheduleSubdivideChildren(layer, north, south, east, west, division)
+    _CompleteSubdivideTask(layer)
 
 
 def _ScheduleSubdivideChildren(layer, north, south, east, west, parent):
   """Schedules subdivide steps for each part of the specified region.
 
-  If the bounding box touches either of the poles on one side (and only one
-  side), divides it into 3 parts, where the part that touches the pole spans all
-  the way the entire longitude range, while the other two parts span half of
-  that.
+  See _GetChildSlices() for how the region is split. The split point is the one
+  recorded on the parent division. Each child's quad path extends the parent's
+  with the index of its slice. The tasks are counted as scheduled before they
+  are added.
 
   Args:
     layer: The layer for which to schedule further subdivide steps.
@@ -308,8 +1103,283 @@ def _ScheduleSubdivideChildren(layer, north, south, east, west, parent):
     west: the minimum longitude of the region to subdivide.
     parent: The Division object which covers the entire region.
   """
-  mid_latitude = (north + south) / 2
-  mid_longitude = (east + west) / 2
+  slices = _GetChildSlices(north, south, east, west,
+                           parent.split_latitude, parent.split_longitude)
+  model.IncrementCounter(_GetCounterName(layer, 'scheduled'), len(slices))
+  parent_path = parent.GetPath()
+  for index, slice_args in enumerate(slices):
+    args = {
+        'stage': 'subdivide',
+        'parent': str(parent.key()),
+        'path': _GetChildPath(parent_path, index) or ''
+    }
+    args.update(slice_args)
+    _AddSubdivideTask(layer, args)
+
+
+def _ChooseSplit(division_split, north, south, east, west, locations,
+                 weights=None):
+  """Chooses where to split the region of a full division among its children.
+
+  With the 'median' strategy, the region is cut through the median latitude and
+  longitude of the entities that are next in line for it, so that dense areas
+  get small children and sparse ones large children, instead of long chains of
+  nearly empty divisions. A median on the edge of the region would not shrink
+  it along that axis, so the center is used instead.
+
+  Args:
+    division_split: The split strategy of the layer, one of the keys of
+        model.Layer.DIVISION_SPLITS, or None.
+    north: The maximum latitude of the region to split.
+    south: The minimum latitude of the region to split.
+    east: The maximum longitude of the region to split.
+    west: the minimum longitude of the region to split.
+    locations: The db.GeoPt locations of the unbaked entities in the region
+        that did not fit into its division.
+    weights: The number of entities at each location. Defaults to 1 for each.
+
+  Returns:
+    A (latitude, longitude) tuple of the split point. Either is None to split
+    through the center along that axis.
+  """
+  if weights is None:
+    weights = [1] * len(locations)
+  points = [(location, weight) for location, weight in zip(locations, weights)
+            if location and weight]
+  if division_split != 'median' or not points:
+    return None, None
+  latitude = _GetWeightedMedian([(i.lat, weight) for i, weight in points])
+  longitude = _GetWeightedMedian([(i.lon, weight) for i, weight in points])
+  if not south < latitude < north:
+    latitude = None
+  if not west < longitude < east:
+    longitude = None
+  return latitude, longitude
+
+
+def _GetWeightedMedian(values):
+  """Returns the median of a list of (value, weight) tuples.
+
+  The upper median is returned if the weights split evenly between two values.
+  """
+  half = sum(weight for _, weight in values) / 2.0
+  running = 0
+  for value, weight in sorted(values):
+    running += weight
+    if running > half:
+      return value
+
+
+def _ChooseSplitFromCounts(division_split, north, south, east, west,
+                           unbaked_counts, placed, leftovers):
+  """Chooses where to split the region of a full division from geocell counts.
+
+  The entities left for the children are counted in the geocells of
+  _GetInnerCountCells() by taking those placed into the division off the
+  unbaked counts. The region is then split through their median as in
+  _ChooseSplit(), with the entities of each geocell at its center. If none are
+  counted, for example because the layer's counts have never been built, the
+  leftover entities fetched are used instead.
+
+  Args:
+    division_split: The split strategy of the layer, one of the keys of
+        model.Layer.DIVISION_SPLITS, or None.
+    north: The maximum latitude of the region to split.
+    south: The minimum latitude of the region to split.
+    east: The maximum longitude of the region to split.
+    west: the minimum longitude of the region to split.
+    unbaked_counts: A dictionary mapping the geocells of _GetInnerCountCells()
+        to their numbers of unbaked entities, before the division was filled.
+    placed: The db.GeoPt locations of the entities placed into the division.
+    leftovers: The db.GeoPt locations of the unbaked entities in the region
+        that were fetched but did not fit into its division. May be empty.
+
+  Returns:
+    A (latitude, longitude) tuple of the split point. Either is None to split
+    through the center along that axis.
+  """
+  if division_split != 'median':
+    return None, None
+  placed_counts = _CountInCells(unbaked_counts.keys(), placed)
+  centers = []
+  weights = []
+  for cell, count in sorted(unbaked_counts.iteritems()):
+    count -= placed_counts[cell]
+    if count > 0:
+      box = geocell.compute_box(cell)
+      centers.append(db.GeoPt((box.north + box.south) / 2,
+                              (box.east + box.west) / 2))
+      weights.append(count)
+  if centers:
+    return _ChooseSplit(division_split, north, south, east, west, centers,
+                        weights)
+  else:
+    return _ChooseSplit(division_split, north, south, east, west, leftovers)
+
+
+def _GetInnerCountCells(north, south, east, west):
+  """Returns the geocells whose counts the baker relies on for a region.
+
+  These are the geocells of _GetCountCells(), with up to
+  settings.BAKER_COUNT_CELLS geocells, that lie entirely inside the region.
+  Their unbaked counts include no entities from outside the region, which
+  other subdivide steps may be placing at the same time, so they do not depend
+  on the order in which the steps run. The entities in the geocells on the
+  edge of the region are not counted.
+
+  Args:
+    north: The maximum latitude of the region.
+    south: The minimum latitude of the region.
+    east: The maximum longitude of the region.
+    west: the minimum longitude of the region.
+
+  Returns:
+    A list of geocell strings of the same resolution, possibly empty.
+  """
+  cells = []
+  for cell in _GetCountCells(north, south, east, west,
+                             settings.BAKER_COUNT_CELLS):
+    box = geocell.compute_box(cell)
+    if (south <= box.south and box.north <= north and
+        west <= box.west and box.east <= east):
+      cells.append(cell)
+  return cells
+
+
+def _CountInCells(cells, locations):
+  """Counts locations in geocells of a single resolution, in memory.
+
+  Args:
+    cells: A list of geocell strings of the same resolution.
+    locations: A list of db.GeoPt locations. None values are ignored.
+
+  Returns:
+    A dictionary mapping each of the geocells to the number of locations in it.
+  """
+  counts = dict((i, 0) for i in cells)
+  if cells:
+    resolution = len(cells[0])
+    for location in locations:
+      if location:
+        cell = geocell.compute(location, resolution)
+        if cell in counts:
+          counts[cell] += 1
+  return counts
+
+
+def _GetClusters(north, south, east, west, get_aggregates):
+  """Makes the cluster placemarks of a division from geocell aggregates.
+
+  Each geocell covering the region (see _GetCountCells(), with up to
+  settings.BAKER_CLUSTER_CELLS geocells) whose entities have their centroid
+  inside the region becomes a cluster. A geocell on the edge of the region
+  may also count entities outside of it.
+
+  Args:
+    north: The maximum latitude of the region.
+    south: The minimum latitude of the region.
+    east: The maximum longitude of the region.
+    west: the minimum longitude of the region.
+    get_aggregates: A function that takes a list of geocells and returns a
+        (count, centroid) tuple for each, like model.GetGeocellAggregates().
+
+  Returns:
+    A dictionary of the cluster_cells, cluster_counts and cluster_locations
+    properties of the division.
+  """
+  cells = _GetCountCells(north, south, east, west,
+                         settings.BAKER_CLUSTER_CELLS)
+  clusters = {'cluster_cells': [], 'cluster_counts': [],
+              'cluster_locations': []}
+  for cell, (count, centroid) in zip(cells, get_aggregates(cells)):
+    if (count and south <= centroid.lat <= north and
+        west <= centroid.lon <= east):
+      clusters['cluster_cells'].append(cell)
+      clusters['cluster_counts'].append(count)
+      clusters['cluster_locations'].append(centroid)
+  return clusters
+
+
+def _AggregateGeocells(points):
+  """Counts entities by geocell in memory, like model.UpdateGeocellCounts().
+
+  Args:
+    points: A list of (entity ID, db.GeoPt location, priority) tuples.
+
+  Returns:
+    A dictionary mapping each geocell up to settings.GEOCELL_COUNT_RESOLUTION
+    characters long that holds entities to a (count, db.GeoPt centroid) tuple.
+  """
+  sums = collections.defaultdict(lambda: [0, 0.0, 0.0])
+  for _, location, _ in points:
+    cell = geocell.compute(location, settings.GEOCELL_COUNT_RESOLUTION)
+    for resolution in xrange(1, len(cell) + 1):
+      total = sums[cell[:resolution]]
+      total[0] += 1
+      total[1] += location.lat
+      total[2] += location.lon
+  return dict((cell, (count, db.GeoPt(latitude / count, longitude / count)))
+              for cell, (count, latitude, longitude) in sums.iteritems())
+
+
+def _GetCountCells(north, south, east, west, max_cells):
+  """Returns the geocells whose counts to use for a region.
+
+  Picks the finest resolution, up to settings.GEOCELL_COUNT_RESOLUTION, at
+  which at most max_cells geocells cover the region. Falls back to the coarsest
+  resolution if even that takes more.
+
+  Args:
+    north: The maximum latitude of the region.
+    south: The minimum latitude of the region.
+    east: The maximum longitude of the region.
+    west: the minimum longitude of the region.
+    max_cells: The maximum number of geocells to return.
+
+  Returns:
+    A list of geocell strings that together cover the region.
+  """
+  resolution = settings.GEOCELL_COUNT_RESOLUTION
+  cell_ne = geocell.compute(geotypes.Point(north, east), resolution)
+  cell_sw = geocell.compute(geotypes.Point(south, west), resolution)
+  while (resolution > 1 and
+         geocell.interpolation_count(cell_ne, cell_sw) > max_cells):
+    resolution -= 1
+    cell_ne = cell_ne[:resolution]
+    cell_sw = cell_sw[:resolution]
+  return geocell.interpolate(cell_ne, cell_sw)
+
+
+def _GetChildSlices(north, south, east, west,
+                    split_latitude=None, split_longitude=None):
+  """Splits a region into the regions of its child divisions.
+
+  If the bounding box touches either of the poles on one side (and only one
+  side), divides it into 3 parts, where the part that touches the pole spans all
+  the way the entire longitude range, while the other two parts span half of
+  that. Otherwise divides it into 4 quadrants.
+
+  Args:
+    north: The maximum latitude of the region to split.
+    south: The minimum latitude of the region to split.
+    east: The maximum longitude of the region to split.
+    west: the minimum longitude of the region to split.
+    split_latitude: The latitude at which to split the region. Defaults to the
+        middle of the region.
+    split_longitude: The longitude at which to split the region. Defaults to
+        the middle of the region.
+
+  Returns:
+    A tuple of dictionaries with north, south, east and west keys.
+  """
+  if split_latitude is None:
+    mid_latitude = (north + south) / 2
+  else:
+    mid_latitude = split_latitude
+  if split_longitude is None:
+    mid_longitude = (east + west) / 2
+  else:
+    mid_longitude = split_longitude
   if north == 90 and south != -90:
     slices = (
         {'north': north, 'south': mid_latitude,
@@ -339,10 +1409,305 @@ def _ScheduleSubdivideChildren(layer, north, south, east, west, parent):
         {'north': mid_latitude, 'south': south,
          'east': mid_longitude, 'west': west}
     )
-  args = {'stage': 'subdivide', 'parent': parent.key().id()}
-  for slice_args in slices:
-    args.update(slice_args)
+  return slices
+
+
+def BakeInMemory(layer):
+  """Bakes a layer in a single process instead of through the task queue.
+
+  Reads the location and priority of every entity in the layer, builds the
+  whole division tree in memory with _PlanDivisions(), then writes it as a new
+  generation of divisions and updates the entities' baked flags and the
+  unbaked counts of the layer's geocell counts with large batched writes. The
+  layer keeps serving its current divisions until it is switched over to the
+  new ones. Takes far fewer datastore round trips than the task queue baker,
+  but has to run in a long-lived process rather than in a request, for example
+  through the remote API with bake_offline.py.
+
+  The divisions' KML is not pre-generated; each division builds and caches it
+  the first time it is served. If the layer has division_clusters set, the
+  cluster placemarks are made from the locations read rather than from the
+  layer's geocell counts.
+
+  Args:
+    layer: The auto-managed layer to bake.
+  """
+  abandoned_generation = layer.baking_generation
+  layer.baking_generation = max(layer.division_generation or 0,
+                                layer.baking_generation or 0) + 1
+  layer.busy = True
+  layer.put()
+  _ResetBakeRecords(layer)
+  if abandoned_generation is not None:
+    _CollectDivisions(layer, abandoned_generation)
+
+  points = []
+  query = layer.entity_set
+  while True:
+    entities = query.fetch(_BATCH_SIZE)
+    if not entities:
+      break
+    for entity in entities:
+      if entity.location:
+        points.append((entity.key().id(), entity.location, entity.priority))
+    query.with_cursor(query.cursor())
+
+  plans = _PlanDivisions(points,
+                         layer.division_size or settings.DEFAULT_DIVISION_SIZE,
+                         layer.division_split)
+  clusters = {}
+  if layer.division_clusters:
+    aggregates = _AggregateGeocells(points)
+    get_aggregates = lambda cells: [aggregates.get(i, (0, None)) for i in cells]
+    for parent in set(plan['parent'] for plan in plans):
+      if parent is not None:
+        plan = plans[parent]
+        clusters[parent] = _GetClusters(plan['north'], plan['south'],
+                                        plan['east'], plan['west'],
+                                        get_aggregates)
+
+  # Divisions are keyed by their quad paths, so the keys of their parents are
+  # known before anything is saved.
+  key_names = [model.Division.GetKeyName(layer, layer.baking_generation,
+                                         plan['path']) for plan in plans]
+  divisions = []
+  for index, (plan, key_name) in enumerate(zip(plans, key_names)):
+    parent = plan['parent']
+    if parent is not None:
+      parent = db.Key.from_path('Division', key_names[parent])
+    divisions.append(model.Division(
+        key_name=key_name, layer=layer, north=plan['north'],
+        south=plan['south'], east=plan['east'], west=plan['west'],
+        entities=plan['entities'], parent_division=parent,
+        depth=plan['depth'], generation=layer.baking_generation,
+        split_latitude=plan['split_latitude'],
+        split_longitude=plan['split_longitude'], baked=True,
+        **clusters.get(index, {})))
+  for start in xrange(0, len(divisions), _BATCH_SIZE):
+    db.put(divisions[start:start + _BATCH_SIZE])
+
+  baked_ids = set()
+  for plan in plans:
+    baked_ids.update(plan['entities'])
+  query = layer.entity_set
+  while True:
+    entities = query.fetch(_BATCH_SIZE)
+    if not entities:
+      break
+    changed_entities = []
+    for entity in entities:
+      baked = (entity.key().id() in baked_ids) or None
+      if entity.baked != baked:
+        entity.baked = baked
+        changed_entities.append(entity)
+    if changed_entities:
+      db.put(changed_entities)
+    query.with_cursor(query.cursor())
+
+  unplaced = _AggregateGeocells([i for i in points if i[0] not in baked_ids])
+  query = model.GeocellCount.all().filter('layer', layer)
+  while True:
+    counts = query.fetch(_BATCH_SIZE)
+    if not counts:
+      break
+    changed_counts = []
+    for count in counts:
+      unbaked = min(unplaced.get(count.GetCell(), (0, None))[0], count.count)
+      if count.unbaked != unbaked:
+        count.unbaked = unbaked
+        changed_counts.append(count)
+    if changed_counts:
+      db.put(changed_counts)
+    query.with_cursor(query.cursor())
+
+  _FinishBaking(layer)
+
+
+def _PlanDivisions(points, division_size, division_split=None):
+  """Builds the division tree of a layer in memory.
+
+  Follows the same rules as the subdivide steps of the task queue baker: each
+  division takes the highest priority entities in its region that are not in
+  any other division yet, and, if there are more than the hard maximum, keeps
+  only division_size of them and splits the region as in
+  _ChooseSplitFromCounts() and _GetChildSlices(). The geocell counts are taken
+  from the entities read rather than from the layer's geocell counts, so the
+  trees match when the layer's counts are up to date.
+  Regions are processed breadth first, so an entity on the boundary of two
+  regions goes to the one that would have been scheduled first. Entities of
+  equal priority are taken in order of ID.
+
+  Args:
+    points: A list of (entity ID, db.GeoPt location, priority) tuples.
+    division_size: The soft maximum for the number of entities per division.
+    division_split: The split strategy of the layer, one of the keys of
+        model.Layer.DIVISION_SPLITS, or None.
+
+  Returns:
+    A list of dictionaries, one for each division, with north, south, east and
+    west keys for its bounds, an entities key for the list of its entity IDs in
+    order of priority, a parent key for the index of its parent division in the
+    list (None for the root), a depth key for its number of ancestors, a path
+    key for its quad path, and split_latitude and split_longitude keys for the
+    split point of its region (None for the center). Parents appear before
+    their children.
+  """
+  ratio = (1 + settings.DIVISION_SIZE_GROWTH_LIMIT)
+  max_results = int(division_size * ratio) + 1
+  points = sorted(points, key=lambda point: (point[2] is None,
+                                             -(point[2] or 0), point[0]))
+  baked_ids = set()
+  plans = []
+  regions = collections.deque([(90.0, -90.0, 180.0, -180.0, None,
+                                 model.Division.ROOT_PATH, points)])
+  while regions:
+    north, south, east, west, parent, path, candidates = regions.popleft()
+    candidates = [i for i in candidates if i[0] not in baked_ids and
+                  south <= i[1].lat <= north and west <= i[1].lon <= east]
+    if not candidates:
+      continue
+    selected = candidates[:max_results]
+    has_children = (len(selected) == max_results)
+    split_latitude = split_longitude = None
+    if has_children:
+      if division_split == 'median':
+        cells = _GetInnerCountCells(north, south, east, west)
+        split_latitude, split_longitude = _ChooseSplitFromCounts(
+            division_split, north, south, east, west,
+            _CountInCells(cells, [i[1] for i in candidates]),
+            [i[1] for i in selected[:division_size]],
+            [i[1] for i in selected[division_size:]])
+      selected = selected[:division_size]
+    entity_ids = [i[0] for i in selected]
+    baked_ids.update(entity_ids)
+    if parent is None:
+      depth = 0
+    else:
+      depth = plans[parent]['depth'] + 1
+    plans.append({'north': north, 'south': south, 'east': east, 'west': west,
+                  'entities': entity_ids, 'parent': parent, 'depth': depth,
+                  'path': path, 'split_latitude': split_latitude,
+                  'split_longitude': split_longitude})
+    if has_children:
+      remaining = candidates[division_size:]
+      slices = _GetChildSlices(north, south, east, west,
+                               split_latitude, split_longitude)
+      for index, child_slice in enumerate(slices):
+        regions.append((child_slice['north'], child_slice['south'],
+                        child_slice['east'], child_slice['west'],
+                        len(plans) - 1, _GetChildPath(path, index),
+                        remaining))
+  return plans
+
+
+def _GetChildPath(path, index):
+  """Returns the quad path of a child division.
+
+  Args:
+    path: The quad path of the parent division, or None if it has none.
+    index: The index of the child's slice among those returned by
+        _GetChildSlices() for the parent's region.
+
+  Returns:
+    The quad path, or None if the parent has none.
+  """
+  if path is None:
+    return None
+  elif path == model.Division.ROOT_PATH:
+    return '%s%d' % (path, index)
+  else:
+    return '%s-%d' % (path, index)
+
+
+def _AddSubdivideTask(layer, args):
+  """Adds a subdivide task that has already been counted as scheduled.
+
+  During a full baking run, a task that creates a division with a quad path is
+  named after that division, so the task queue rejects any second task for it;
+  the scheduled count is then corrected. Incremental runs add to the same
+  generation every time, and task names cannot be reused, so their tasks are
+  left unnamed and duplicates are cancelled by _Subdivide() instead.
+
+  Args:
+    layer: The layer being baked.
+    args: The POST parameters of the subdivide task.
+  """
+  if layer.baking_generation is None or not args.get('path'):
     taskqueue.add(url=_GetBakerURL(layer), params=args)
+    return
+  name = 'subdivide-%d-%d-%s' % (layer.key().id(), layer.baking_generation,
+                                 args['path'])
+  try:
+    taskqueue.add(url=_GetBakerURL(layer), params=args, name=name)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    model.IncrementCounter(_GetCounterName(layer, 'scheduled'), -1)
+
+
+def _GetBakingGeneration(layer):
+  """Returns the generation of divisions to which subdivide steps add.
+
+  That is the generation being built by a full baking run, or the served one
+  while the layer is baked incrementally.
+
+  Args:
+    layer: The layer being baked.
+
+  Returns:
+    The generation number, or None for a layer baked before divisions had
+    generations.
+  """
+  if layer.baking_generation is None:
+    return layer.division_generation
+  else:
+    return layer.baking_generation
+
+
+def _FilterByGeneration(query, generation):
+  """Restricts a division query to a single generation of divisions.
+
+  Divisions created before divisions had generations lack the property and
+  cannot be queried by it, so the query is left as is for generation None.
+
+  Args:
+    query: The db.Query over Division objects to restrict.
+    generation: The generation to restrict it to.
+
+  Returns:
+    The query.
+  """
+  if generation is not None:
+    query.filter('generation', generation)
+  return query
+
+
+def _GetCounterName(layer, counter):
+  """Returns the name of a sharded counter tracking the baking of a layer.
+
+  Args:
+    layer: The layer being baked.
+    counter: Which counter, e.g. 'scheduled' or 'completed' subdivide tasks.
+
+  Returns:
+    The name to pass to model.IncrementCounter() and model.GetCounter().
+  """
+  return 'baker:%d:%s' % (layer.key().id(), counter)
+
+
+def _ResetBakeRecords(layer):
+  """Resets the counters and the report of a layer for a new baking run."""
+  for counter in _COUNTERS:
+    model.ResetCounter(_GetCounterName(layer, counter))
+  model.BakeReport(key_name=model.BakeReport.GetKeyName(layer)).put()
+
+
+def DeleteBakeRecords(layer):
+  """Deletes all the baking bookkeeping of a layer that is being deleted."""
+  for counter in _COUNTERS:
+    model.ResetCounter(_GetCounterName(layer, counter))
+  db.delete([
+      db.Key.from_path('BakeReport', model.BakeReport.GetKeyName(layer)),
+      db.Key.from_path('BakeSetupBarrier',
+                       model.BakeSetupBarrier.GetKeyName(layer))])
 
 
 def _GetBakerURL(layer):
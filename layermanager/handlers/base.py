@@ -104,6 +104,7 @@ class PageHandler(webapp.RequestHandler):
     try:
       template_args = method(layer)
     except util.RequestDone, e:
+      model.FlushCacheFills(self._cache)
       if e.redirected:
         return
     except util.BadRequest, e:
@@ -117,6 +118,7 @@ class PageHandler(webapp.RequestHandler):
     else:
       if template_args is not None:
         self.RenderTemplate(layer, category, self.FORM_TEMPLATE, template_args)
+      model.FlushCacheFills(self._cache)
 
     if self.response.out.len:
       self.response.set_status(httplib.OK)
@@ -281,6 +283,7 @@ class PageHandler(webapp.RequestHandler):
     description = {}
     excludes = set(excludes)
     excludes.add('cached_kml')
+    excludes.add('kml_dependencies')
     # pylint: disable-msg=W0622
     # "property" is a perfect name, and if it shadows a global, so be it.
     for property_name, property in instance.properties().iteritems():
@@ -18,11 +18,14 @@
 
 import collections
 import httplib
+import math
 import re
+import time
 import xml.dom.minidom
-import zipfile
-from google.appengine.api import images
+from django.utils import simplejson as json
+from google.appengine.api import memcache
 from google.appengine.ext import blobstore
+from google.appengine.ext import webapp
 from google.appengine.ext.webapp import blobstore_handlers
 import model
 import settings
@@ -47,6 +50,17 @@ class DumpServer(blobstore_handlers.BlobstoreDownloadHandler):
           of types other than image and icon. Resized thumbnails are always
           served as a PNG file, regardless of the format of the original blob.
 
+    Layer and division KML served without the compress and pretty arguments is
+    looked up in memcache before anything is loaded from the datastore, and
+    stored there after being generated.
+
+    Unless pretty formatting is requested, KML of cacheable layers is served
+    with an ETag derived from the layer's memcached KML generation and, if
+    known, the Last-Modified time of that generation. Conditional requests
+    that match them are answered with a 304 after a single memcache lookup, or
+    for divisions requested by numeric ID, once the division is loaded and
+    found to belong to the layer in the URL.
+
     Args:
       layer_id: The ID of a layer to use if object_id is unspecified. Unused in
           all other cases.
@@ -54,26 +68,66 @@ class DumpServer(blobstore_handlers.BlobstoreDownloadHandler):
           a resource, "k" means a KML and empty means KML iff object_id is
           "root".
       object_id: The ID of the object to serve. This may be a Resource, a Layer
-          or a Division, depending on the typecode parameter.
+          or a Division, depending on the typecode parameter. Divisions are
+          identified by their quad path, which is looked up among the served
+          divisions of the layer, or by their numeric ID if they have none.
     """
     resize = self.request.get('resize', None)
     no_compress = self.request.get('compress', None) == 'no'
     pretty = 'pretty' in self.request.arguments()
 
+    use_memcache = not no_compress and not pretty
+
     try:
       if typecode == 'r':
         self.GetResource(object_id, resize)
       elif typecode == 'k':
-        division = util.GetInstance(model.Division, object_id)
+        by_path = object_id.startswith(model.Division.ROOT_PATH)
+        validators = self.GetKMLValidators(layer_id, no_compress, pretty)
+        # The validators are derived from the layer in the URL. Divisions
+        # served by quad path are looked up in that layer, but those served by
+        # numeric ID must be loaded before the validators can be trusted.
+        if by_path and self.IsNotModified(validators):
+          return
+        if use_memcache and self.GetMemcachedKML(
+            'Division', _GetMemcacheId(layer_id, object_id), validators,
+            layer_id):
+          return
+        # Read the generation before the division so that a cache clear
+        # landing in between invalidates, rather than adopts, what we store.
+        generation = None
+        if use_memcache:
+          generation = model.GetKMLGeneration(int(layer_id))
+        if by_path:
+          division = _GetDivisionByPath(layer_id, object_id)
+        else:
+          division = util.GetInstance(model.Division, object_id)
+        if validators or use_memcache:
+          division_layer_id = (
+              model.Division.layer.get_value_for_datastore(division).id())
+          if division_layer_id != int(layer_id):
+            validators = None
+            generation = None
+          elif not by_path and self.IsNotModified(validators):
+            return
         compress = division.layer.compressed and not no_compress
-        self.GetKML(division, compress, pretty)
+        self.GetKML(division, compress, pretty, generation, validators)
       elif not typecode and not object_id:
+        validators = self.GetKMLValidators(layer_id, no_compress, pretty)
+        if self.IsNotModified(validators):
+          return
+        if use_memcache and self.GetMemcachedKML('Layer', int(layer_id),
+                                                 validators):
+          return
+        generation = None
+        if use_memcache: generation = model.GetKMLGeneration(int(layer_id))
         layer = util.GetInstance(model.Layer, layer_id)
-        if layer.auto_managed and not layer.baked:
+        if (layer.auto_managed and not layer.baked and
+            not layer.dynamic_viewport):
           raise util.BadRequest('This auto-managed layer has not been baked.')
         else:
           compress = layer.compressed and not no_compress
-          self.GetKML(layer, compress, pretty)
+          self.GetKML(layer, compress, pretty, generation, validators)
       else:
         raise util.BadRequest('Invalid typecode or object ID.')
     except util.BadRequest, e:
@@ -84,9 +138,10 @@ class DumpServer(blobstore_handlers.BlobstoreDownloadHandler):
     """Serves a resource blob and optionally dynamically resizes images.
 
     If the size paramater is not supplied, the blob is served directly. If it
-    is, and the blob is an image or an icon, it is resized and served manually.
-    Resized thumbnails are always served as a PNG file, regardless of the format
-    of the original blob.
+    is, and the blob is an image or an icon, a thumbnail is served instead. Each
+    thumbnail is only generated on its first request and then stored. Resized
+    thumbnails are always served as a PNG file, regardless of the format of the
+    original blob.
 
     No permissions are checked when serving blobs.
 
@@ -118,18 +173,14 @@ class DumpServer(blobstore_handlers.BlobstoreDownloadHandler):
             raise util.BadRequest('Invalid thumbnail size specified.')
 
           if settings.MIN_THUMBNAIL_SIZE <= size <= settings.MAX_THUMBNAIL_SIZE:
-            image = images.Image(blob_key=str(blob_key))
-            # Automatically keeps aspect ratio.
-            image.resize(size, size)
-            thumbnail = image.execute_transforms(output_encoding=images.PNG)
-
+            thumbnail = resource.GetThumbnail(size)
             if thumbnail:
               self.response.headers['Content-Type'] = 'image/png'
               self.response.out.write(thumbnail)
             else:
-              # If the requested size is equal to the original size,
-              # execute_transforms() returns an empty string. In that case we
-              # send back the original image.
+              # If the requested size is equal to the original size, the
+              # thumbnail is empty. In that case we send back the original
+              # image.
               self.send_blob(blob_key)
           else:
             raise util.BadRequest('Invalid thumbnail size specified.')
@@ -140,32 +191,356 @@ class DumpServer(blobstore_handlers.BlobstoreDownloadHandler):
     else:
       raise util.BadRequest('Invalid resource specified.')
 
-  def GetKML(self, layer_or_division, compressed, pretty):
+  def GetKMLValidators(self, layer_id, no_compress, pretty):
+    """Looks up the HTTP validators of a layer's or division's current KML.
+
+    Args:
+      layer_id: The ID of the layer whose KML or division KML is requested, as
+          a string.
+      no_compress: Whether KMZ compression was disabled by the request.
+      pretty: Whether pretty formatting was requested.
+
+    Returns:
+      An (etag, last_modified) tuple, where last_modified is a number of
+      seconds since the epoch or None, or None if the KML cannot be validated.
+    """
+    if pretty: return None
+    generation, last_modified = model.GetKMLValidators(int(layer_id))
+    if generation is None: return None
+    if no_compress:
+      etag = '"%d-kml"' % generation
+    else:
+      etag = '"%d"' % generation
+    # A change later in the same second could not be told apart by clients
+    # revalidating with If-Modified-Since.
+    if last_modified is not None and last_modified >= int(time.time()):
+      last_modified = None
+    return etag, last_modified
+
+  def IsNotModified(self, validators):
+    """Answers a conditional request with a 304 if the client is up to date.
+
+    If-None-Match takes precedence over If-Modified-Since when both are sent.
+
+    Args:
+      validators: The validators returned by GetKMLValidators().
+
+    Returns:
+      Whether the request was answered.
+    """
+    if validators is None: return False
+    etag, last_modified = validators
+    if_none_match = self.request.headers.get('If-None-Match')
+    if if_none_match is not None:
+      etags = [i.strip() for i in if_none_match.split(',')]
+      not_modified = etag in etags or '*' in etags
+    else:
+      since = util.ParseHTTPDate(self.request.headers.get('If-Modified-Since'))
+      not_modified = (since is not None and last_modified is not None and
+                      last_modified <= since)
+    if not_modified:
+      self.response.set_status(httplib.NOT_MODIFIED)
+      self.SetCacheHeaders(validators, False)
+    return not_modified
+
+  def SetCacheHeaders(self, validators, uncacheable):
+    """Sets the Cache-Control, ETag and Last-Modified headers of served KML.
+
+    Args:
+      validators: The validators returned by GetKMLValidators(), or None.
+      uncacheable: Whether the KML belongs to an uncacheable layer, in which
+          case clients are told not to cache it, and no validators are sent.
+    """
+    if uncacheable:
+      self.response.headers['Cache-Control'] = 'no-cache'
+    else:
+      self.response.headers['Cache-Control'] = (
+          'public, max-age=%d' % settings.KML_MAX_AGE)
+      if validators:
+        etag, last_modified = validators
+        self.response.headers['ETag'] = etag
+        if last_modified is not None:
+          self.response.headers['Last-Modified'] = util.FormatHTTPDate(
+              last_modified)
+
+  def GetMemcachedKML(self, kind, object_id, validators=None, layer_id=None):
+    """Serves a Layer or Division KML from memcache if it is there.
+
+    Args:
+      kind: The kind of the object whose KML to serve; "Layer" or "Division".
+      object_id: The ID under which the layer or division KML is memcached.
+          See model.GetMemcachedKML().
+      validators: The validators returned by GetKMLValidators(), or None.
+      layer_id: If specified, the ID of the layer, as a string, to which the
+          served object must belong for its KML to be served from memcache.
+
+    Returns:
+      Whether the KML was found in memcache and served.
+    """
+    if layer_id is not None: layer_id = int(layer_id)
+    cached = model.GetMemcachedKML(kind, object_id, layer_id)
+    if cached:
+      data, compressed = cached
+      # Only KML of cacheable layers is ever memcached.
+      self.SetCacheHeaders(validators, False)
+      if compressed:
+        self.response.headers['Content-Type'] = settings.KMZ_MIME_TYPE
+      else:
+        self.response.headers['Content-Type'] = settings.KML_MIME_TYPE
+      self.response.out.write(data)
+      return True
+    else:
+      return False
+
+  def GetKML(self, layer_or_division, compressed, pretty, generation=None,
+             validators=None):
     """Serves a raw Layer or Division KML with the proper content type.
 
+    Unless pretty formatting is requested, the KML is written out piece by
+    piece as it is generated (and compressed), rather than being built up as a
+    single string first. Compressed KML is served from the KMZ archive cached
+    by the layer or division whenever possible. The objects whose cached KML
+    was filled along the way are saved in batches once the KML is written out.
+
     Args:
       layer_or_division: The Layer or Division whose KML is to be generated.
       compressed: Whether the resulting KML should be zipped.
       pretty: Whether the resulting KML should be formatted for readability by
           humans. If specified, overrides compressed.
+      generation: The generation of the layer's memcached KML, read before the
+          layer or division was loaded. If specified, the served KML is stored
+          in memcache under this generation, unless the layer is uncacheable.
+      validators: The validators returned by GetKMLValidators() before the
+          layer or division was loaded, or None. Ignored for pretty KML.
     """
     self.response.headers['Content-Type'] = settings.KML_MIME_TYPE
     cache = collections.defaultdict(dict)
-    kml = layer_or_division.GenerateKML(cache).encode('utf8')
     if pretty:
+      kml = layer_or_division.GenerateKML(cache).encode('utf8')
+      model.FlushCacheFills(cache)
       try:
         pretty_kml = xml.dom.minidom.parseString(kml).toprettyxml()
       except Exception, e:
         raise util.BadRequest('Could not format XML: ' + str(e))
       kml = re.sub(r'\n\s*\n', '\n', re.sub(r'\t', '  ', pretty_kml))
+      self.response.out.write(kml)
+    else:
+      if compressed:
+        self.response.headers['Content-Type'] = settings.KMZ_MIME_TYPE
+        chunks = layer_or_division.IterKMZ(cache)
+      else:
+        chunks = layer_or_division.IterKML(cache)
+
+      if isinstance(layer_or_division, model.Division):
+        layer = layer_or_division.layer
+        memcache_id = _GetMemcacheId(layer.key().id(),
+                                     layer_or_division.GetServedId())
+      else:
+        layer = layer_or_division
+        memcache_id = layer.key().id()
+      self.SetCacheHeaders(validators, layer.uncacheable)
+      store = generation is not None and not layer.uncacheable
+
+      stored_chunks = []
+      for chunk in chunks:
+        if store: stored_chunks.append(chunk)
+        self.response.out.write(chunk)
+      model.FlushCacheFills(cache)
+
+      if store:
+        model.SetMemcachedKML(
+            layer_or_division.kind(), memcache_id, layer.key().id(),
+            generation, ''.join(stored_chunks), compressed)
+
 
-    if compressed and not pretty:
+class ViewServer(DumpServer):
+  """A handler to serve the KML of the entities of a layer in a viewport."""
+
+  def get(self, layer_id):  # pylint: disable-msg=C6409
+    """Publicly serves the entities of a layer with a dynamic viewport.
+
+    The viewport is snapped outwards to a grid (see _SnapViewport()) and the
+    KML of the snapped viewport is looked up in memcache before anything is
+    loaded from the datastore, and stored there after being generated. Like
+    division KML, it is invalidated whenever anything in the layer changes,
+    and served with the same validators.
+
+    GET Args:
+      BBOX: The viewport, as "west,south,east,north" in degrees, the way Earth
+          fills in the viewFormat of the link from the layer document. West is
+          greater than east for viewports that cross the 180th meridian.
+      compress: If set to "no", disables any KMZ compression that might
+          otherwise have occurred.
+
+    Args:
+      layer_id: The ID of the layer whose entities to serve, as a string.
+    """
+    no_compress = self.request.get('compress', None) == 'no'
+    try:
+      viewport = _SnapViewport(*_ParseViewport(self.request.get('BBOX')))
+      memcache_id = '%d:%s' % (int(layer_id), ','.join(map(str, viewport)))
+      validators = self.GetKMLValidators(layer_id, no_compress, False)
+      if self.IsNotModified(validators):
+        return
+      if not no_compress and self.GetMemcachedKML('View', memcache_id,
+                                                  validators, layer_id):
+        return
+      generation = None
+      if not no_compress: generation = model.GetKMLGeneration(int(layer_id))
+      layer = util.GetInstance(model.Layer, layer_id)
+      if not (layer.auto_managed and layer.dynamic_viewport):
+        raise util.BadRequest('This layer is not served by viewport.')
+      compress = layer.compressed and not no_compress
+      self.GetViewKML(layer, viewport, compress, generation, validators,
+                      memcache_id)
+    except util.BadRequest, e:
+      self.error(httplib.BAD_REQUEST)
+      self.response.out.write(str(e))
+
+  def GetViewKML(self, layer, viewport, compressed, generation=None,
+                 validators=None, memcache_id=None):
+    """Serves the KML of a viewport of a layer with the proper content type.
+
+    Args:
+      layer: The layer whose entities to serve.
+      viewport: A (west, south, east, north) tuple of the viewport.
+      compressed: Whether the resulting KML should be zipped.
+      generation: The generation of the layer's memcached KML, read before the
+          layer was loaded. If specified, the served KML is stored in memcache
+          under memcache_id and this generation, unless the layer is
+          uncacheable.
+      validators: The validators returned by GetKMLValidators() before the
+          layer was loaded, or None.
+      memcache_id: The ID under which to store the KML in memcache.
+    """
+    if compressed:
       self.response.headers['Content-Type'] = settings.KMZ_MIME_TYPE
-      zipper = zipfile.ZipFile(self.response.out, 'w', zipfile.ZIP_DEFLATED)
-      info = zipfile.ZipInfo('doc.kml')
-      info.compress_type = zipfile.ZIP_DEFLATED
-      info.external_attr = 0644 << 16  # Owner read/write, group/others read.
-      zipper.writestr(info, kml)
-      zipper.close()
     else:
-      self.response.out.write(kml)
+      self.response.headers['Content-Type'] = settings.KML_MIME_TYPE
+    self.SetCacheHeaders(validators, layer.uncacheable)
+    store = generation is not None and not layer.uncacheable
+
+    cache = collections.defaultdict(dict)
+    west, south, east, north = viewport
+    stored_chunks = []
+    for chunk in layer.IterViewKML(north, south, east, west, compressed,
+                                   cache):
+      if store: stored_chunks.append(chunk)
+      self.response.out.write(chunk)
+    model.FlushCacheFills(cache)
+
+    if store:
+      model.SetMemcachedKML('View', memcache_id, layer.key().id(), generation,
+                            ''.join(stored_chunks), compressed)
+
+
+class MemcacheStatsHandler(webapp.RequestHandler):
+  """An admin-only handler reporting how well served KML is memcached."""
+
+  def get(self):  # pylint: disable-msg=C6409
+    """Writes out the KML memcache counters and global memcache statistics.
+
+    The response is a JSON object with the hits and misses of memcached layer
+    and division KML lookups, and the statistics returned by
+    memcache.get_stats() under "memcache".
+    """
+    stats = model.GetMemcachedKMLStats()
+    stats['memcache'] = memcache.get_stats()
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(json.dumps(stats))
+
+
+def _GetDivisionByPath(layer_id, path):
+  """Gets a served division of a layer given its quad path.
+
+  Args:
+    layer_id: The ID of the layer, as a string.
+    path: The quad path of the division.
+
+  Returns:
+    The division, with its layer already loaded.
+
+  Raises:
+    BadRequest: If the layer or the division does not exist.
+  """
+  layer = util.GetInstance(model.Layer, layer_id)
+  division = layer.GetDivision(path)
+  if not division:
+    raise util.BadRequest('Invalid division specified.')
+  # Saves loading the layer again through the reference.
+  division.layer = layer
+  return division
+
+
+def _ParseViewport(bbox):
+  """Parses the bounding box of a viewport.
+
+  Args:
+    bbox: The bounding box, as "west,south,east,north" in degrees.
+
+  Returns:
+    A (west, south, east, north) tuple of floats.
+
+  Raises:
+    BadRequest: If the bounding box is missing or invalid.
+  """
+  try:
+    west, south, east, north = [float(i) for i in bbox.split(',')]
+  except (AttributeError, ValueError):
+    raise util.BadRequest('Invalid bounding box specified.')
+  if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and
+          -180 <= east <= 180):
+    raise util.BadRequest('Invalid bounding box specified.')
+  return west, south, east, north
+
+
+def _SnapViewport(west, south, east, north):
+  """Snaps a viewport outwards to a grid.
+
+  The grid step is the smallest power of two degrees that divides the longer
+  side of the viewport into at most settings.VIEW_GRID_STEPS steps, so that
+  nearby viewports at about the same zoom snap to the same one.
+
+  Args:
+    west: The minimum longitude of the viewport. If greater than east, the
+        viewport crosses the 180th meridian.
+    south: The minimum latitude of the viewport.
+    east: The maximum longitude of the viewport.
+    north: The maximum latitude of the viewport.
+
+  Returns:
+    A (west, south, east, north) tuple of the snapped viewport. Viewports that
+    cross the 180th meridian and would cover the whole world once snapped span
+    from -180 to 180 instead.
+  """
+  width = east - west
+  if width < 0: width += 360
+  size = float(max(north - south, width)) / settings.VIEW_GRID_STEPS
+  step = 2.0 ** math.ceil(math.log(max(size, 1e-6), 2))
+  crosses = west > east
+  west = max(-180.0, math.floor(west / step) * step)
+  south = max(-90.0, math.floor(south / step) * step)
+  east = min(180.0, math.ceil(east / step) * step)
+  north = min(90.0, math.ceil(north / step) * step)
+  if crosses and west <= east:
+    west, east = -180.0, 180.0
+  return west, south, east, north
+
+
+def _GetMemcacheId(layer_id, object_id):
+  """Returns the ID under which the KML of a division is memcached.
+
+  Quad paths are only unique within a layer, so divisions served by quad path
+  are memcached under the ID of their layer followed by the path.
+
+  Args:
+    layer_id: The ID of the layer of the division, as a string or an integer.
+    object_id: The quad path or the numeric ID of the division, as a string.
+
+  Returns:
+    The ID to pass to model.GetMemcachedKML() and model.SetMemcachedKML().
+  """
+  if object_id.startswith(model.Division.ROOT_PATH):
+    return '%d:%s' % (int(layer_id), object_id)
+  else:
+    return int(object_id)
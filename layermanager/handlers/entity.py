@@ -18,13 +18,21 @@
 
 import copy
 import datetime
+import logging
 from django.utils import simplejson as json
 from google.appengine import runtime
+from google.appengine.api.labs import taskqueue
 from google.appengine.ext import db
+from google.appengine.runtime import apiproxy_errors
 import handlers.base
 import model
 import util
 
+# The number of entities created by a bulk request whose geocell counts are
+# updated together. Counting as the request goes bounds how many of the
+# entities created go uncounted if it is cut short.
+_COUNT_BATCH_SIZE = 50
+
 
 class EntityHandler(handlers.base.PageHandler):
   """A form to query, create, update and delete entities."""
@@ -122,7 +130,9 @@ class EntityHandler(handlers.base.PageHandler):
       layer.ClearCache()
       entity_id = db.run_in_transaction(_CreateEntityAndGeometry,
                                         layer, fields, geometries)
-      model.Entity.get_by_id(entity_id).GenerateKML()  # Build cache.
+      entity = model.Entity.get_by_id(entity_id)
+      model.UpdateGeocellCounts(layer, [entity])
+      entity.GenerateKML()  # Build cache.
     except db.BadValueError, e:
       raise util.BadRequest(str(e))
     else:
@@ -150,6 +160,7 @@ class EntityHandler(handlers.base.PageHandler):
       raise util.BadRequest('Invalid JSON syntax in entities specification.')
 
     created_entity_ids = []
+    counted = 0
     error = ''
     try:
       layer.ClearCache()
@@ -162,9 +173,19 @@ class EntityHandler(handlers.base.PageHandler):
         except (db.BadValueError, TypeError, ValueError, util.BadRequest), e:
           error = str(e)
           break
+        if len(created_entity_ids) - counted == _COUNT_BATCH_SIZE:
+          _CountCreatedEntities(layer, created_entity_ids[counted:])
+          counted = len(created_entity_ids)
+      _CountCreatedEntities(layer, created_entity_ids[counted:])
     except runtime.DeadlineExceededError:
-      # We still want to write out the entity IDs.
+      # We still want to write out the entity IDs, and to count the entities
+      # reported as created.
       error = 'Ran out of time.'
+      try:
+        _CountCreatedEntities(layer, created_entity_ids[counted:])
+      except (db.Error, apiproxy_errors.Error), e:
+        logging.warning('Could not count %d created entities: %s',
+                        len(created_entity_ids) - counted, e)
 
     self.response.out.write(','.join(str(i) for i in created_entity_ids))
     self.response.out.write('\n')
@@ -194,9 +215,16 @@ class EntityHandler(handlers.base.PageHandler):
                      entity.template.schema.key()))
     try:
       entity.ClearCache()
+      if entity.baked:
+        # The entity may have moved, so it is placed again by the next
+        # incremental bake.
+        fields['baked'] = None
       db.run_in_transaction(_UpdateEntityAndGeometry,
                             int(entity_id), fields, geometries, clear_fields)
-      model.Entity.get_by_id(int(entity_id)).GenerateKML()  # Rebuild cache.
+      if entity.baked: entity.RemoveFromDivisions()
+      updated_entity = model.Entity.get_by_id(int(entity_id))
+      model.UpdateGeocellCounts(layer, [updated_entity], [entity])
+      updated_entity.GenerateKML()  # Rebuild cache.
     except db.BadValueError, e:
       raise util.BadRequest(str(e))
 
@@ -213,6 +241,8 @@ class EntityHandler(handlers.base.PageHandler):
     entity = util.GetInstance(model.Entity, entity_id, layer)
     layer.ClearCache()
     entity.SafeDelete()
+    model.UpdateGeocellCounts(layer, removed=[entity])
+    if entity.baked: entity.RemoveFromDivisions()
 
 
 def _CreateEntityAndGeometry(layer, fields, geometries):
@@ -240,6 +270,17 @@ def _CreateEntityAndGeometry(layer, fields, geometries):
   return entity.key().id()
 
 
+def _CountCreatedEntities(layer, entity_ids):
+  """Adds newly created entities to the geocell counts of their layer.
+
+  Args:
+    layer: The layer of the entities.
+    entity_ids: The IDs of the entities. May be empty.
+  """
+  if entity_ids:
+    model.UpdateGeocellCounts(layer, model.Entity.get_by_id(entity_ids))
+
+
 def _UpdateEntityAndGeometry(entity_id, fields, geometries, clear_fields):
   """Updates the entity and swaps geometries if new ones are specifeid.
 
@@ -580,6 +621,57 @@ class EntityBalloonHandler(handlers.base.PageHandler):
     self.response.out.write(content)
 
 
+class GeometryMigrationHandler(handlers.base.PageHandler):
+  """A queue handler to rewrite geometries in the current storage format.
+
+  Line strings and polygons written before settings.PACK_GEOMETRY_COORDINATES
+  was enabled keep their coordinates as lists of individual values until they
+  are saved again. Posting a task to /entity-continue-migrate/0 re-saves all of
+  them, continuing in new tasks for as long as necessary.
+  """
+
+  PERMISSION_REQUIRED = None
+  REQUIRES_LAYER = False
+  # The geometry classes whose storage format depends on the setting.
+  MIGRATED_MODELS = (model.LineString, model.Polygon)
+  # The number of geometries to load and save at once.
+  BATCH_SIZE = 100
+
+  def Migrate(self, unused_layer):
+    """Re-saves line strings and polygons, one batch at a time.
+
+    POST Args:
+      model: The name of the geometry class currently being migrated.
+          Optional; defaults to the first class in MIGRATED_MODELS.
+      cursor: The query cursor at which to continue. Optional.
+    """
+    names = [i.class_name() for i in self.MIGRATED_MODELS]
+    model_name = self.request.get('model') or names[0]
+    if model_name not in names:
+      raise util.BadRequest('Invalid geometry class specified.')
+    cursor = self.request.get('cursor') or None
+
+    for model_class in self.MIGRATED_MODELS[names.index(model_name):]:
+      query = model_class.all()
+      if cursor: query.with_cursor(cursor)
+      try:
+        while True:
+          geometries = query.fetch(self.BATCH_SIZE)
+          if not geometries: break
+          db.put(geometries)
+          cursor = query.cursor()
+          query.with_cursor(cursor)
+      except (runtime.DeadlineExceededError, db.Error,
+              apiproxy_errors.OverQuotaError):
+        # Schedule continuation.
+        taskqueue.add(url='/entity-continue-migrate/0', params={
+            'model': model_class.class_name(),
+            'cursor': cursor or ''
+        })
+        return
+      cursor = None
+
+
 def _GetGeometriesDescription(entity):
   """Returns a JSON representation of an entity's geometries."""
   geometries = []
@@ -587,6 +679,9 @@ def _GetGeometriesDescription(entity):
   def FormatGeometryField(value):
     if isinstance(value, db.GeoPt):
       return [value.lat, value.lon]
+    elif isinstance(value, util.CoordinateArray):
+      return [list(i) for i in zip(value.GetLatitudes(),
+                                   value.GetLongitudes())]
     elif isinstance(value, list):
       return [FormatGeometryField(i) for i in value]
     elif isinstance(value, db.Model):
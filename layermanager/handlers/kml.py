@@ -50,7 +50,8 @@ class KMLHandler(handlers.base.PageHandler):
       layer: The layer whose KMLs and resources are to be dumped.
     """
     if not layer: raise util.BadRequest('No valid layer specified.')
-    if layer.auto_managed and not layer.baked:
+    if (layer.auto_managed and not layer.baked and
+        not layer.dynamic_viewport):
       raise util.BadRequest('This auto-managed layer has not been baked yet.')
 
     self.response.headers['Content-Type'] = 'text/plain'
@@ -80,14 +81,21 @@ def _GetKMLURLsList(layer, limit=None):
   urls = []
   url = util.GetURL('/serve/%d/root.%s' % (layer.key().id(), extension))
   urls.append(url)
-  if layer.auto_managed:
-    root_division = model.Division.all(keys_only=True).filter('layer', layer)
-    root_division = root_division.filter('parent_division', None).get()
+  # The view KML of layers with a dynamic viewport depends on the viewport.
+  if layer.auto_managed and not layer.dynamic_viewport:
+    root_division = layer.GetRootDivision()
+    root_division = root_division and root_division.key()
     division_keys = model.Division.all(keys_only=True).filter('layer', layer)
+    # Divisions created before divisions had generations lack the property.
+    if layer.division_generation is not None:
+      division_keys.filter('generation', layer.division_generation)
     if limit:
       division_keys = division_keys.fetch(limit)
     for division_key in division_keys:
       if division_key != root_division:
-        url = util.GetURL('/serve/0/k%d.%s' % (division_key.id(), extension))
+        served_id = (model.Division.GetPathFromKey(division_key) or
+                     division_key.id())
+        url = util.GetURL('/serve/%d/k%s.%s' % (layer.key().id(), served_id,
+                                                 extension))
         urls.append(url)
   return urls
@@ -23,6 +23,7 @@ from google.appengine.api.labs import taskqueue
 from google.appengine.ext import db
 from google.appengine.runtime import apiproxy_errors
 import handlers.base
+import handlers.baker
 import model
 import util
 
@@ -85,6 +86,9 @@ class LayerHandler(handlers.base.PageHandler):
           forms.
       dynamic_balloons: A flag indicating whether entities in this layer have
           their balloon contents served dynamically.
+      dynamic_viewport: A flag indicating whether the entities in this layer
+          are served by viewport instead of through baked divisions. Has no
+          effect on non-auto-managed layers.
       division_size: A soft bound on the maximum number of entities in a single
           division. Leaf divisions may have up to 1.5 time this number. Set but
           has no effect on non-auto-managed layers.
@@ -100,16 +104,25 @@ class LayerHandler(handlers.base.PageHandler):
       division_lod_max_fade: The distance over which the geometry fades, from
           fully transparent to fully opaque. Has no effect on non-auto-managed
           layers.
+      division_split: How the region of a full division is split among its
+          children. One of the keys of model.Layer.DIVISION_SPLITS. Optional.
+          Has no effect on non-auto-managed layers.
+      division_clusters: If non-empty, divisions with children also show
+          cluster placemarks for the entities in their region. Has no effect
+          on non-auto-managed layers.
     """
 
     def CreateLayerWithPermissions():
       """Creates a layer with full permissions for the current user."""
       dynamic_balloons = bool(self.request.get('dynamic_balloons'))
+      dynamic_viewport = bool(self.request.get('dynamic_viewport'))
       division_size = self.GetArgument('division_size', int)
       division_lod_min = self.GetArgument('division_lod_min', int)
       division_lod_min_fade = self.GetArgument('division_lod_min_fade', int)
       division_lod_max = self.GetArgument('division_lod_max', int)
       division_lod_max_fade = self.GetArgument('division_lod_max_fade', int)
+      division_split = self.request.get('division_split', None) or None
+      division_clusters = bool(self.request.get('division_clusters'))
       if self.request.get('compressed', None) is None:
         compressed = True
       else:
@@ -124,11 +137,14 @@ class LayerHandler(handlers.base.PageHandler):
                           auto_managed=bool(self.request.get('auto_managed')),
                           compressed=compressed,
                           dynamic_balloons=dynamic_balloons,
+                          dynamic_viewport=dynamic_viewport,
                           division_size=division_size,
                           division_lod_min=division_lod_min,
                           division_lod_min_fade=division_lod_min_fade,
                           division_lod_max=division_lod_max,
-                          division_lod_max_fade=division_lod_max_fade)
+                          division_lod_max_fade=division_lod_max_fade,
+                          division_split=division_split,
+                          division_clusters=division_clusters)
       layer.put()
       user = users.get_current_user()
       for permission_type in model.Permission.TYPES:
@@ -156,8 +172,10 @@ class LayerHandler(handlers.base.PageHandler):
     """
     if not layer: raise util.BadRequest('Layer required.')
 
+    old_settings = layer.GetFragmentSettings()
     try:
-      for field in ('name', 'description', 'custom_kml', 'world', 'item_type'):
+      for field in ('name', 'description', 'custom_kml', 'world', 'item_type',
+                    'division_split'):
         value = self.request.get(field, None)
         if value == '':  # pylint: disable-msg=C6403
           setattr(layer, field, None)
@@ -174,7 +192,8 @@ class LayerHandler(handlers.base.PageHandler):
         else:
           layer.icon = icon
 
-      bools = ('auto_managed', 'dynamic_balloons', 'compressed', 'uncacheable')
+      bools = ('auto_managed', 'dynamic_balloons', 'dynamic_viewport',
+               'compressed', 'uncacheable', 'division_clusters')
       for arg in bools:
         value = self.request.get(arg, None)
         if value:
@@ -190,7 +209,10 @@ class LayerHandler(handlers.base.PageHandler):
         elif value is not None:
           setattr(layer, arg, int(value))
 
-      layer.ClearCache()
+      if layer.GetFragmentSettings() != old_settings:
+        layer.ClearSettingsCache()
+      else:
+        layer.ClearCache()
       layer.put()
     except (db.BadValueError, TypeError, ValueError), e:
       raise util.BadRequest(str(e))
@@ -222,10 +244,13 @@ class LayerQueueHandler(handlers.base.PageHandler):
       self._DeleteAllInQuery(layer.region_set)
       self._DeleteAllInQuery(layer.schema_set, model.Schema.SafeDelete)
       self._DeleteAllInQuery(layer.entity_set, model.Entity.SafeDelete)
+      self._DeleteAllInQuery(layer.geocellcount_set)
       for resource in layer.resource_set:
         if resource.blob:
           resource.blob.delete()
+        resource.DeleteThumbnails()
         resource.delete()
+      handlers.baker.DeleteBakeRecords(layer)
       layer.SafeDelete()
     except (runtime.DeadlineExceededError, db.Error,
             apiproxy_errors.OverQuotaError):
@@ -245,6 +245,7 @@ class ResourceHandler(blobstore_handlers.BlobstoreUploadHandler,
       raise util.BadRequest('A reference to this resource was found.')
     # NOTE: May leave an inaccessible orphan blob if delete fails.
     blob = resource.blob
+    resource.DeleteThumbnails()
     resource.delete()
     if blob: blob.delete()
 
@@ -297,6 +298,7 @@ class ResourceHandler(blobstore_handlers.BlobstoreUploadHandler,
     else:
       raise util.BadRequest('Neither URL nor file specified.')
     resource.put()
+    if blob: _PregenerateThumbnails(resource)
     return resource.key().id()
 
   @staticmethod
@@ -329,6 +331,22 @@ def _IsImage(blob):
   return True
 
 
+def _PregenerateThumbnails(resource):
+  """Generates the thumbnails of a new resource that the editor will request.
+
+  The sizes are taken from settings.PREGENERATED_THUMBNAIL_SIZES. Failures are
+  ignored; the thumbnails are then generated when first requested.
+
+  Args:
+    resource: The newly created Resource.
+  """
+  for size in settings.PREGENERATED_THUMBNAIL_SIZES.get(resource.type, ()):
+    try:
+      resource.GetThumbnail(size)
+    except images.Error:
+      break
+
+
 def _TryGetImageSize(blob):
   """Attempts to find the width and height of an image stored in blobstore.
 
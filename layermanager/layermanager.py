@@ -35,7 +35,7 @@ HANDLER_MAP = {
     r'/earth':
       base.MakeStaticHandler('earth'),
     # Dynamic handlers.
-    r'/(baker)-(form|create)/(\d+)':
+    r'/(baker)-(form|create|status)/(\d+)':
       baker.Baker,
     r'/(baker)-(update)/(\d+)':
       baker.BakerApprentice,
@@ -43,6 +43,8 @@ HANDLER_MAP = {
       entity.EntityHandler,
     r'/(balloon)-(raw)/(\d+)':
       entity.EntityBalloonHandler,
+    r'/(entity-continue)-(migrate)/(\d+)':
+      entity.GeometryMigrationHandler,
     r'/(field)-(form|raw|list|create|delete)/(\d+)':
       schema.FieldHandler,
     r'/(field-continue)-(delete)/(\d+)?':
@@ -76,11 +78,17 @@ HANDLER_MAP = {
     # Admin-only global permissions editing page. Protected via app.yaml.
     r'/acl':
       acl.ACLHandler,
+    # Admin-only KML memcache statistics. Protected via app.yaml.
+    r'/memcache-stats':
+      dump.MemcacheStatsHandler,
     # Resource and KML servers. Not using base.BasePageHandler (therefore
     # unprotected). Allows an arbitrary dummy extension to be appended to the
-    # URL.
-    r'/serve/(\d+)/(?:([kr])(\d+)|root)(?:\.\w+)?':
-      dump.DumpServer
+    # URL. Divisions are served either by numeric ID or by quad path.
+    r'/serve/(\d+)/(?:([kr])(\d+|r[\d-]*)|root)(?:\.\w+)?':
+      dump.DumpServer,
+    # The entities of layers with a dynamic viewport, by bounding box.
+    r'/serve/(\d+)/view(?:\.\w+)?':
+      dump.ViewServer
 }
 
 
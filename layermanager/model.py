@@ -17,17 +17,27 @@
 """The model definitions for data objects and their KML serializers."""
 
 
+import collections
 import datetime
+import hashlib
 import itertools
+import logging
 import operator
 import os
+import random
 import re
 import time
+from google.appengine.api import images
+from google.appengine.api import memcache
 from google.appengine.ext import blobstore
 from google.appengine.ext import db
 from google.appengine.ext.db import polymodel
 from google.appengine.ext.webapp import template
+from google.appengine.runtime import apiproxy_errors
+from lib.geo import geocell
 from lib.geo import geomodel
+from lib.geo import geotypes
+import settings
 import util
 
 
@@ -43,6 +53,33 @@ _ALTITUDE_MODES = ['clampToGround', 'relativeToGround', 'absolute']
 # it is generated from static files.
 _kml_template_cache = {}
 
+# The maximum number of keys to pass to a single batch datastore get.
+_MAX_BATCH_SIZE = 1000
+# The maximum number of models to pass to a single batch datastore put.
+_MAX_PUT_BATCH_SIZE = 500
+
+# The reference properties that PrefetchReferences() resolves in bulk.
+_PREFETCHED_REFERENCES = ('layer', 'style', 'region', 'template')
+
+# A comment used to mark where the styles and contents of a document go when
+# rendering layer.kml piece by piece in _IterDocumentKML().
+_DOCUMENT_CONTENTS_PLACEHOLDER = u'<!--KML_LAYER_MANAGER_CONTENTS-->'
+
+# Memcache key formats for served KML documents. The generation key holds the
+# current generation of a layer's documents, the header key describes the
+# latest stored copy of a layer or division document, and its chunks are kept
+# under keys that include the generation they belong to.
+_MEMCACHE_GENERATION_KEY = 'kml-generation:%d'
+_MEMCACHE_MODIFIED_KEY = 'kml-modified:%d:%d'
+_MEMCACHE_HEADER_KEY = 'kml:%s:%s'
+_MEMCACHE_CHUNK_KEY = 'kml:%s:%s:%d:%d'
+# Memcache keys of the hit and miss counters of GetMemcachedKML().
+_MEMCACHE_HITS_KEY = 'kml-stats:hits'
+_MEMCACHE_MISSES_KEY = 'kml-stats:misses'
+# Memcache key format for the KMZ archive of a layer's or division's cached
+# KML, by the key of the owner.
+_MEMCACHE_KMZ_KEY = 'kmz:%s'
+
 
 class KMLGenerationError(RuntimeError):
   """An exception thrown when an error occurs during KML generation."""
@@ -71,6 +108,90 @@ def _ValidateKMLColor(color):
     raise db.BadValueError('Invalid KML color; must be in the AABBGGRR format.')
 
 
+class PackedGeoPtListProperty(db.Property):
+  """A list of db.GeoPt values that can be stored as a single blob.
+
+  The value of the property is a util.CoordinateArray; lists of db.GeoPt
+  objects are converted on assignment. If settings.PACK_GEOMETRY_COORDINATES is
+  true, the coordinates are written as one unindexed blob of little-endian
+  doubles. Otherwise they are written like db.ListProperty(db.GeoPt) would
+  write them. Both formats are accepted when reading.
+  """
+
+  data_type = util.CoordinateArray
+
+  def default_value(self):
+    """Returns an empty coordinate array."""
+    return util.CoordinateArray()
+
+  def empty(self, value):
+    """Like db.ListProperty, only treats None as empty, not an empty list."""
+    return value is None
+
+  def validate(self, value):
+    """Converts lists of db.GeoPt objects into a util.CoordinateArray."""
+    if value is not None and not isinstance(value, util.CoordinateArray):
+      if not isinstance(value, (list, tuple)):
+        raise db.BadValueError('Property %s must be a list.' % self.name)
+      for point in value:
+        if not isinstance(point, db.GeoPt):
+          raise db.BadValueError(
+              'Items in the %s list must all be GeoPt instances.' % self.name)
+      value = util.CoordinateArray.FromPoints(value)
+    value = super(PackedGeoPtListProperty, self).validate(value)
+    if value is None: value = util.CoordinateArray()
+    return value
+
+  def get_value_for_datastore(self, model_instance):
+    """Returns the blob or the list of points to store."""
+    value = super(PackedGeoPtListProperty, self).get_value_for_datastore(
+        model_instance)
+    if settings.PACK_GEOMETRY_COORDINATES:
+      return value and db.Blob(value.ToBlob()) or None
+    else:
+      return list(value)
+
+  def make_value_from_datastore(self, value):
+    """Converts a stored blob or list of points into a util.CoordinateArray."""
+    if value is None:
+      return util.CoordinateArray()
+    elif isinstance(value, list):
+      return util.CoordinateArray.FromPoints(value)
+    else:
+      return util.CoordinateArray.FromBlob(value)
+
+
+class PackedFloatListProperty(db.ListProperty):
+  """A list of floats that can be stored as a single blob.
+
+  Behaves exactly like db.ListProperty(float), except that the values are
+  written as one unindexed blob of little-endian doubles if
+  settings.PACK_GEOMETRY_COORDINATES is true. Both formats are accepted when
+  reading.
+  """
+
+  def __init__(self, **kwds):
+    super(PackedFloatListProperty, self).__init__(float, **kwds)
+
+  def get_value_for_datastore(self, model_instance):
+    """Returns the blob or the list of floats to store."""
+    value = super(PackedFloatListProperty, self).get_value_for_datastore(
+        model_instance)
+    if settings.PACK_GEOMETRY_COORDINATES:
+      return value and db.Blob(util.PackDoubles(value)) or None
+    else:
+      return value
+
+  def make_value_from_datastore(self, value):
+    """Converts a stored blob or list of floats into a list of floats."""
+    if value is None:
+      return []
+    elif isinstance(value, list):
+      return value
+    else:
+      return util.UnpackDoubles(value).tolist()
+
+
 def _RenderKMLTemplate(filename, args):
   """Renders the specified templates with custom KML filters auto-registered."""
   if filename not in _kml_template_cache:
@@ -80,6 +201,325 @@ def _RenderKMLTemplate(filename, args):
   return _kml_template_cache[filename].render(template.Context(args))
 
 
+def _IterDocumentKML(container, styles, contents, description=None):
+  """Renders layer.kml one piece at a time.
+
+  The template is evaluated with a placeholder in place of the styles and
+  contents, and the parts before and after it are yielded around the
+  fragments, so the whole document never has to be held in one string.
+
+  The fragments are passed through as they are, apart from stripping their
+  surrounding whitespace. Each of them comes out of its own {% spaceless %}
+  template, so running the whitespace removal again over the whole document
+  would only cost time proportional to its size without changing anything
+  but user-supplied text such as descriptions.
+
+  Args:
+    container: The Layer or Division to pass to the template as "layer".
+    styles: An iterable of <Style> KML fragments.
+    contents: An iterable of Feature KML fragments.
+    description: The evaluated description of the container, if any.
+
+  Yields:
+    Unicode strings which, when concatenated, form a KML document.
+  """
+  args = {
+      'layer': container,
+      'styles': [],
+      'contents': [_DOCUMENT_CONTENTS_PLACEHOLDER],
+      'description': description
+  }
+  document = ForceIntoUnicode(_RenderKMLTemplate('layer.kml', args))
+  header, footer = document.split(_DOCUMENT_CONTENTS_PLACEHOLDER)
+  yield header
+  for fragment in itertools.chain(styles, contents):
+    yield ForceIntoUnicode(fragment).strip()
+  yield footer
+
+
+def _IterKMZ(chunks):
+  """Compresses a KML document into a KMZ archive, one piece at a time.
+
+  Args:
+    chunks: An iterable of UTF-8 encoded strings that make up the document.
+
+  Yields:
+    Strings that make up the KMZ archive when concatenated, as soon as the
+    compressor produces them.
+  """
+  output = util.ChunkBuffer()
+  zipper = util.KMZWriter(output, 'doc.kml')
+  for chunk in chunks:
+    zipper.write(chunk)
+    data = output.Drain()
+    if data: yield data
+  zipper.close()
+  yield output.Drain()
+
+
+def _IterStoredDocument(pieces, compressed, store=None):
+  """Encodes and optionally compresses a freshly generated document.
+
+  Args:
+    pieces: An iterable of Unicode strings that make up the KML document.
+    compressed: Whether to yield a KMZ archive rather than the KML itself.
+    store: A function to call with the complete KML text and the KMZ archive
+        (None unless compressed) after the last piece has been yielded. Pass
+        None if the document should not be kept.
+
+  Yields:
+    Strings that make up the KML document, or the KMZ archive if compressed,
+    when concatenated.
+  """
+  kml_pieces = []
+  kmz_pieces = []
+
+  def EncodePieces():
+    for piece in pieces:
+      if store: kml_pieces.append(piece)
+      yield piece.encode('utf8')
+
+  if compressed:
+    for data in _IterKMZ(EncodePieces()):
+      if store: kmz_pieces.append(data)
+      yield data
+  else:
+    for data in EncodePieces():
+      yield data
+
+  if store:
+    store(u''.join(kml_pieces), compressed and ''.join(kmz_pieces) or None)
+
+
+def _GetCachedKMZ(instance):
+  """Looks up the KMZ archive of an object's cached KML in memcache.
+
+  Args:
+    instance: A Layer or Division with a valid cached_kml.
+
+  Returns:
+    The archive, as a string, or None if it is not in memcache or was built
+    from a different version of the cached KML.
+  """
+  cached = memcache.get(_MEMCACHE_KMZ_KEY % instance.key())
+  if cached:
+    digest, kmz = cached
+    if digest == _GetKMLDigest(instance.cached_kml):
+      return kmz
+  return None
+
+
+def _SetCachedKMZ(instance, kml, kmz):
+  """Stores the KMZ archive of an object's cached KML in memcache.
+
+  The archive is kept out of the object itself so that it does not add to the
+  size of its entity. It is stored with a digest of the KML it was built from,
+  so that replacing the cached KML is enough to invalidate it.
+
+  Args:
+    instance: The Layer or Division that owns the cached KML.
+    kml: The cached KML, as a Unicode string.
+    kmz: The KMZ archive of kml.
+  """
+  memcache.set(_MEMCACHE_KMZ_KEY % instance.key(), (_GetKMLDigest(kml), kmz))
+
+
+def _GetKMLDigest(kml):
+  """Returns a digest that identifies a version of a cached KML document."""
+  return hashlib.md5(kml.encode('utf8')).digest()
+
+
+def _SaveCacheFill(instance, cache):
+  """Saves an object whose cached KML has just been filled.
+
+  With a cache, the put is deferred until FlushCacheFills() is called on it,
+  so that the objects rendered during a request are saved in a few batches
+  instead of one at a time.
+
+  Args:
+    instance: The model instance to save.
+    cache: The collections.defaultdict used for the current request, or None
+        to save the instance immediately.
+  """
+  if cache is None:
+    instance.put()
+  else:
+    cache['pending_puts'][instance.key()] = instance
+
+
+def FlushCacheFills(cache):
+  """Saves the objects queued by KML generation with batched puts.
+
+  Should be called by whoever created the cache once the KML has been
+  produced. Failed puts are logged and otherwise ignored; the affected objects
+  merely regenerate their cached KML the next time they are rendered.
+
+  Args:
+    cache: The collections.defaultdict passed to the KML generation methods.
+  """
+  instances = cache.pop('pending_puts', {}).values()
+  for start in xrange(0, len(instances), _MAX_PUT_BATCH_SIZE):
+    batch = instances[start:start + _MAX_PUT_BATCH_SIZE]
+    try:
+      db.put(batch)
+    except (db.Error, apiproxy_errors.Error), e:
+      logging.warning('Could not save %d cached KML fragments: %s',
+                      len(batch), e)
+
+
+def _IncrementMemcacheCounter(key):
+  """Increments a counter in memcache, creating it if necessary."""
+  if memcache.incr(key) is None:
+    memcache.add(key, 1)
+
+
+def GetKMLGeneration(layer_id):
+  """Returns the current generation of a layer's memcached KML documents.
+
+  Missing generations are initialized from the clock, so that a number that
+  has been evicted from memcache is never reused for newer documents.
+
+  Args:
+    layer_id: The ID of the layer whose generation to get.
+
+  Returns:
+    An integer generation, or None if memcache is unavailable.
+  """
+  key = _MEMCACHE_GENERATION_KEY % layer_id
+  generation = memcache.get(key)
+  if generation is None:
+    now = time.time()
+    if memcache.add(key, int(now * 1000)):
+      memcache.add(_MEMCACHE_MODIFIED_KEY % (layer_id, int(now * 1000)),
+                   int(now))
+    generation = memcache.get(key)
+  return generation
+
+
+def GetKMLValidators(layer_id):
+  """Returns what HTTP validators of a layer's served KML are derived from.
+
+  Args:
+    layer_id: The ID of the layer whose validators to get.
+
+  Returns:
+    A (generation, last_modified) tuple. The generation is as returned by
+    GetKMLGeneration(). The last_modified time is the number of seconds since
+    the epoch at which the generation started, or None if it is not known.
+  """
+  generation = GetKMLGeneration(layer_id)
+  if generation is None:
+    return None, None
+  else:
+    return generation, memcache.get(_MEMCACHE_MODIFIED_KEY %
+                                    (layer_id, generation))
+
+
+def ClearMemcachedKML(layer_id):
+  """Invalidates all memcached KML documents of a layer and its divisions."""
+  generation = memcache.incr(_MEMCACHE_GENERATION_KEY % layer_id)
+  if generation is not None:
+    memcache.set(_MEMCACHE_MODIFIED_KEY % (layer_id, generation),
+                 int(time.time()))
+
+
+def GetMemcachedKML(kind, object_id, expected_layer_id=None):
+  """Looks up a served KML document in memcache.
+
+  Counts a hit or a miss in the counters returned by GetMemcachedKMLStats().
+
+  Args:
+    kind: The kind of the object whose document to look up; "Layer",
+        "Division" or "View" for the KML of a layer's viewport.
+    object_id: The ID of the layer or division. For divisions served by quad
+        path, the layer ID and the path separated by a colon. For viewports,
+        the layer ID and the bounding box separated by a colon.
+    expected_layer_id: If specified, documents belonging to any other layer are
+        treated as missing.
+
+  Returns:
+    A (data, compressed) tuple with the document and whether it is a KMZ
+    archive, or None if there is no copy of the document's current generation
+    in memcache.
+  """
+  header = memcache.get(_MEMCACHE_HEADER_KEY % (kind, object_id))
+  if header and expected_layer_id in (None, header[0]):
+    layer_id, generation, compressed, chunk_count = header
+    chunk_keys = [_MEMCACHE_CHUNK_KEY % (kind, object_id, generation, i)
+                  for i in xrange(chunk_count)]
+    generation_key = _MEMCACHE_GENERATION_KEY % layer_id
+    values = memcache.get_multi([generation_key] + chunk_keys)
+    if (values.get(generation_key) == generation and
+        len(values) == chunk_count + 1):
+      _IncrementMemcacheCounter(_MEMCACHE_HITS_KEY)
+      return ''.join([values[i] for i in chunk_keys]), compressed
+  _IncrementMemcacheCounter(_MEMCACHE_MISSES_KEY)
+  return None
+
+
+def SetMemcachedKML(kind, object_id, layer_id, generation, data, compressed):
+  """Stores a served KML document in memcache.
+
+  Documents larger than settings.MEMCACHE_CHUNK_SIZE are split into several
+  memcache values. The document is only returned by GetMemcachedKML() while
+  the layer's generation is still the one passed here.
+
+  Args:
+    kind: The kind of the object whose document to store; "Layer",
+        "Division" or "View".
+    object_id: The ID of the layer or division, as for GetMemcachedKML().
+    layer_id: The ID of the layer to which the document belongs.
+    generation: The generation of the layer's documents, as returned by
+        GetKMLGeneration() before the document was generated.
+    data: The document, as a string.
+    compressed: Whether the document is a KMZ archive.
+  """
+  if generation is None: return
+  size = settings.MEMCACHE_CHUNK_SIZE
+  chunks = {}
+  for index, start in enumerate(xrange(0, len(data), size)):
+    key = _MEMCACHE_CHUNK_KEY % (kind, object_id, generation, index)
+    chunks[key] = data[start:start + size]
+  if not memcache.set_multi(chunks):
+    header = (layer_id, generation, compressed, len(chunks))
+    memcache.set(_MEMCACHE_HEADER_KEY % (kind, object_id), header)
+
+
+def GetMemcachedKMLStats():
+  """Returns the hit and miss counts of GetMemcachedKML() as a dictionary."""
+  counters = memcache.get_multi([_MEMCACHE_HITS_KEY, _MEMCACHE_MISSES_KEY])
+  return {'hits': counters.get(_MEMCACHE_HITS_KEY, 0),
+          'misses': counters.get(_MEMCACHE_MISSES_KEY, 0)}
+
+
+def _SerializeKMLElement(tag, value):
+  """Serializes a simple KML element, or nothing if the value is None.
+
+  Booleans are serialized as 1 or 0. Other values are serialized the same way
+  a Django template would print them.
+  """
+  if value is None:
+    return u''
+  elif isinstance(value, bool):
+    value = value and u'1' or u'0'
+  return u'<%s>%s</%s>' % (tag, value, tag)
+
+
+def _SerializeLinearRing(points, altitudes):
+  """Serializes a closed ring of points (a util.CoordinateArray) into KML.
+
+  Returns an empty string if there are no points, as there is no ring to close.
+  """
+  if not points:
+    return u''
+  closing_point = u'%s,%s' % (points[0].lon, points[0].lat)
+  if altitudes:
+    closing_point += u',%s' % altitudes[0]
+  coordinates = points.FormatKML(altitudes)
+  return u'<LinearRing><coordinates>%s %s</coordinates></LinearRing>' % (
+      coordinates, closing_point)
+
+
 def ForceIntoUnicode(string):
   """Converts a string to unicode (assuming UTF8) if it's not already."""
   if isinstance(string, unicode):
@@ -93,6 +533,19 @@ class AuthenticatedUser(db.Model):
   user = db.UserProperty(required=True)
 
 
+class KMLDependency(db.Model):
+  """A counter of the changes to an object that cached KML fragments rely on.
+
+  The key name identifies the object (and aspect) being tracked. See
+  GetKMLDependencyName(). A missing counter is equivalent to a generation of 0.
+
+  Explicit Properties:
+    generation: Incremented whenever the tracked object changes in a way that
+        invalidates the KML fragments built from it.
+  """
+  generation = db.IntegerProperty(default=0, indexed=False)
+
+
 class ContainerModelBase(db.Model):
   """A base class for containers. Only to reduce redundancy, so not a PolyModel.
 
@@ -166,6 +619,11 @@ class Layer(ContainerModelBase):
     compressed: Whether to serve KMZs instead of KMLs.
     dynamic_balloons: Whether to serve the entity balloon contents for this
         layer dynamically, instead of baking them into the KML.
+    dynamic_viewport: Whether to serve the entities of this layer by viewport
+        instead of through baked divisions. The layer document then links to
+        a view KML which Earth reloads whenever the camera stops, listing the
+        entities in view. Suits layers that change too often to bake. Has no
+        effect on non-auto-managed layers.
     auto_managed: A flag indicating that this layer is managed automatically.
         This is used for huge layers to block access to manual editing forms.
     baked: Whether this layer has been baked (auto-regionated), Has no effect on
@@ -185,10 +643,27 @@ class Layer(ContainerModelBase):
     division_lod_max_fade: The distance over which the geometry fades, from
         fully transparent to fully opaque. Has no effect on non-auto-managed
         layers.
+    division_split: How the region of a full division is split among its
+        children. One of the keys of DIVISION_SPLITS. None is equivalent to
+        'center'. Has no effect on non-auto-managed layers.
+    division_clusters: Whether divisions that have children also show a
+        cluster placemark with the number of entities for each part of their
+        region that has any, so that dense areas stand out before their
+        entities are loaded. Takes effect on the next baking run. Has no effect
+        on non-auto-managed layers.
+    division_generation: The generation of the divisions that are served. None
+        for layers baked before divisions had generations.
+    baking_generation: The generation of the divisions being built by a full
+        baking run, next to the served ones. None when no such run is in
+        progress.
     cached_kml: The cached KML representation of the layer. This should be
         reset to None whenever the layer is updated.
     timestamp: The last modified timestamp.
 
+  Two KML dependencies are tracked for each layer: its settings (see
+  FRAGMENT_SETTINGS), which the KML of every item in the layer relies on, and
+  its contents, which only folders and divisions rely on.
+
   Properties inherited from ContainerModelBase:
     name, description, icon, custom_kml, item_type: See the ContainerModelBase
     docstring for details.
@@ -206,12 +681,25 @@ class Layer(ContainerModelBase):
   """
 
   WORLDS = ['earth', 'moon', 'mars', 'sky']
+  # The layer properties that affect the KML of individual styles, entities,
+  # folders, links and divisions, rather than just the layer's own document.
+  FRAGMENT_SETTINGS = ('compressed', 'dynamic_balloons', 'division_lod_min',
+                       'division_lod_min_fade', 'division_lod_max',
+                       'division_lod_max_fade')
+  # The ways in which a full division can be split among its children. 'center'
+  # cuts the region through its center, 'median' through the median location of
+  # the entities that did not fit into the division.
+  DIVISION_SPLITS = {
+      'center': 'Quadrants',
+      'median': 'Entity Density'
+  }
 
   world = db.StringProperty(choices=WORLDS, required=True)
   busy = db.BooleanProperty()
   uncacheable = db.BooleanProperty()
   compressed = db.BooleanProperty()
   dynamic_balloons = db.BooleanProperty()
+  dynamic_viewport = db.BooleanProperty()
   auto_managed = db.BooleanProperty()
   baked = db.BooleanProperty()
   division_size = db.IntegerProperty(indexed=False)
@@ -219,6 +707,11 @@ class Layer(ContainerModelBase):
   division_lod_min_fade = db.IntegerProperty(indexed=False)
   division_lod_max = db.IntegerProperty(indexed=False)
   division_lod_max_fade = db.IntegerProperty(indexed=False)
+  division_split = db.StringProperty(choices=DIVISION_SPLITS.keys(),
+                                     indexed=False)
+  division_clusters = db.BooleanProperty(indexed=False)
+  division_generation = db.IntegerProperty(indexed=False)
+  baking_generation = db.IntegerProperty(indexed=False)
   cached_kml = db.TextProperty()
   timestamp = db.DateTimeProperty(auto_now=True)
 
@@ -283,51 +776,270 @@ class Layer(ContainerModelBase):
     Raises:
       KMLGenerationError: If the layer is auto-managed but not baked yet.
     """
-    if not self.cached_kml or self.uncacheable:
+    if not self.HasValidKMLCache():
       self.cached_kml = self._DoGenerateKML(cache)
       if not self.uncacheable: self.put()
     return self.cached_kml
 
+  def IterKML(self, cache=None):
+    """Serializes the layer as a KML document, one piece at a time.
+
+    Produces the same document as GenerateKML(), but yields the header, each
+    style, each content item and the footer separately, so that the document
+    can be written out while it is being generated. The cache is used and
+    filled the same way as in GenerateKML().
+
+    Args:
+      cache: An optional collections.defaultdict to use as a cache.
+
+    Yields:
+      UTF-8 encoded strings that make up the document when concatenated.
+
+    Raises:
+      KMLGenerationError: If the layer is auto-managed but not baked yet.
+    """
+    if self.HasValidKMLCache():
+      yield self.cached_kml.encode('utf8')
+    else:
+      store = not self.uncacheable and self._StoreCache or None
+      for data in _IterStoredDocument(self._IterUncachedKML(cache), False,
+                                      store):
+        yield data
+
+  def IterKMZ(self, cache=None):
+    """Serializes the layer as a KMZ archive, one piece at a time.
+
+    The archive of the cached KML is kept in memcache, and served from there
+    without being compressed again for as long as the cached KML is valid.
+
+    Args:
+      cache: An optional collections.defaultdict to use as a cache.
+
+    Yields:
+      Strings that make up the KMZ archive when concatenated.
+
+    Raises:
+      KMLGenerationError: If the layer is auto-managed but not baked yet.
+    """
+    if self.HasValidKMLCache():
+      kmz = _GetCachedKMZ(self)
+      if kmz is None:
+        kmz = ''.join(_IterKMZ([self.cached_kml.encode('utf8')]))
+        _SetCachedKMZ(self, self.cached_kml, kmz)
+      yield kmz
+    else:
+      store = not self.uncacheable and self._StoreCache or None
+      for data in _IterStoredDocument(self._IterUncachedKML(cache), True,
+                                      store):
+        yield data
+
+  def HasValidKMLCache(self):
+    """Returns whether cached_kml can be served as it is."""
+    return bool(self.cached_kml and not self.uncacheable)
+
+  def _StoreCache(self, kml, kmz):
+    """Saves a generated KML document and, optionally, its KMZ archive."""
+    self.cached_kml = kml
+    self.put()
+    if kmz: _SetCachedKMZ(self, kml, kmz)
+
   def _DoGenerateKML(self, cache):
     """Implements the actual KML generation as specified by GenerateKML()."""
+    return u''.join(self._IterUncachedKML(cache))
+
+  def _IterUncachedKML(self, cache):
+    """Generates the pieces of the layer's document, ignoring the cache."""
+    owns_cache = cache is None
+    if owns_cache: cache = collections.defaultdict(dict)
+    items = self._GetKMLContents()
+    styles = list(self.style_set)
+    PrefetchReferences(items + styles, cache, [self])
+    PrefetchKMLDependencies(items + styles, cache)
+    PrefetchGeometries(items, cache)
+    styles = (i.GenerateKML(cache) for i in styles)
+    contents = (_GenerateItemKML(i, cache) for i in items)
+    if self.auto_managed and self.dynamic_viewport:
+      contents = itertools.chain([self.GenerateViewLinkKML()], contents)
+    for piece in _IterDocumentKML(self, styles, contents,
+                                  self.EvaluateDescription()):
+      yield piece
+    if owns_cache: FlushCacheFills(cache)
+
+  def _GetKMLContents(self):
+    """Returns the items that make up the KML document of this layer.
+
+    Returns:
+      A list of the entities, folders, links and divisions to serialize as the
+      contents of the layer's KML document.
+
+    Raises:
+      KMLGenerationError: If the layer is auto-managed but not baked yet, and
+          does not have a dynamic viewport.
+    """
     if self.auto_managed:
-      if self.baked:
-        root_division = self.division_set.filter('parent_division', None).get()
+      if self.dynamic_viewport:
+        # The entities are listed in the view KML. See GenerateViewLinkKML().
+        items = list(self.link_set)
+      elif self.baked:
+        root_division = self.GetRootDivision()
         items = Entity.get_by_id(root_division.entities)
         items += list(root_division.division_set)
         items += list(self.link_set)
         # Don't forget entities that have not been assigned to a division yet.
         # This happens when new entities where added since the layer was last
-        # baked.
-        items += self.entity_set.filter('baked', None)
+        # baked. While a new generation of divisions is being baked, the baked
+        # flags track that generation instead, so they mean nothing here.
+        if self.baking_generation is None:
+          items += self.entity_set.filter('baked', None)
         # Folders are ignored in baked layers to avoid duplicating entities.
       else:
         raise KMLGenerationError('Cannot generate unbaked auto-managed layer.')
     else:
       items = self.GetSortedContents()
+    return items
 
-    items_kml = []
-    for item in items:
-      if isinstance(item, Division):
-        item_kml = item.GenerateLinkKML()
-      else:
-        item_kml = item.GenerateKML(cache)
-      items_kml.append(item_kml)
-    styles = [i.GenerateKML(cache) for i in self.style_set]
+  def GenerateViewLinkKML(self):
+    """Generates a <NetworkLink> tag pointing to the view KML of this layer.
 
-    args = {
+    The link is reloaded with the bounding box of the viewport whenever the
+    camera stops, and every settings.VIEW_REFRESH_INTERVAL seconds otherwise.
+    """
+    return _RenderKMLTemplate('view_link.kml', {
         'layer': self,
-        'contents': items_kml,
-        'styles': styles,
-        'description': self.EvaluateDescription()
-    }
-    return ForceIntoUnicode(_RenderKMLTemplate('layer.kml', args))
+        'refresh_time': settings.VIEW_REFRESH_TIME,
+        'refresh_interval': settings.VIEW_REFRESH_INTERVAL
+    })
 
-  def ClearCache(self):
-    """Clears the cached KML representation of this layer."""
+  def GetViewEntities(self, north, south, east, west):
+    """Returns the entities of the layer in a viewport, by priority.
+
+    Args:
+      north: The maximum latitude of the viewport.
+      south: The minimum latitude of the viewport.
+      east: The maximum longitude of the viewport.
+      west: The minimum longitude of the viewport. If greater than east, the
+          viewport crosses the 180th meridian.
+
+    Returns:
+      A list of at most settings.VIEW_MAX_ENTITIES entities located in the
+      viewport, highest priority first.
+    """
+    if west <= east:
+      boxes = [geotypes.Box(north, east, south, west)]
+    else:
+      boxes = [geotypes.Box(north, 180.0, south, west),
+               geotypes.Box(north, east, south, -180.0)]
+    limit = settings.VIEW_MAX_ENTITIES
+    entities = []
+    for box in boxes:
+      query = self.entity_set.order('-priority')
+      entities += Entity.bounding_box_fetch(query, box, limit)
+    if len(boxes) > 1:
+      entities.sort(key=operator.attrgetter('priority'), reverse=True)
+    return entities[:limit]
+
+  def IterViewKML(self, north, south, east, west, compressed, cache=None):
+    """Serializes the entities of the layer in a viewport as a KML document.
+
+    The document holds nothing but the entities returned by GetViewEntities(),
+    each serialized from its cached KML where possible. It is not cached by
+    the layer; see the view server in handlers/dump.py.
+
+    Args:
+      north: The maximum latitude of the viewport.
+      south: The minimum latitude of the viewport.
+      east: The maximum longitude of the viewport.
+      west: The minimum longitude of the viewport.
+      compressed: Whether to yield a KMZ archive rather than the KML itself.
+      cache: An optional collections.defaultdict to use as a cache.
+
+    Yields:
+      Strings that make up the KML document, or the KMZ archive if compressed,
+      when concatenated.
+    """
+    owns_cache = cache is None
+    if owns_cache: cache = collections.defaultdict(dict)
+    entities = self.GetViewEntities(north, south, east, west)
+    PrefetchReferences(entities, cache, [self])
+    PrefetchKMLDependencies(entities, cache)
+    PrefetchGeometries(entities, cache)
+    contents = (i.GenerateKML(cache) for i in entities)
+    # Like a division document, without a name or a region of its own.
+    pieces = _IterDocumentKML({}, [], contents)
+    for data in _IterStoredDocument(pieces, compressed):
+      yield data
+    if owns_cache: FlushCacheFills(cache)
+
+  def GetRootDivision(self):
+    """Returns the root of the served division tree, or None if there is none.
+
+    There is a root division for each generation of divisions that has not been
+    deleted yet. They are told apart in memory rather than in the query, since
+    divisions created before divisions had generations lack the property.
+    """
+    root = self.GetDivision(Division.ROOT_PATH)
+    if root:
+      return root
+    # Divisions baked before divisions had key names can only be queried.
+    # The served generation, the one being baked and those awaiting collection.
+    roots = self.division_set.filter('parent_division', None).fetch(20)
+    for root in roots:
+      if root.generation == self.division_generation:
+        return root
+    return None
+
+  def GetDivision(self, path):
+    """Returns the served division with the given quad path, or None.
+
+    Args:
+      path: The quad path of the division. See Division.GetKeyName().
+
+    Returns:
+      The division, looked up by key name. None if there is no such division,
+      or if the served divisions predate key names.
+    """
+    if self.division_generation is None:
+      return None
+    return Division.get_by_key_name(
+        Division.GetKeyName(self, self.division_generation, path))
+
+  def ClearCache(self, cache=None):
+    """Clears the cached KML of this layer and of its folders and divisions.
+
+    Should be called whenever anything in the layer changes. The cached KML of
+    entities, links and styles is left alone; see ClearSettingsCache().
+
+    Args:
+      cache: The collections.defaultdict used for the current request, if any,
+          so that the KML generations it holds are kept up to date.
+    """
+    BumpKMLGeneration(GetKMLDependencyName(self.key(), 'contents'), cache)
+    self.ClearDocumentCache()
+
+  def ClearDocumentCache(self):
+    """Clears the cached KML of the layer's own document only.
+
+    Unlike ClearCache(), leaves the cached KML of folders and divisions valid.
+    Used when only the items listed directly in the layer document changed.
+    """
     # Saving even if the cache was already empty to update the timestamp.
     self.cached_kml = None
     self.put()
+    ClearMemcachedKML(self.key().id())
+
+  def ClearSettingsCache(self, cache=None):
+    """Clears all the cached KML in the layer after FRAGMENT_SETTINGS changed.
+
+    Args:
+      cache: The collections.defaultdict used for the current request, if any,
+          so that the KML generations it holds are kept up to date.
+    """
+    BumpKMLGeneration(GetKMLDependencyName(self.key()), cache)
+    self.ClearCache(cache)
+
+  def GetFragmentSettings(self):
+    """Returns the values of FRAGMENT_SETTINGS, for detecting changes."""
+    return [getattr(self, i) for i in self.FRAGMENT_SETTINGS]
 
   def GetSortedContents(self):
     """Returns a sorted list of the container content nodes."""
@@ -373,6 +1085,8 @@ class Resource(db.Model):
     overlay_set: The overlays which reference this resource.
     model_set: The models which reference this resource.
 
+  Thumbnails of image and icon blobs are cached as child Thumbnail entities.
+
     NOTE: In addition to these, ContainerModelBase also references Resource but
     there's no backreference for it due to circular referencing issues.
   """
@@ -437,6 +1151,60 @@ class Resource(db.Model):
     else:
       raise TypeError('Tried to generate thumbnail of a non-image resource.')
 
+  def GetThumbnail(self, size):
+    """Gets a PNG thumbnail of the resource's blob, generating it if needed.
+
+    Generated thumbnails are stored, so that each size of each image is only
+    resized once. A thumbnail that cannot be stored is still returned.
+
+    Args:
+      size: The size in pixels of the longer side of the thumbnail.
+
+    Returns:
+      A string containing the PNG thumbnail. Empty if the image already has
+      the requested size, in which case the original blob should be used.
+
+    Raises:
+      images.Error: If the blob could not be resized.
+    """
+    key_name = Thumbnail.GetKeyName(size)
+    thumbnail = Thumbnail.get_by_key_name(key_name, parent=self)
+    if thumbnail is None:
+      image = images.Image(blob_key=str(self.blob.key()))
+      # Automatically keeps aspect ratio.
+      image.resize(size, size)
+      data = image.execute_transforms(output_encoding=images.PNG)
+      thumbnail = Thumbnail(key_name=key_name, parent=self, data=db.Blob(data))
+      try:
+        thumbnail.put()
+      except (db.Error, apiproxy_errors.Error), e:
+        logging.warning('Could not store a thumbnail of resource %d: %s',
+                        self.key().id(), e)
+    return thumbnail.data
+
+  def DeleteThumbnails(self):
+    """Deletes all the stored thumbnails of the resource."""
+    db.delete(Thumbnail.all(keys_only=True).ancestor(self).fetch(
+        _MAX_BATCH_SIZE))
+
+
+class Thumbnail(db.Model):
+  """A Datastore model for cached thumbnails of image and icon resources.
+
+  Thumbnails are children of their resources, keyed by size. See
+  Resource.GetThumbnail().
+
+  Explicit Properties:
+    data: The PNG image data. Empty if the original image already has the size
+        of the thumbnail.
+  """
+  data = db.BlobProperty()
+
+  @staticmethod
+  def GetKeyName(size):
+    """Returns the key name of the thumbnail with the given size."""
+    return 'size%d' % size
+
 
 class Permission(db.Model):
   """A Datastore model for permission objects that form an Access Control List.
@@ -511,6 +1279,8 @@ class Style(db.Model):
         overrides when generating KML.
     cached_kml: The cached KML representation of the style. This should be reset
         to None whenever the style is updated.
+    kml_dependencies: The KML dependencies of cached_kml, with the generations
+        they had when it was generated. See RecordKMLDependencies().
 
   Auto-generated Properties:
     entity_set: The set of all entities affected by this style.
@@ -556,18 +1326,23 @@ class Style(db.Model):
   highlight_polygon_outline = db.BooleanProperty(indexed=False)
 
   cached_kml = db.TextProperty()
+  kml_dependencies = db.StringListProperty(indexed=False)
 
-  def GenerateKML(self, unused_cache=None):
+  def GenerateKML(self, cache=None):
     """Serializes the object as a KML <Style> or <StyleMap> tag.
 
     If the style has highlight overrides, two <Style> tags are generated and
     included by a <StyleMap> with the standard ID. Otherwise a single <Style> is
     generated and given the standard ID.
 
+    Args:
+      cache: An optional collections.defaultdict to use as a cache.
+
     Returns:
       A string containing a <Style> or two <Style>s and a <StyleMap>.
     """
-    if not self.cached_kml or self.layer.uncacheable:
+    if not self.HasValidKMLCache(cache):
+      RecordKMLDependencies(self, cache)
       id_string = str(self.key().id())
       if self.has_highlight:
         normal = self._GenerateSingleStyleKML(id_string + '_1', False)
@@ -577,9 +1352,17 @@ class Style(db.Model):
       else:
         kml = self._GenerateSingleStyleKML(id_string, False)
       self.cached_kml = ForceIntoUnicode(kml)
-      if not self.layer.uncacheable: self.put()
+      if not self.layer.uncacheable: _SaveCacheFill(self, cache)
     return self.cached_kml
 
+  def HasValidKMLCache(self, cache=None):
+    """Returns whether cached_kml is up to date with the style's layer."""
+    return _HasValidKMLCache(self, cache)
+
+  def GetKMLDependencies(self):
+    """Returns the names of the KML dependencies of the style."""
+    return [GetKMLDependencyName(Style.layer.get_value_for_datastore(self))]
+
   def _GenerateSingleStyleKML(self, style_id, highlighted):
     """Generates either a normal or a highlight <Style> with the given ID.
 
@@ -610,9 +1393,14 @@ class Style(db.Model):
 
     return _RenderKMLTemplate('style.kml', args)
 
-  def ClearCache(self):
-    """Clears the cached KML representation of this style."""
-    self.layer.ClearCache()
+  def ClearCache(self, cache=None):
+    """Clears the cached KML representation of this style.
+
+    Args:
+      cache: The collections.defaultdict used for the current request, if any,
+          so that the KML generations it holds are kept up to date.
+    """
+    self.layer.ClearCache(cache)
     if self.cached_kml:
       self.cached_kml = None
       self.put()
@@ -667,21 +1455,30 @@ class Region(db.Model):
   cached_kml = db.TextProperty()
   timestamp = db.DateTimeProperty(auto_now=True)
 
-  def GenerateKML(self, unused_cache=None):
+  def GenerateKML(self, cache=None):
     """Serializes the object as a KML <Region> tag.
 
+    Args:
+      cache: An optional collections.defaultdict to use as a cache.
+
     Returns:
       A string containing a KML <Region> tag.
     """
     if not self.cached_kml or self.layer.uncacheable:
       kml = ForceIntoUnicode(_RenderKMLTemplate('region.kml', {'region': self}))
       self.cached_kml = kml
-      if not self.layer.uncacheable: self.put()
+      if not self.layer.uncacheable: _SaveCacheFill(self, cache)
     return self.cached_kml
 
-  def ClearCache(self):
-    """Clears the cached KML representation of this region."""
-    self.layer.ClearCache()
+  def ClearCache(self, cache=None):
+    """Clears the cached KML representation of this region and its users.
+
+    Args:
+      cache: The collections.defaultdict used for the current request, if any,
+          so that the KML generations it holds are kept up to date.
+    """
+    BumpKMLGeneration(GetKMLDependencyName(self.key()), cache)
+    self.layer.ClearCache(cache)
     if self.cached_kml:
       self.cached_kml = None
       self.put()
@@ -696,18 +1493,16 @@ class Folder(ContainerModelBase):
 
   Explicit Properties:
     layer: A reference to the layer to which this folder belongs.
-    layer_timestamp: The last modified timestamp of the layer that contains this
-        folder.
     folder: A reference to another folder that is the parent of this one. If
         None, the folder is considered a child of the layer.
     folder_index: A number indicating where in the parent folder the folder
         appears. Entities, folders or links with lower indices appear before
         those with higher ones.
     region: The Region that controls when this folder is shown or hidden.
-    region_timestamp: The last modified timestamp of the region used by this
-        folder.
     cached_kml: The cached KML representation of the folder. This should be
         reset to None whenever the folder is updated.
+    kml_dependencies: The KML dependencies of cached_kml, with the generations
+        they had when it was generated. See RecordKMLDependencies().
 
   Properties inherited from ContainerModelBase:
     name, description, icon, custom_kml, item_type: See the ContainerModelBase
@@ -720,12 +1515,11 @@ class Folder(ContainerModelBase):
   """
 
   layer = db.ReferenceProperty(Layer, required=True)
-  layer_timestamp = db.DateTimeProperty()
   folder = db.SelfReferenceProperty()
   folder_index = db.IntegerProperty(default=0)
   region = db.ReferenceProperty(Region)
-  region_timestamp = db.DateTimeProperty()
   cached_kml = db.TextProperty()
+  kml_dependencies = db.StringListProperty(indexed=False)
 
   def GenerateKML(self, cache=None):
     """Serializes the object as a KML <Folder> tag.
@@ -736,22 +1530,48 @@ class Folder(ContainerModelBase):
     Returns:
       A string containing a KML <Folder> tag.
     """
-    if (not self.cached_kml or
-        self.layer.uncacheable or
-        self.layer.timestamp != self.layer_timestamp or
-        (self.region and self.region.timestamp != self.region_timestamp)):
-      contents = [i.GenerateKML(cache) for i in self.GetSortedContents()]
-      description = self.EvaluateDescription()
-      args = {'folder': self, 'contents': contents, 'description': description}
+    if not self.HasValidKMLCache(cache):
+      contents_cache = cache
+      if contents_cache is None:
+        contents_cache = collections.defaultdict(dict)
+      RecordKMLDependencies(self, contents_cache)
+      contents = self.GetSortedContents()
+      PrefetchReferences(contents, contents_cache, [self.layer])
+      PrefetchKMLDependencies(contents, contents_cache)
+      PrefetchGeometries(contents, contents_cache)
+      contents = [i.GenerateKML(contents_cache) for i in contents]
+      args = {
+          'folder': self,
+          'contents': contents,
+          'description': self.EvaluateDescription(),
+          'region_kml': _GenerateRegionKML(self, contents_cache)
+      }
       self.cached_kml = ForceIntoUnicode(_RenderKMLTemplate('folder.kml', args))
-      self.layer_timestamp = self.layer.timestamp
-      if self.region: self.region_timestamp = self.region.timestamp
-      if not self.layer.uncacheable: self.put()
+      if cache is None: FlushCacheFills(contents_cache)
+      if not self.layer.uncacheable: _SaveCacheFill(self, cache)
     return self.cached_kml
 
-  def ClearCache(self):
-    """Clears the cached KML representation of this folder."""
-    self.layer.ClearCache()
+  def HasValidKMLCache(self, cache=None):
+    """Returns whether cached_kml is up to date with the folder's references."""
+    return _HasValidKMLCache(self, cache)
+
+  def GetKMLDependencies(self):
+    """Returns the names of the KML dependencies of the folder."""
+    layer_key = Folder.layer.get_value_for_datastore(self)
+    names = [GetKMLDependencyName(layer_key),
+             GetKMLDependencyName(layer_key, 'contents')]
+    region_key = Folder.region.get_value_for_datastore(self)
+    if region_key: names.append(GetKMLDependencyName(region_key))
+    return names
+
+  def ClearCache(self, cache=None):
+    """Clears the cached KML representation of this folder.
+
+    Args:
+      cache: The collections.defaultdict used for the current request, if any,
+          so that the KML generations it holds are kept up to date.
+    """
+    self.layer.ClearCache(cache)
     if self.cached_kml:
       self.cached_kml = None
       self.put()
@@ -780,10 +1600,10 @@ class Link(ContainerModelBase):
         higher ones.
     region: The Region that controls when the KML pointed to by this link is
         loaded, shown and hidden.
-    region_timestamp: The last modified timestamp of the region used by this
-        link.
     cached_kml: The cached KML representation of the link. This should be
         reset to None whenever the link is updated.
+    kml_dependencies: The KML dependencies of cached_kml, with the generations
+        they had when it was generated. See RecordKMLDependencies().
 
   Properties inherited from ContainerModelBase:
     name, description, icon, custom_kml, item_type: See the ContainerModelBase
@@ -795,28 +1615,48 @@ class Link(ContainerModelBase):
   folder = db.ReferenceProperty(Folder)
   folder_index = db.IntegerProperty(default=0)
   region = db.ReferenceProperty(Region)
-  region_timestamp = db.DateTimeProperty()
   cached_kml = db.TextProperty()
+  kml_dependencies = db.StringListProperty(indexed=False)
 
-  def GenerateKML(self, unused_cache=None):
+  def GenerateKML(self, cache=None):
     """Serializes the object as a KML <NetworkLink> tag.
 
+    Args:
+      cache: An optional collections.defaultdict to use as a cache.
+
     Returns:
       A string containing a KML <NetworkLink> tag.
     """
-    if (not self.cached_kml or
-        self.layer.uncacheable or
-        (self.region and self.region.timestamp != self.region_timestamp)):
-      description = self.EvaluateDescription()
-      args = {'link': self, 'description': description}
+    if not self.HasValidKMLCache(cache):
+      RecordKMLDependencies(self, cache)
+      args = {
+          'link': self,
+          'description': self.EvaluateDescription(),
+          'region_kml': _GenerateRegionKML(self, cache)
+      }
       self.cached_kml = ForceIntoUnicode(_RenderKMLTemplate('link.kml', args))
-      if self.region: self.region_timestamp = self.region.timestamp
-      if not self.layer.uncacheable: self.put()
+      if not self.layer.uncacheable: _SaveCacheFill(self, cache)
     return self.cached_kml
 
-  def ClearCache(self):
-    """Clears the cached KML representation of this link."""
-    self.layer.ClearCache()
+  def HasValidKMLCache(self, cache=None):
+    """Returns whether cached_kml is up to date with the link's references."""
+    return _HasValidKMLCache(self, cache)
+
+  def GetKMLDependencies(self):
+    """Returns the names of the KML dependencies of the link."""
+    names = [GetKMLDependencyName(Link.layer.get_value_for_datastore(self))]
+    region_key = Link.region.get_value_for_datastore(self)
+    if region_key: names.append(GetKMLDependencyName(region_key))
+    return names
+
+  def ClearCache(self, cache=None):
+    """Clears the cached KML representation of this link.
+
+    Args:
+      cache: The collections.defaultdict used for the current request, if any,
+          so that the KML generations it holds are kept up to date.
+    """
+    self.layer.ClearCache(cache)
     if self.cached_kml:
       self.cached_kml = None
       self.put()
@@ -918,9 +1758,15 @@ class Template(db.Model):
 
     return template_cache[template_id].render(template.Context(args))
 
-  def ClearCache(self):
-    """Clears the cached KML of the whole layer to force entity cache checks."""
-    self.schema.layer.ClearCache()
+  def ClearCache(self, cache=None):
+    """Clears the cached KML of the entities using this template.
+
+    Args:
+      cache: The collections.defaultdict used for the current request, if any,
+          so that the KML generations it holds are kept up to date.
+    """
+    BumpKMLGeneration(GetKMLDependencyName(self.key()), cache)
+    self.schema.layer.ClearCache(cache)
 
 
 class Field(db.Model):
@@ -1091,7 +1937,20 @@ class Point(KMLGeometry):
 
   def GenerateKML(self, unused_cache=None):
     """Serializes the object as a <Point>."""
-    return ForceIntoUnicode(_RenderKMLTemplate('point.kml', {'point': self}))
+    if settings.USE_COMPILED_GEOMETRY_SERIALIZERS:
+      return self._SerializeKML()
+    else:
+      return ForceIntoUnicode(_RenderKMLTemplate('point.kml', {'point': self}))
+
+  def _SerializeKML(self):
+    """Serializes the object exactly like point.kml, without Django."""
+    return u''.join((
+        u'<Point>',
+        _SerializeKMLElement('extrude', self.extrude),
+        _SerializeKMLElement('altitudeMode', self.altitude_mode),
+        u'<coordinates>%s,%s,%s</coordinates>' % (
+            self.location.lon, self.location.lat, self.altitude or 0),
+        u'</Point>'))
 
 
 class LineString(KMLGeometry):
@@ -1109,22 +1968,36 @@ class LineString(KMLGeometry):
         the ground to their altitude to appear as vertical planes instead.
   """
 
-  points = db.ListProperty(db.GeoPt, required=True, indexed=False)
-  altitudes = db.ListProperty(float, indexed=False)
+  points = PackedGeoPtListProperty(required=True, indexed=False)
+  altitudes = PackedFloatListProperty(indexed=False)
   altitude_mode = db.StringProperty(choices=_ALTITUDE_MODES, indexed=False)
   tessellate = db.BooleanProperty(indexed=False)
   extrude = db.BooleanProperty(indexed=False)
 
   def GetCenter(self):
     """Returns a db.GeoPt with the location of the center of this geometry."""
-    latitude = sum(i.lat for i in self.points) / len(self.points)
-    longitude = sum(i.lon for i in self.points) / len(self.points)
+    latitude = sum(self.points.GetLatitudes()) / len(self.points)
+    longitude = sum(self.points.GetLongitudes()) / len(self.points)
     return db.GeoPt(latitude, longitude)
 
   def GenerateKML(self, unused_cache=None):
     """Serializes the object as a <LineString>."""
-    kml = _RenderKMLTemplate('line_string.kml', {'line_string': self})
-    return ForceIntoUnicode(kml)
+    if settings.USE_COMPILED_GEOMETRY_SERIALIZERS:
+      return self._SerializeKML()
+    else:
+      kml = _RenderKMLTemplate('line_string.kml', {'line_string': self})
+      return ForceIntoUnicode(kml)
+
+  def _SerializeKML(self):
+    """Serializes the object exactly like line_string.kml, without Django."""
+    coordinates = self.points.FormatKML(self.altitudes)
+    return u''.join((
+        u'<LineString>',
+        _SerializeKMLElement('extrude', self.extrude),
+        _SerializeKMLElement('tessellate', self.tessellate),
+        _SerializeKMLElement('altitudeMode', self.altitude_mode),
+        u'<coordinates>%s</coordinates>' % coordinates,
+        u'</LineString>'))
 
 
 class Polygon(KMLGeometry):
@@ -1148,24 +2021,47 @@ class Polygon(KMLGeometry):
         the ground to its altitude to look 3-dimensional.
   """
 
-  outer_points = db.ListProperty(db.GeoPt, required=True, indexed=False)
-  inner_points = db.ListProperty(db.GeoPt, indexed=False)
-  outer_altitudes = db.ListProperty(float, indexed=False)
-  inner_altitudes = db.ListProperty(float, indexed=False)
+  outer_points = PackedGeoPtListProperty(required=True, indexed=False)
+  inner_points = PackedGeoPtListProperty(indexed=False)
+  outer_altitudes = PackedFloatListProperty(indexed=False)
+  inner_altitudes = PackedFloatListProperty(indexed=False)
   altitude_mode = db.StringProperty(choices=_ALTITUDE_MODES, indexed=False)
   tessellate = db.BooleanProperty(indexed=False)
   extrude = db.BooleanProperty(indexed=False)
 
   def GetCenter(self):
     """Returns a db.GeoPt with the location of the center of this geometry."""
-    latitude = sum(i.lat for i in self.outer_points) / len(self.outer_points)
-    longitude = sum(i.lon for i in self.outer_points) / len(self.outer_points)
+    latitude = sum(self.outer_points.GetLatitudes()) / len(self.outer_points)
+    longitude = sum(self.outer_points.GetLongitudes()) / len(self.outer_points)
     return db.GeoPt(latitude, longitude)
 
   def GenerateKML(self, unused_cache=None):
     """Serializes the object as a <Polygon>."""
-    kml = _RenderKMLTemplate('polygon.kml', {'polygon': self})
-    return ForceIntoUnicode(kml)
+    if settings.USE_COMPILED_GEOMETRY_SERIALIZERS:
+      return self._SerializeKML()
+    else:
+      kml = _RenderKMLTemplate('polygon.kml', {'polygon': self})
+      return ForceIntoUnicode(kml)
+
+  def _SerializeKML(self):
+    """Serializes the object exactly like polygon.kml, without Django."""
+    parts = [
+        u'<Polygon>',
+        _SerializeKMLElement('extrude', self.extrude),
+        _SerializeKMLElement('tessellate', self.tessellate),
+        _SerializeKMLElement('altitudeMode', self.altitude_mode),
+        u'<outerBoundaryIs>',
+        _SerializeLinearRing(self.outer_points, self.outer_altitudes),
+        u'</outerBoundaryIs>'
+    ]
+    if self.inner_points:
+      parts += [
+          u'<innerBoundaryIs>',
+          _SerializeLinearRing(self.inner_points, self.inner_altitudes),
+          u'</innerBoundaryIs>'
+      ]
+    parts.append(u'</Polygon>')
+    return u''.join(parts)
 
 
 class Model(KMLGeometry):
@@ -1369,10 +2265,11 @@ class PhotoOverlay(Overlay):
 class Division(db.Model):
   """A Datastore model for layer divisions, used for auto-regionation.
 
+  Divisions are keyed by their layer, generation and quad path; see
+  GetKeyName(). Divisions baked before they had key names have numeric IDs.
+
   Explicit Properties:
     layer: A reference to the layer to which this division belongs.
-    layer_timestamp: The last modified timestamp of the layer that contains this
-        division.
     north: The maximum latitude of the overlay rectangle.
     south: The minimum latitude of the overlay rectangle.
     west: The maximum longitude of the overlay rectangle.
@@ -1380,15 +2277,32 @@ class Division(db.Model):
     baked: Whether the division has been baked already.
     entities: A list of IDs of entity that belong to this division.
     parent_division: The Division which contains this one. None for roots.
+    depth: The number of ancestors of the division. 0 for roots.
+    generation: The baking run that created the division. Only the divisions
+        of the layer's division_generation are served. See Layer.
+    split_latitude: The latitude at which the region of the division was split
+        among its children. None if it was split through its center.
+    split_longitude: The longitude at which the region of the division was
+        split among its children. None if it was split through its center.
+    cluster_cells: The geocells of the division's cluster placemarks. Only
+        set on divisions with children, in layers with division_clusters set.
+    cluster_counts: The number of entities in each of cluster_cells.
+    cluster_locations: The centroid of the entities in each of cluster_cells,
+        where its cluster placemark is shown.
     cached_kml: The cached KML representation of the division. This should be
         reset to None whenever the division is updated.
+    kml_dependencies: The KML dependencies of cached_kml, with the generations
+        they had when it was generated. See RecordKMLDependencies().
+    render_time: The number of seconds it took the baker's render stage to
+        generate cached_kml. None if the division has not been rendered by it.
+    kml_size: The size in bytes of the UTF-8 encoded KML rendered by the
+        baker's render stage.
 
   Auto-generated Properties:
     division_set: The set of all child divisions.
   """
 
   layer = db.ReferenceProperty(Layer, required=True)
-  layer_timestamp = db.DateTimeProperty()
   north = db.FloatProperty(required=True)
   south = db.FloatProperty(required=True)
   west = db.FloatProperty(required=True)
@@ -1396,7 +2310,54 @@ class Division(db.Model):
   baked = db.BooleanProperty(required=True)
   entities = db.ListProperty(int)
   parent_division = db.SelfReferenceProperty()
+  depth = db.IntegerProperty()
+  generation = db.IntegerProperty()
+  split_latitude = db.FloatProperty(indexed=False)
+  split_longitude = db.FloatProperty(indexed=False)
+  cluster_cells = db.StringListProperty(indexed=False)
+  cluster_counts = db.ListProperty(int, indexed=False)
+  cluster_locations = db.ListProperty(db.GeoPt, indexed=False)
   cached_kml = db.TextProperty()
+  kml_dependencies = db.StringListProperty(indexed=False)
+  render_time = db.FloatProperty(indexed=False)
+  kml_size = db.IntegerProperty(indexed=False)
+
+  # The quad path of root divisions.
+  ROOT_PATH = 'r'
+
+  @staticmethod
+  def GetKeyName(layer, generation, path):
+    """Returns the key name of a division.
+
+    Args:
+      layer: The layer of the division.
+      generation: The generation of the division.
+      path: The quad path of the division: ROOT_PATH for the root, followed
+          by the index of the child slice taken at each level, separated by
+          dashes after the first, e.g. "r0-2-1-3".
+
+    Returns:
+      The key name, unique across layers and generations.
+    """
+    return '%d:%d:%s' % (layer.key().id(), generation, path)
+
+  @staticmethod
+  def GetPathFromKey(key):
+    """Returns the quad path in a division's key, or None for a numeric ID."""
+    name = key.name()
+    return name and name.rsplit(':', 1)[1]
+
+  def GetPath(self):
+    """Returns the quad path of the division, or None if it has none."""
+    return Division.GetPathFromKey(self.key())
+
+  def GetServedId(self):
+    """Returns the ID of the division in the URL of its KML, as a string.
+
+    This is the quad path of the division, which stays the same across bakes,
+    or its numeric ID if it has none.
+    """
+    return self.GetPath() or str(self.key().id())
 
   def GenerateKML(self, cache=None):
     """Serializes the division as a lightweight KML <Document> tag.
@@ -1413,34 +2374,702 @@ class Division(db.Model):
     if not self.baked:
       raise KMLGenerationError('Cannot generate unbaked layer division.')
 
-    if (not self.cached_kml or self.layer.uncacheable or
-        self.layer.timestamp != self.layer_timestamp):
-      entities = [i.GenerateKML(cache) for i in Entity.get_by_id(self.entities)]
-      links_kml = [i.GenerateLinkKML() for i in self.division_set]
-      args = {'layer': self, 'contents': entities + links_kml}
-      self.cached_kml = ForceIntoUnicode(_RenderKMLTemplate('layer.kml', args))
-      self.layer_timestamp = self.layer.timestamp
-      if not self.layer.uncacheable: self.put()
+    if not self.HasValidKMLCache(cache):
+      RecordKMLDependencies(self, cache)
+      self.cached_kml = u''.join(self._IterUncachedKML(cache))
+      if not self.layer.uncacheable: _SaveCacheFill(self, cache)
     return self.cached_kml
 
+  def IterKML(self, cache=None):
+    """Serializes the division as a KML document, one piece at a time.
+
+    Produces the same document as GenerateKML(), but yields the header, each
+    entity, each child division link and the footer separately. The cache is
+    used and filled the same way as in GenerateKML().
+
+    Args:
+      cache: An optional collections.defaultdict to use as a cache.
+
+    Yields:
+      UTF-8 encoded strings that make up the document when concatenated.
+
+    Raises:
+      KMLGenerationError: If the division has not finished baking yet.
+    """
+    if not self.baked:
+      raise KMLGenerationError('Cannot generate unbaked layer division.')
+
+    if self.HasValidKMLCache(cache):
+      yield self.cached_kml.encode('utf8')
+    else:
+      RecordKMLDependencies(self, cache)
+      store = not self.layer.uncacheable and self._StoreCache or None
+      for data in _IterStoredDocument(self._IterUncachedKML(cache), False,
+                                      store):
+        yield data
+
+  def IterKMZ(self, cache=None):
+    """Serializes the division as a KMZ archive, one piece at a time.
+
+    The archive of the cached KML is kept in memcache, and served from there
+    without being compressed again for as long as the cached KML is valid.
+
+    Args:
+      cache: An optional collections.defaultdict to use as a cache.
+
+    Yields:
+      Strings that make up the KMZ archive when concatenated.
+
+    Raises:
+      KMLGenerationError: If the division has not finished baking yet.
+    """
+    if not self.baked:
+      raise KMLGenerationError('Cannot generate unbaked layer division.')
+
+    if self.HasValidKMLCache(cache):
+      kmz = _GetCachedKMZ(self)
+      if kmz is None:
+        kmz = ''.join(_IterKMZ([self.cached_kml.encode('utf8')]))
+        _SetCachedKMZ(self, self.cached_kml, kmz)
+      yield kmz
+    else:
+      RecordKMLDependencies(self, cache)
+      store = not self.layer.uncacheable and self._StoreCache or None
+      for data in _IterStoredDocument(self._IterUncachedKML(cache), True,
+                                      store):
+        yield data
+
+  def HasValidKMLCache(self, cache=None):
+    """Returns whether cached_kml is up to date with the division's layer."""
+    return _HasValidKMLCache(self, cache)
+
+  def GetKMLDependencies(self):
+    """Returns the names of the KML dependencies of the division."""
+    layer_key = Division.layer.get_value_for_datastore(self)
+    return [GetKMLDependencyName(layer_key),
+            GetKMLDependencyName(layer_key, 'contents')]
+
+  def _StoreCache(self, kml, kmz):
+    """Saves a generated KML document and, optionally, its KMZ archive."""
+    self.cached_kml = kml
+    self.put()
+    if kmz: _SetCachedKMZ(self, kml, kmz)
+
+  def _IterUncachedKML(self, cache):
+    """Generates the pieces of the division's document, ignoring the cache."""
+    owns_cache = cache is None
+    if owns_cache: cache = collections.defaultdict(dict)
+    PrefetchDivisionEntities([self], cache, [self.layer])
+    entities = (cache['entities'][i].GenerateKML(cache) for i in self.entities)
+    clusters = (i for i in [self.GenerateClusterKML()] if i)
+    links = (i.GenerateLinkKML() for i in self.division_set)
+    contents = itertools.chain(entities, clusters, links)
+    for piece in _IterDocumentKML(self, [], contents):
+      yield piece
+    if owns_cache: FlushCacheFills(cache)
+
   def GenerateLinkKML(self):
     """Generates a <NetworkLink> tag pointing to this division."""
     return _RenderKMLTemplate('division_link.kml', {'division': self})
 
+  def GenerateClusterKML(self):
+    """Generates the cluster placemarks of this division.
+
+    Each placemark is labeled with the number of entities in its geocell and
+    has the geocell as its region, so it fades out once that part of the
+    division is shown in enough detail for the child divisions to load.
+
+    Returns:
+      A string of <Placemark> tags, empty if the division has no clusters.
+    """
+    if not self.cluster_cells:
+      return u''
+    clusters = []
+    for cell, count, location in zip(self.cluster_cells, self.cluster_counts,
+                                     self.cluster_locations):
+      clusters.append({'count': count, 'location': location,
+                       'box': geocell.compute_box(cell)})
+    return _RenderKMLTemplate('cluster.kml', {'division': self,
+                                              'clusters': clusters})
+
   def ClearCache(self):
     """Clears the cached KML representation of this division."""
+    ClearMemcachedKML(Division.layer.get_value_for_datastore(self).id())
     if self.cached_kml:
       self.cached_kml = None
       self.put()
 
 
+class BakeSetupBarrier(db.Model):
+  """The progress of the parallel setup stage of a layer's baking.
+
+  Keyed by GetKeyName(). Setup is complete once the walk over the layer's keys
+  has determined expected_shards and that many shards have finished. The
+  finished shards are counted by the baker with a sharded counter rather than
+  here, so that they do not all update this one entity.
+
+  Explicit Properties:
+    expected_shards: The total number of setup shards. None until all of them
+        have been scheduled.
+    released: Whether the subdivision stage has been started.
+  """
+  expected_shards = db.IntegerProperty(indexed=False)
+  released = db.BooleanProperty(default=False, indexed=False)
+
+  @staticmethod
+  def GetKeyName(layer):
+    """Returns the key name of the barrier for the given layer."""
+    return str(layer.key().id())
+
+  @staticmethod
+  def Reset(layer):
+    """Creates a fresh barrier for a new baking run of the given layer."""
+    BakeSetupBarrier(key_name=BakeSetupBarrier.GetKeyName(layer)).put()
+
+
+class BakeReport(db.Model):
+  """The outcome of the latest baking run of a layer.
+
+  Keyed by the layer ID. See GetKeyName().
+
+  Explicit Properties:
+    started: When the baking run was started.
+    finished: When the baking run finished. None while it is in progress.
+    unassigned_entities: The IDs of up to settings.BAKER_RECONCILE_LIMIT
+        entities that were not assigned to any division.
+    division_count: The number of divisions in the baked layer.
+    depth: The number of levels in the baked division tree.
+    stalled: When the baking run was found to have stalled. None unless no
+        subdivide task completed between two checks of the monitor.
+    stalled_tasks: The number of subdivide tasks that had not completed when
+        the baking run stalled.
+  """
+  started = db.DateTimeProperty(auto_now_add=True, indexed=False)
+  finished = db.DateTimeProperty(indexed=False)
+  unassigned_entities = db.ListProperty(int, indexed=False)
+  division_count = db.IntegerProperty(indexed=False)
+  depth = db.IntegerProperty(indexed=False)
+  stalled = db.DateTimeProperty(indexed=False)
+  stalled_tasks = db.IntegerProperty(indexed=False)
+
+  @staticmethod
+  def GetKeyName(layer):
+    """Returns the key name of the report for the given layer."""
+    return str(layer.key().id())
+
+
+class CounterShard(db.Model):
+  """One shard of a sharded counter.
+
+  Keyed by the counter name and the shard index, separated by a colon. See
+  IncrementCounter() and GetCounter().
+
+  Explicit Properties:
+    count: The part of the counter's value held by this shard.
+  """
+  count = db.IntegerProperty(default=0, indexed=False)
+
+
+class GeocellCount(db.Model):
+  """The number of entities of a layer located in a geocell.
+
+  Keyed by GetKeyName(). Kept for every prefix of the entities' geocells up to
+  settings.GEOCELL_COUNT_RESOLUTION characters long, so that the number of
+  entities in a region can be estimated without querying them. See
+  UpdateGeocellCounts() and GetGeocellCounts().
+
+  Explicit Properties:
+    layer: The layer whose entities are counted.
+    count: The number of entities of the layer located in the geocell. Updated
+        without transactions, so concurrent updates of the same geocell may be
+        lost. The baker's count stage rebuilds the counts of a layer.
+    unbaked: How many of the entities counted are not assigned to any division
+        yet. Reset to count when a baking run starts, and decremented as the
+        baker places entities (see MarkGeocellsBaked()).
+    latitude_sum: The sum of the latitudes of the entities counted.
+    longitude_sum: The sum of the longitudes of the entities counted.
+  """
+  layer = db.ReferenceProperty(Layer, required=True)
+  count = db.IntegerProperty(default=0, indexed=False)
+  unbaked = db.IntegerProperty(default=0, indexed=False)
+  latitude_sum = db.FloatProperty(default=0.0, indexed=False)
+  longitude_sum = db.FloatProperty(default=0.0, indexed=False)
+
+  @staticmethod
+  def GetKeyName(layer, cell):
+    """Returns the key name of the count of a geocell in the given layer."""
+    return '%d:%s' % (layer.key().id(), cell)
+
+  def GetCell(self):
+    """Returns the geocell whose entities are counted."""
+    return self.key().name().split(':', 1)[1]
+
+  def GetCentroid(self):
+    """Returns the db.GeoPt centroid of the entities counted, or None."""
+    if self.count:
+      return db.GeoPt(self.latitude_sum / self.count,
+                      self.longitude_sum / self.count)
+    else:
+      return None
+
+
+def _GenerateRegionKML(item, cache):
+  """Serializes the region of an entity, folder or link, if it has one."""
+  if item.region is None:
+    return u''
+  else:
+    return item.region.GenerateKML(cache)
+
+
+def _GenerateItemKML(item, cache):
+  """Serializes a container item, linking to (not inlining) Divisions."""
+  if isinstance(item, Division):
+    return item.GenerateLinkKML()
+  else:
+    return item.GenerateKML(cache)
+
+
+def PrefetchReferences(items, cache, known=()):
+  """Resolves the references of a list of entities, folders or links at once.
+
+  Collects the distinct keys referenced by the layer, style, region and
+  template properties of the items, loads the ones not already in
+  cache['references'] with batched gets, and assigns the shared instances back
+  to the items' properties. Each item then dereferences them without a
+  datastore get of its own. The layers of referenced styles and regions are
+  shared the same way.
+
+  Args:
+    items: An iterable of models. Anything that is not a db.Model is ignored.
+    cache: The collections.defaultdict in which to keep the loaded objects.
+    known: Objects already loaded by the caller (e.g. the layer being
+        rendered) that should be reused rather than loaded again.
+  """
+  instances = cache['references']
+  for instance in known:
+    instances.setdefault(instance.key(), instance)
+
+  references = []
+  for item in items:
+    if not isinstance(item, db.Model): continue
+    for name in _PREFETCHED_REFERENCES:
+      reference = item.properties().get(name)
+      if isinstance(reference, db.ReferenceProperty):
+        key = reference.get_value_for_datastore(item)
+        if key is not None:
+          references.append((item, name, key))
+
+  missing = list(set(i[2] for i in references if i[2] not in instances))
+  for start in xrange(0, len(missing), _MAX_BATCH_SIZE):
+    batch = missing[start:start + _MAX_BATCH_SIZE]
+    instances.update(zip(batch, db.get(batch)))
+
+  for item, name, key in references:
+    if instances[key] is not None:
+      setattr(item, name, instances[key])
+
+  fetched = [instances[i] for i in missing if instances[i] is not None]
+  if fetched:
+    PrefetchReferences(fetched, cache)
+
+
+def PrefetchDivisionEntities(divisions, cache, known=()):
+  """Loads everything needed to render a list of divisions at once.
+
+  The entities of all the divisions are loaded with batched gets into
+  cache['entities'], keyed by their IDs, where the divisions pick them up when
+  they generate their KML. The references, KML dependencies and geometries of
+  the entities and the divisions are then prefetched for all of them together.
+
+  Args:
+    divisions: A list of divisions about to be rendered.
+    cache: The collections.defaultdict in which to keep the loaded objects.
+    known: Objects already loaded by the caller (e.g. the layer of the
+        divisions) that should be reused rather than loaded again.
+  """
+  preloaded = cache['entities']
+  missing = set()
+  for division in divisions:
+    missing.update(i for i in division.entities if i not in preloaded)
+  missing = list(missing)
+  for start in xrange(0, len(missing), _MAX_BATCH_SIZE):
+    batch = missing[start:start + _MAX_BATCH_SIZE]
+    preloaded.update(zip(batch, Entity.get_by_id(batch)))
+  entities = [preloaded[i] for division in divisions for i in division.entities]
+  PrefetchReferences(list(divisions) + entities, cache, known)
+  PrefetchKMLDependencies(list(divisions) + entities, cache)
+  PrefetchGeometries(entities, cache)
+
+
+def PrefetchGeometries(items, cache):
+  """Loads the geometries of entities about to be serialized in batched gets.
+
+  Only the geometries of entities whose cached KML is out of date are loaded.
+  They are stored in cache['geometries'], keyed by their datastore keys, where
+  Entity.GenerateKML() picks them up instead of getting them one at a time.
+
+  Args:
+    items: An iterable of container contents. Anything that is not an Entity
+        is ignored.
+    cache: The collections.defaultdict in which to store the geometries.
+  """
+  prefetched = cache['geometries']
+  keys = []
+  for item in items:
+    if isinstance(item, Entity) and not item.HasValidKMLCache(cache):
+      keys += [i for i in item.GetGeometryKeys() if i not in prefetched]
+  for start in xrange(0, len(keys), _MAX_BATCH_SIZE):
+    batch = keys[start:start + _MAX_BATCH_SIZE]
+    prefetched.update(zip(batch, db.get(batch)))
+
+
+def GetKMLDependencyName(key, aspect=None):
+  """Returns the name under which an object's KML generation is tracked.
+
+  Args:
+    key: The datastore key of the object.
+    aspect: An optional string, for objects which track several independent
+        generations (e.g. the settings and the contents of a layer).
+
+  Returns:
+    A string suitable as the key name of a KMLDependency.
+  """
+  name = ':'.join(str(i) for i in key.to_path())
+  if aspect: name += '/' + aspect
+  return name
+
+
+def GetKMLGenerations(names, cache=None):
+  """Looks up the current generations of a list of KML dependencies.
+
+  Generations already in cache['kml_generations'] are reused; the rest are
+  loaded with batched gets and added there.
+
+  Args:
+    names: A list of dependency names, as returned by GetKMLDependencyName().
+    cache: An optional collections.defaultdict to use as a cache.
+
+  Returns:
+    A dictionary mapping each of the names to its current generation.
+  """
+  if cache is None:
+    known = {}
+  else:
+    known = cache['kml_generations']
+  missing = list(set(i for i in names if i not in known))
+  for start in xrange(0, len(missing), _MAX_BATCH_SIZE):
+    batch = missing[start:start + _MAX_BATCH_SIZE]
+    for name, dependency in zip(batch, KMLDependency.get_by_key_name(batch)):
+      known[name] = dependency and dependency.generation or 0
+  return dict((i, known[i]) for i in names)
+
+
+def BumpKMLGeneration(name, cache=None):
+  """Invalidates the cached KML fragments that rely on a KML dependency.
+
+  Args:
+    name: The name of the dependency, as returned by GetKMLDependencyName().
+    cache: An optional collections.defaultdict used as a cache. The new
+        generation replaces the one in cache['kml_generations'], so that
+        fragments checked later with the same cache are not taken as valid.
+  """
+
+  def Bump():
+    dependency = (KMLDependency.get_by_key_name(name) or
+                  KMLDependency(key_name=name))
+    dependency.generation += 1
+    dependency.put()
+    return dependency.generation
+  generation = db.run_in_transaction(Bump)
+  if cache is not None:
+    cache['kml_generations'][name] = generation
+
+
+def PrefetchKMLDependencies(items, cache):
+  """Loads the KML generations that a list of items rely on at once.
+
+  Only the dependencies of items that have cached KML are looked up, so that
+  the HasValidKMLCache() checks of all the items are answered from
+  cache['kml_generations'] after a single batched lookup.
+
+  Args:
+    items: An iterable of models. Anything without a GetKMLDependencies()
+        method is ignored.
+    cache: The collections.defaultdict in which to keep the generations.
+  """
+  names = []
+  for item in items:
+    if getattr(item, 'cached_kml', None) and hasattr(item,
+                                                     'GetKMLDependencies'):
+      names += item.GetKMLDependencies()
+  GetKMLGenerations(names, cache)
+
+
+def RecordKMLDependencies(instance, cache):
+  """Records the current generations of the KML dependencies of an object.
+
+  Must be called before the object's KML is generated, so that a change made
+  while generating it invalidates the result.
+
+  Args:
+    instance: A Style, Folder, Link, Division or Entity.
+    cache: The collections.defaultdict used as a cache, or None.
+  """
+  generations = GetKMLGenerations(instance.GetKMLDependencies(), cache)
+  instance.kml_dependencies = ['%s=%d' % i for i in sorted(generations.items())]
+
+
+def _HasValidKMLCache(instance, cache):
+  """Returns whether an object's cached_kml is up to date.
+
+  Args:
+    instance: A Style, Folder, Link, Division or Entity.
+    cache: The collections.defaultdict used as a cache, or None.
+
+  Returns:
+    Whether the object has cached KML, its layer is cacheable, and the
+    generations recorded by RecordKMLDependencies() are still current.
+  """
+  if not instance.cached_kml or not instance.kml_dependencies:
+    return False
+  elif instance.layer.uncacheable:
+    return False
+  else:
+    generations = GetKMLGenerations(instance.GetKMLDependencies(), cache)
+    current = ['%s=%d' % i for i in sorted(generations.items())]
+    return current == instance.kml_dependencies
+
+
+def _GetCounterShardKeys(name):
+  """Returns the keys of all the shards of the named counter."""
+  return [db.Key.from_path('CounterShard', '%s:%d' % (name, i))
+          for i in xrange(settings.COUNTER_SHARDS)]
+
+
+def IncrementCounter(name, delta=1):
+  """Adds a value to a sharded counter.
+
+  Updates a single random shard in a transaction, so that any number of
+  requests can update the same counter at the same time.
+
+  Args:
+    name: The name of the counter.
+    delta: The value to add.
+  """
+  key_name = '%s:%d' % (name, random.randrange(settings.COUNTER_SHARDS))
+
+  def Increment():
+    shard = CounterShard.get_by_key_name(key_name)
+    if shard is None:
+      shard = CounterShard(key_name=key_name)
+    shard.count += delta
+    shard.put()
+  db.run_in_transaction(Increment)
+
+
+def GetCounter(name):
+  """Returns the value of a sharded counter. Counters start at 0."""
+  shards = db.get(_GetCounterShardKeys(name))
+  return sum(shard.count for shard in shards if shard)
+
+
+def GetCounters(names):
+  """Returns the values of several sharded counters with a single batch get.
+
+  Args:
+    names: A list of counter names.
+
+  Returns:
+    A list of the values of the counters, in the same order as names.
+  """
+  keys = []
+  for name in names:
+    keys += _GetCounterShardKeys(name)
+  shards = db.get(keys)
+  values = []
+  for start in xrange(0, len(shards), settings.COUNTER_SHARDS):
+    counter_shards = shards[start:start + settings.COUNTER_SHARDS]
+    values.append(sum(shard.count for shard in counter_shards if shard))
+  return values
+
+
+def ResetCounter(name):
+  """Resets a sharded counter to 0 by deleting its shards."""
+  db.delete(_GetCounterShardKeys(name))
+
+
+def UpdateGeocellCounts(layer, added=(), removed=()):
+  """Updates the geocell counts of a layer for entities added or removed.
+
+  Sums up the change of every geocell affected and applies them all with
+  batched gets and puts. Along with the counts, keeps the sums of the entities'
+  coordinates, from which GetGeocellAggregates() finds their centroids, and the
+  numbers of entities not flagged as baked. An entity that moved is passed both
+  as removed, with its old geocells, and as added, with its new ones, so the
+  geocells it did not leave or enter only have their sums adjusted. Entities
+  without a location are not counted.
+
+  Args:
+    layer: The layer to which the entities belong.
+    added: The entities added to the layer, as saved.
+    removed: The entities removed from the layer, as they were before.
+  """
+  deltas = collections.defaultdict(lambda: [0, 0, 0.0, 0.0])
+  for entities, sign in ((added, 1), (removed, -1)):
+    for entity in entities:
+      for cell in entity.location_geocells[:settings.GEOCELL_COUNT_RESOLUTION]:
+        delta = deltas[cell]
+        delta[0] += sign
+        if not entity.baked:
+          delta[1] += sign
+        delta[2] += sign * entity.location.lat
+        delta[3] += sign * entity.location.lon
+
+  def Apply(count, delta):
+    delta_count, delta_unbaked, delta_latitude, delta_longitude = delta
+    count.count = max(count.count + delta_count, 0)
+    count.unbaked = min(max(count.unbaked + delta_unbaked, 0), count.count)
+    if count.count:
+      count.latitude_sum += delta_latitude
+      count.longitude_sum += delta_longitude
+    else:
+      count.latitude_sum = count.longitude_sum = 0.0
+
+  changed = dict((cell, delta) for cell, delta in deltas.iteritems()
+                 if delta != [0, 0, 0, 0])
+  _ApplyGeocellDeltas(layer, changed, Apply, True)
+
+
+def MarkGeocellsBaked(layer, locations):
+  """Decrements the unbaked counts of the geocells of newly baked entities.
+
+  Must be called before the entities are flagged as baked, so that a baking
+  step interrupted in between, and repeated, decrements them again rather than
+  not at all. The unbaked counts may then end up too low, but never too high.
+
+  Args:
+    layer: The layer to which the entities belong.
+    locations: The db.GeoPt locations of the entities. None values are
+        ignored.
+  """
+  deltas = collections.defaultdict(int)
+  for location in locations:
+    if location:
+      cell = geocell.compute(location, settings.GEOCELL_COUNT_RESOLUTION)
+      for resolution in xrange(1, len(cell) + 1):
+        deltas[cell[:resolution]] += 1
+
+  def Apply(count, delta):
+    count.unbaked = max(count.unbaked - delta, 0)
+
+  _ApplyGeocellDeltas(layer, deltas, Apply, False)
+
+
+def _ApplyGeocellDeltas(layer, deltas, apply_delta, create_missing):
+  """Applies changes to the geocell counts of a layer with batched writes.
+
+  Args:
+    layer: The layer whose counts to change.
+    deltas: A dictionary mapping geocells to the changes of their counts.
+    apply_delta: A function that takes a GeocellCount and a change, and
+        applies the latter to the former.
+    create_missing: Whether to create the counts of geocells that have never
+        been counted, rather than skip them.
+  """
+  cells = deltas.keys()
+  counts = []
+  for start in xrange(0, len(cells), _MAX_BATCH_SIZE):
+    batch = cells[start:start + _MAX_BATCH_SIZE]
+    key_names = [GeocellCount.GetKeyName(layer, i) for i in batch]
+    for cell, key_name, count in zip(batch, key_names,
+                                     GeocellCount.get_by_key_name(key_names)):
+      if count is None:
+        if not create_missing:
+          continue
+        count = GeocellCount(key_name=key_name, layer=layer)
+      apply_delta(count, deltas[cell])
+      counts.append(count)
+  for start in xrange(0, len(counts), _MAX_PUT_BATCH_SIZE):
+    db.put(counts[start:start + _MAX_PUT_BATCH_SIZE])
+
+
+def GetGeocellCounts(layer, cells):
+  """Returns the numbers of entities of a layer in some geocells.
+
+  Args:
+    layer: The layer whose entities to count.
+    cells: A list of geocell strings, at most settings.GEOCELL_COUNT_RESOLUTION
+        characters long.
+
+  Returns:
+    A list of the numbers of entities in each geocell, in the same order as
+    cells. Geocells that have never been counted have 0 entities.
+  """
+  return [count for count, _ in GetGeocellAggregates(layer, cells)]
+
+
+def GetGeocellAggregates(layer, cells):
+  """Returns the numbers and centroids of the entities of a layer in geocells.
+
+  Args:
+    layer: The layer whose entities to count.
+    cells: A list of geocell strings, at most settings.GEOCELL_COUNT_RESOLUTION
+        characters long.
+
+  Returns:
+    A list of (count, centroid) tuples for each geocell, in the same order as
+    cells, where centroid is a db.GeoPt, or None for geocells without
+    entities.
+  """
+  values = []
+  for count in _GetGeocellCountObjects(layer, cells):
+    if count:
+      values.append((count.count, count.GetCentroid()))
+    else:
+      values.append((0, None))
+  return values
+
+
+def GetUnbakedGeocellCounts(layer, cells):
+  """Returns the numbers of entities of a layer not baked yet in some geocells.
+
+  Args:
+    layer: The layer whose entities to count.
+    cells: A list of geocell strings, at most settings.GEOCELL_COUNT_RESOLUTION
+        characters long.
+
+  Returns:
+    A list of the numbers of unbaked entities in each geocell, in the same
+    order as cells. Geocells that have never been counted have 0 entities.
+  """
+  return [count and count.unbaked or 0
+          for count in _GetGeocellCountObjects(layer, cells)]
+
+
+def _GetGeocellCountObjects(layer, cells):
+  """Loads the GeocellCount objects of some geocells with batched gets.
+
+  Args:
+    layer: The layer whose counts to load.
+    cells: A list of geocell strings.
+
+  Returns:
+    A list of GeocellCount objects, in the same order as cells, with None for
+    geocells that have never been counted.
+  """
+  counts = []
+  for start in xrange(0, len(cells), _MAX_BATCH_SIZE):
+    key_names = [GeocellCount.GetKeyName(layer, i)
+                 for i in cells[start:start + _MAX_BATCH_SIZE]]
+    counts += GeocellCount.get_by_key_name(key_names)
+  return counts
+
+
 class Entity(geomodel.GeoModel, db.Expando):
   """A Datastore expando model for entity objects.
 
   Explicit Properties:
     layer: A reference to the layer to which this entity belongs.
-    layer_timestamp: The last modified timestamp of the layer that contains this
-        entity.
     name: The name of the entity as it shows up in the editor and in Google
         Earth.
     geometries: A list of IDs of Geometry objects that belong to this entity.
@@ -1452,12 +3081,8 @@ class Entity(geomodel.GeoModel, db.Expando):
         higher ones.
     template: A reference to the template which this entity uses, and indirectly
         to the schema which the template belongs to.
-    template_timestamp: The last modified timestamp of the template used by this
-        entity.
     style: A reference to the style which is applied to the entity.
     region: The Region that controls when this entity is shown or hidden.
-    region_timestamp: The last modified timestamp of the region used by this
-        entity.
     view_location: The latitude and longitude of the point to which the camera
         points when displaying this entity.
     view_altitude: The altitude of the point to which the camera points when
@@ -1483,6 +3108,8 @@ class Entity(geomodel.GeoModel, db.Expando):
         non-auto-managed layers.
     cached_kml: The cached KML representation of the entity. This should be
         reset to None whenever the entity is updated.
+    kml_dependencies: The KML dependencies of cached_kml, with the generations
+        they had when it was generated. See RecordKMLDependencies().
 
   GeoModel Properties:
     location: The location of the centerpoint of this model's geometry.
@@ -1495,17 +3122,14 @@ class Entity(geomodel.GeoModel, db.Expando):
   """
 
   layer = db.ReferenceProperty(Layer, required=True)
-  layer_timestamp = db.DateTimeProperty()
   name = db.StringProperty(required=True, indexed=False)
   geometries = db.ListProperty(int)
   snippet = db.StringProperty(indexed=False, multiline=True)
   folder = db.ReferenceProperty(Folder)
   folder_index = db.IntegerProperty()
   template = db.ReferenceProperty(Template)
-  template_timestamp = db.DateTimeProperty()
   style = db.ReferenceProperty(Style)
   region = db.ReferenceProperty(Region)
-  region_timestamp = db.DateTimeProperty()
 
   view_location = db.GeoPtProperty(indexed=False)
   view_altitude = db.FloatProperty(indexed=False)
@@ -1519,9 +3143,31 @@ class Entity(geomodel.GeoModel, db.Expando):
   baked = db.BooleanProperty()
 
   cached_kml = db.TextProperty()
+  kml_dependencies = db.StringListProperty(indexed=False)
 
   bounding_box_fetch = staticmethod(geomodel.GeoModel.bounding_box_fetch)
 
+  # Properties that older versions of the model stored on every entity. Being
+  # an expando, the model would otherwise keep them as dynamic properties.
+  OBSOLETE_PROPERTIES = ('layer_timestamp', 'template_timestamp',
+                         'region_timestamp')
+
+  @classmethod
+  def from_entity(cls, entity):
+    """Loads an entity, leaving out its OBSOLETE_PROPERTIES.
+
+    They are then dropped from the datastore the next time it is saved.
+
+    Args:
+      entity: The datastore_types.Entity to load.
+
+    Returns:
+      The Entity instance.
+    """
+    for name in cls.OBSOLETE_PROPERTIES:
+      if name in entity: del entity[name]
+    return super(Entity, cls).from_entity(entity)
+
   def GenerateKML(self, cache=None):
     """Serializes the object as one or more KML Features.
 
@@ -1546,19 +3192,55 @@ class Entity(geomodel.GeoModel, db.Expando):
     Raises:
       ValueError: If the entity has no geometries.
     """
-    if (not self.cached_kml or
-        self.layer.uncacheable or
-        self.layer.timestamp != self.layer_timestamp or
-        (self.region and self.region.timestamp != self.region_timestamp) or
-        (self.template and self.template.timestamp != self.template_timestamp)):
-      kml = ForceIntoUnicode(self._DoGenerateKML(cache))
-      self.cached_kml = kml
-      self.layer_timestamp = self.layer.timestamp
-      if self.region: self.region_timestamp = self.region.timestamp
-      if self.template: self.template_timestamp = self.template.timestamp
-      if not self.layer.uncacheable: self.put()
+    if not self.HasValidKMLCache(cache):
+      RecordKMLDependencies(self, cache)
+      self.cached_kml = ForceIntoUnicode(self._DoGenerateKML(cache))
+      if not self.layer.uncacheable: _SaveCacheFill(self, cache)
     return self.cached_kml
 
+  def HasValidKMLCache(self, cache=None):
+    """Returns whether cached_kml is up to date with the entity's references."""
+    return _HasValidKMLCache(self, cache)
+
+  def GetKMLDependencies(self):
+    """Returns the names of the KML dependencies of the entity.
+
+    These are the settings of its layer, its region and its template. Styles
+    are only referenced by ID, so the entity's KML does not depend on them.
+    """
+    names = [GetKMLDependencyName(Entity.layer.get_value_for_datastore(self))]
+    for reference in (Entity.region, Entity.template):
+      key = reference.get_value_for_datastore(self)
+      if key: names.append(GetKMLDependencyName(key))
+    return names
+
+  def GetGeometryKeys(self):
+    """Returns the datastore keys of the entity's geometries, in order."""
+    return [db.Key.from_path(Geometry.kind(), i, parent=self.key())
+            for i in self.geometries]
+
+  def GetGeometries(self, cache=None):
+    """Gets the entity's geometries.
+
+    Geometries preloaded by PrefetchGeometries() are taken from the cache. The
+    rest are loaded in a single batch get.
+
+    Args:
+      cache: An optional collections.defaultdict to use as a cache.
+
+    Returns:
+      A list of the entity's Geometry objects, in order.
+    """
+    keys = self.GetGeometryKeys()
+    if cache is not None:
+      prefetched = cache['geometries']
+    else:
+      prefetched = {}
+    missing = [i for i in keys if i not in prefetched]
+    if missing:
+      prefetched.update(zip(missing, db.get(missing)))
+    return [prefetched[i] for i in keys]
+
   def _DoGenerateKML(self, cache):
     """Actually implements KML generation as described in GenerateKML()."""
     if not self.geometries:
@@ -1568,10 +3250,12 @@ class Entity(geomodel.GeoModel, db.Expando):
     if not self.layer.dynamic_balloons and self.template:
       description = self.template.Evaluate(self, cache)
 
-    args = {'entity': self, 'description': description}
+    region_kml = _GenerateRegionKML(self, cache)
+    args = {'entity': self, 'description': description,
+            'region_kml': region_kml}
     feature_details = ForceIntoUnicode(_RenderKMLTemplate('entity.kml', args))
 
-    geometries = [Geometry.get_by_id(i, parent=self) for i in self.geometries]
+    geometries = self.GetGeometries(cache)
 
     kml_geometries = [i for i in geometries if isinstance(i, KMLGeometry)]
     overlays = [i for i in geometries if not isinstance(i, KMLGeometry)]
@@ -1595,7 +3279,7 @@ class Entity(geomodel.GeoModel, db.Expando):
 
     if overlays:
       # Make sure only the first Feature has a balloon.
-      args = {'entity': self, 'description': ''}
+      args = {'entity': self, 'description': '', 'region_kml': region_kml}
       feature_details = _RenderKMLTemplate('entity.kml', args)
 
       overlays_kml = []
@@ -1638,9 +3322,32 @@ class Entity(geomodel.GeoModel, db.Expando):
       self.delete()
     db.run_in_transaction(Delete)
 
-  def ClearCache(self):
-    """Clears the cached KML representation of this entity."""
-    self.layer.ClearCache()
+  def RemoveFromDivisions(self):
+    """Removes the entity from the divisions it was baked into.
+
+    Clears the cached KML of each affected division. The caller is responsible
+    for clearing the entity's baked flag, so that it is served from the layer
+    document until it is placed again by an incremental bake.
+    """
+    entity_id = self.key().id()
+    layer_key = Entity.layer.get_value_for_datastore(self)
+    divisions = Division.all().filter('layer', layer_key)
+    divisions = divisions.filter('entities', entity_id).fetch(1000)
+    for division in divisions:
+      division.entities = [i for i in division.entities if i != entity_id]
+      division.cached_kml = None
+    if divisions:
+      db.put(divisions)
+      ClearMemcachedKML(layer_key.id())
+
+  def ClearCache(self, cache=None):
+    """Clears the cached KML representation of this entity.
+
+    Args:
+      cache: The collections.defaultdict used for the current request, if any,
+          so that the KML generations it holds are kept up to date.
+    """
+    self.layer.ClearCache(cache)
     if self.cached_kml:
       self.cached_kml = None
       self.put()
@@ -50,13 +50,18 @@ MAX_ICON_SIZE = 64
 MIN_THUMBNAIL_SIZE = 16
 # The maximum height or width, in pixels, accepted in thumbnailing requests.
 MAX_THUMBNAIL_SIZE = 512
+# The thumbnail sizes generated right after an image or icon is uploaded, by
+# resource type. These are the sizes requested by the editor's icon pickers and
+# resource lists. Other sizes are generated on first request.
+PREGENERATED_THUMBNAIL_SIZES = {'icon': [16], 'image': [100, 200]}
 
 #########################  Handler Name-Action Tables  #########################
 # Commands that use GET requests mapped to the methods that implement them.
 GET_COMMANDS = {
     'form': 'ShowForm',
     'raw': 'ShowRaw',
-    'list': 'ShowList'
+    'list': 'ShowList',
+    'status': 'ShowStatus'
 }
 # Commands that use POST requests mapped to the methods that implement them.
 POST_COMMANDS = {
@@ -64,9 +69,46 @@ POST_COMMANDS = {
     'delete': 'Delete',
     'update': 'Update',
     'move': 'Move',
-    'bulk': 'BulkCreate'
+    'bulk': 'BulkCreate',
+    'migrate': 'Migrate'
 }
 
+###############################  KML Generation  ###############################
+# Whether to serialize Point, LineString and Polygon geometries with the
+# hand-written serializers in model.py instead of their Django templates. Both
+# produce identical output; the serializers are much faster.
+USE_COMPILED_GEOMETRY_SERIALIZERS = True
+
+################################  KML Serving  #################################
+# The largest number of bytes of a served KML or KMZ document to keep in a
+# single memcache value. Larger documents are split into several values to stay
+# under memcache's item size limit.
+MEMCACHE_CHUNK_SIZE = 950000
+# The number of seconds for which clients may use served KML without checking
+# back with the server. Revalidation with If-None-Match or If-Modified-Since is
+# answered without loading or sending the KML unless it has changed. Not used
+# for uncacheable layers.
+KML_MAX_AGE = 0
+# The maximum number of entities, highest priority first, in the KML served for
+# a viewport of a layer with a dynamic viewport.
+VIEW_MAX_ENTITIES = 200
+# The number of steps into which a viewport is divided along its longer side
+# when it is snapped outwards to a grid before its KML is looked up in or stored
+# to memcache. Each step is a power of two degrees, so slightly different views
+# at about the same zoom share one memcached document.
+VIEW_GRID_STEPS = 8
+# The number of seconds after the camera stops before Earth requests the KML of
+# the new viewport, and between refreshes of the KML of a standing viewport.
+VIEW_REFRESH_TIME = 1
+VIEW_REFRESH_INTERVAL = 30
+
+##############################  Geometry Storage  ##############################
+# Whether to store the coordinates and altitudes of LineString and Polygon
+# geometries as blobs of packed doubles rather than as lists of individual
+# values. Geometries stored either way can always be read. Existing geometries
+# are converted by posting a task to /entity-continue-migrate/0.
+PACK_GEOMETRY_COORDINATES = True
+
 ###########################  Default Baker Settings  ###########################
 # The default soft maximum for the number of entities per Division. Used when a
 # layer does not specify division size.
@@ -75,8 +117,42 @@ DEFAULT_DIVISION_SIZE = 100
 # steps, relative to the soft maximum set by the layer or DEFAULT_DIVISION_SIZE.
 # If soft maximum = 42, growth limit = 0.5, then hard maximum = 42+42*0.5 = 63.
 DIVISION_SIZE_GROWTH_LIMIT = 0.5
-# The number of seconds to wait between two successive baker monitoring tasks.
-BAKER_MONITOR_DELAY = 5
+# The number of seconds between two successive checks of the baking watchdog.
+# Baking normally finishes as soon as the last subdivide task completes. If no
+# subdivide task has completed between two checks, baking is considered stalled
+# and the stall is reported, but the served divisions are left as they are.
+BAKER_MONITOR_DELAY = 300
+# The maximum number of entities that were not assigned to any division to
+# list in the report of a finished baking run.
+BAKER_RECONCILE_LIMIT = 100
+# The number of shards of each sharded counter used to track baking progress.
+# More shards allow more subdivide tasks to update them at the same time.
+COUNTER_SHARDS = 20
+# The number of consecutive entity keys cleared by a single setup shard before
+# baking. The shards run in parallel. Must be at most 1000.
+BAKER_SETUP_SHARD_SIZE = 1000
+# The number of seconds for which the divisions replaced by a baking run are
+# kept after the switch, so that clients holding links into the old division
+# tree can still follow them until they reload the layer.
+BAKER_COLLECT_DELAY = 900
+# The number of divisions whose KML is generated together by the render stage
+# after baking. The entities of a batch are loaded with shared batched gets,
+# so larger batches take fewer datastore round trips but longer tasks.
+BAKER_RENDER_BATCH_SIZE = 10
+# The longest geocell prefix for which the entities of each layer are counted.
+# The baker decides whether to split a division and where from the counts of
+# entities not placed yet, and makes cluster placemarks from the totals. Each
+# entity saved updates one count per prefix.
+GEOCELL_COUNT_RESOLUTION = 6
+# The maximum number of geocells into which the region of a subdivide step is
+# cut to read its counts. Only those entirely inside the region are used, so
+# more geocells let more regions be split without fetching the entities left
+# over, at the cost of larger batch gets.
+BAKER_COUNT_CELLS = 256
+# The maximum number of geocells into which the region of a division is cut
+# for its cluster placemarks, in layers that show them. Each geocell that holds
+# entities becomes one placemark.
+BAKER_CLUSTER_CELLS = 16
 
 #########################  Dynamic Balloon Placeholder  ########################
 # The placeholder ID for flyTo links that is used when serving dynamic balloons.
@@ -18,23 +18,101 @@
 
 layermanager.baker = {};
 
-/** Sets up handler for the Bake button. */
+/**
+ * How often to refresh the baking progress panel while baking, in milliseconds.
+ * @type {number}
+ * @const
+ */
+layermanager.baker.STATUS_REFRESH_INTERVAL = 10000;
+
+/**
+ * Sets up handlers for the Bake, Update Baked Layer and Recount Entities
+ * buttons, and fills the baking progress panel.
+ */
 layermanager.baker.initialize = function() {
   jQuery('#bake').click(function() {
-    jQuery(this).attr('disabled', true);
-    jQuery.ajax({
-      type: 'POST',
-      url: '/baker-create/' + layermanager.resources.layer.id,
-      complete: function(xhr) {
-        if (xhr.status >= 200 && xhr.status < 300) {
-          jQuery('#bake_message').text('Layer baking started successfully.');
-        } else {
-          jQuery('#bake').attr('disabled', false);
-          jQuery('#bake_message').html('Layer baking could not be started.' +
-                                       '<br />' + xhr.responseText);
-        }
+    layermanager.baker.start(false);
+  });
+  jQuery('#bake_incremental').click(function() {
+    layermanager.baker.start(true);
+  });
+  jQuery('#bake_recount').click(layermanager.baker.recount);
+  if (jQuery('#bake_status').length) layermanager.baker.refreshStatus();
+};
+
+/**
+ * Fills the baking progress panel with the current status of the layer, and
+ * schedules another refresh if the layer is still being baked.
+ */
+layermanager.baker.refreshStatus = function() {
+  var url = '/baker-status/' + layermanager.resources.layer.id;
+  jQuery.getJSON(url, function(status) {
+    var eta = '';
+    if (status.eta !== null) {
+      eta = Math.floor(status.eta / 60) + 'm ' + (status.eta % 60) + 's';
+    }
+    jQuery('#bake_status_state').text(status.busy ? 'Baking' : 'Idle');
+    jQuery('#bake_status_divisions').text(status.divisions);
+    jQuery('#bake_status_assigned').text(
+        status.assigned + ' of ' + status.entities);
+    jQuery('#bake_status_remaining').text(status.remaining);
+    jQuery('#bake_status_in_flight').text(status.tasks_in_flight);
+    jQuery('#bake_status_retried').text(status.tasks_retried);
+    jQuery('#bake_status_rate').text(status.entities_per_second.toFixed(1));
+    jQuery('#bake_status_eta').text(eta);
+    jQuery('#bake_status_rendered').text(status.rendered);
+    if (status.busy) {
+      window.setTimeout(layermanager.baker.refreshStatus,
+                        layermanager.baker.STATUS_REFRESH_INTERVAL);
+    }
+  });
+};
+
+/**
+ * Starts baking the current layer.
+ * @param {boolean} incremental Whether to only place the entities added or
+ *     changed since the layer was last baked.
+ */
+layermanager.baker.start = function(incremental) {
+  var buttons = jQuery('#bake, #bake_incremental');
+  buttons.attr('disabled', true);
+  jQuery.ajax({
+    type: 'POST',
+    url: '/baker-create/' + layermanager.resources.layer.id,
+    data: incremental ? {incremental: 1} : {},
+    complete: function(xhr) {
+      if (xhr.status >= 200 && xhr.status < 300) {
+        jQuery('#bake_message').text('Layer baking started successfully.');
+        layermanager.baker.refreshStatus();
+      } else {
+        buttons.attr('disabled', false);
+        jQuery('#bake_message').html('Layer baking could not be started.' +
+                                     '<br />' + xhr.responseText);
+      }
+    }
+  });
+};
+
+/**
+ * Starts rebuilding the per-geocell entity counts of the current layer, which
+ * the baker uses to estimate how many entities each region holds.
+ */
+layermanager.baker.recount = function() {
+  var button = jQuery('#bake_recount');
+  button.attr('disabled', true);
+  jQuery.ajax({
+    type: 'POST',
+    url: '/baker-create/' + layermanager.resources.layer.id,
+    data: {recount: 1},
+    complete: function(xhr) {
+      button.attr('disabled', false);
+      if (xhr.status >= 200 && xhr.status < 300) {
+        jQuery('#bake_message').text('Entity recount started successfully.');
+      } else {
+        jQuery('#bake_message').html('Entity recount could not be started.' +
+                                     '<br />' + xhr.responseText);
       }
-    });
+    }
   });
 };
 
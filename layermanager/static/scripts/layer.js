@@ -31,11 +31,14 @@ layermanager.layer.collectFields = function() {
     item_type: jQuery('#item_type').val(),
     auto_managed: jQuery('#auto_managed').attr('checked') ? '1' : '',
     division_size: jQuery('#division_size').val(),
+    division_split: jQuery('#division_split').val(),
+    division_clusters: jQuery('#division_clusters').attr('checked') ? '1' : '',
     division_lod_min: jQuery('#division_lod_min').val(),
     division_lod_min_fade: jQuery('#division_lod_min_fade').val(),
     division_lod_max: jQuery('#division_lod_max').val(),
     division_lod_max_fade: jQuery('#division_lod_max_fade').val(),
     dynamic_balloons: jQuery('#dynamic_balloons').attr('checked') ? '1' : '',
+    dynamic_viewport: jQuery('#dynamic_viewport').attr('checked') ? '1' : '',
     compressed: jQuery('#compressed').attr('checked') ? '1' : '',
     uncacheable: jQuery('#uncacheable').attr('checked') ? '1' : '',
     custom_kml: jQuery('#custom_kml').val()
@@ -101,7 +104,7 @@ layermanager.layer.initialize = function() {
   jQuery('#layer_delete').click(layermanager.layer.destroy);
   jQuery('#auto_managed').click(layermanager.layer.refreshRegionationVisibility);
 
-  layermanager.ui.initIntegerField(jQuery('#regionation_settings input'));
+  layermanager.ui.initIntegerField(jQuery('#regionation_settings input:text'));
   if (layermanager.resources.layer.id) {
     jQuery('#layer_create').hide();
     layermanager.ui.visualizeIconSelect(jQuery('.icon-selector'));
@@ -18,7 +18,9 @@
 
 
 import cgi
+import itertools
 from google.appengine.ext.webapp import template
+import util
 
 
 register = template.create_template_register()
@@ -29,7 +31,7 @@ def FormatCoordinates(points, altitudes=None):
   """Formats a list of points into a KML coordinates string.
 
   Args:
-    points: A list of db.GeoPt objects.
+    points: A list of db.GeoPt objects or a util.CoordinateArray.
     altitudes: An optional list of altitude values. If specified and non-empty,
         must be of the same length as points.
 
@@ -40,15 +42,17 @@ def FormatCoordinates(points, altitudes=None):
     ValueError: If the number of the altitudes is not equal to the number of
         points.
   """
-  if altitudes:
+  if isinstance(points, util.CoordinateArray):
+    return points.FormatKML(altitudes)
+  elif altitudes:
     if len(points) != len(altitudes):
       raise ValueError('Received %d altitudes. Expected %d.' %
                        (len(altitudes), len(points)))
-    coordinates = [(point.lon, point.lat, altitudes[i])
-                   for i, point in enumerate(points)]
+    coordinates = ['%s,%s,%s' % (point.lon, point.lat, altitude)
+                   for point, altitude in itertools.izip(points, altitudes)]
   else:
-    coordinates = [(i.lon, i.lat) for i in points]
-  return ' '.join(','.join(str(j) for j in i) for i in coordinates)
+    coordinates = ['%s,%s' % (i.lon, i.lat) for i in points]
+  return ' '.join(coordinates)
 
 
 @register.filter
@@ -18,10 +18,10 @@
 
 
 import httplib
+import StringIO
 import xml.dom.minidom
-import zipfile
-from google.appengine.api import images
 from google.appengine.ext import blobstore
+from google.appengine.ext import db
 from handlers import dump
 from lib.mox import mox
 import model
@@ -53,39 +53,231 @@ class DumpServerTest(mox.MoxTestBase):
     mock_division = self.mox.CreateMockAnything()
     mock_division.layer = self.mox.CreateMockAnything()
     mock_division.layer.compressed = object()
-    dummy_id = object()
     dummy_size = object()
 
     handler.request.get('resize', None).AndReturn(dummy_size)
     handler.request.arguments().AndReturn(['pretty'])
-    util.GetInstance(model.Division, dummy_id).AndReturn(mock_division)
-    handler.GetKML(mock_division, mock_division.layer.compressed, True)
+    util.GetInstance(model.Division, '5').AndReturn(mock_division)
+    handler.GetKML(mock_division, mock_division.layer.compressed, True, None)
+
+    self.mox.ReplayAll()
+    handler.get('0', 'k', '5')
+
+  def testGetDivisionKMLByPath(self):
+    handler = dump.DumpServer()
+    handler.request = self.mox.CreateMockAnything()
+    handler.response = self.mox.CreateMockAnything()
+    handler.response.out = StringIO.StringIO()
+    handler.GetKML = self.mox.CreateMockAnything()
+    handler.error = self.mox.CreateMockAnything()
+    layer = model.Layer(name='a', world='earth', auto_managed=True,
+                        baked=True, compressed=True, division_generation=2)
+    layer_id = layer.put().id()
+    division = model.Division(key_name=model.Division.GetKeyName(layer, 2,
+                                                                 'r1-3'),
+                              layer=layer, north=1.0, south=0.0, east=1.0,
+                              west=0.0, generation=2, baked=True)
+    division.put()
+
+    @mox.Func
+    def VerifyDivision(served_division):
+      self.assertEqual(served_division.key(), division.key())
+      return True
+
+    for _ in xrange(2):
+      handler.request.get('resize', None).AndReturn(None)
+      handler.request.get('compress', None).AndReturn(None)
+      handler.request.arguments().AndReturn(['pretty'])
+    handler.GetKML(VerifyDivision, True, True, None, None)
+    handler.error(httplib.BAD_REQUEST)
 
     self.mox.ReplayAll()
-    handler.get('0', 'k', dummy_id)
+    handler.get(str(layer_id), 'k', 'r1-3')
+    # Only the served generation is looked up.
+    layer.division_generation = 3
+    layer.put()
+    handler.get(str(layer_id), 'k', 'r1-3')
+
+  def testGetDivisionKMLOfAnotherLayer(self):
+    self.mox.StubOutWithMock(model, 'GetKMLValidators')
+    self.mox.StubOutWithMock(model, 'GetMemcachedKML')
+    self.mox.StubOutWithMock(model, 'GetKMLGeneration')
+    handler = dump.DumpServer()
+    handler.request = self.mox.CreateMockAnything()
+    handler.request.headers = {'If-None-Match': '"7"'}
+    handler.response = self.mox.CreateMockAnything()
+    handler.response.headers = {}
+    handler.GetKML = self.mox.CreateMockAnything()
+    layer = model.Layer(name='a', world='earth', compressed=True)
+    layer_id = layer.put().id()
+    other_layer_id = model.Layer(name='b', world='earth').put().id()
+    division = model.Division(layer=layer, north=1.0, south=0.0, east=1.0,
+                              west=0.0, baked=True)
+    division_id = division.put().id()
+
+    @mox.Func
+    def VerifyDivision(served_division):
+      self.assertEqual(served_division.key(), division.key())
+      return True
+
+    handler.request.get('resize', None).AndReturn(None)
+    handler.request.get('compress', None).AndReturn(None)
+    handler.request.arguments().AndReturn([])
+    model.GetKMLValidators(other_layer_id).AndReturn((7, 1234))
+    model.GetMemcachedKML('Division', division_id,
+                          other_layer_id).AndReturn(None)
+    model.GetKMLGeneration(other_layer_id).AndReturn(5)
+    # Neither the ETag nor the generation of the layer in the URL may answer
+    # for this division.
+    handler.GetKML(VerifyDivision, True, False, None, None)
+
+    self.mox.ReplayAll()
+    handler.get(str(other_layer_id), 'k', str(division_id))
+    self.assertEqual(handler.response.headers, {})
+
+  def testGetDivisionKMLReadsGenerationFirst(self):
+    self.mox.StubOutWithMock(model, 'GetKMLValidators')
+    self.mox.StubOutWithMock(model, 'GetMemcachedKML')
+    handler = dump.DumpServer()
+    handler.request = self.mox.CreateMockAnything()
+    handler.request.headers = {}
+    handler.GetKML = self.mox.CreateMockAnything()
+    layer = model.Layer(name='a', world='earth', compressed=True)
+    layer_id = layer.put().id()
+    division = model.Division(layer=layer, north=1.0, south=0.0, east=1.0,
+                              west=0.0, baked=True)
+    division_id = division.put().id()
+    calls = []
+
+    def GetKMLGeneration(generation_layer_id):
+      calls.append(('GetKMLGeneration', generation_layer_id))
+      return 5
+
+    def GetInstance(model_class, instance_id):
+      calls.append(('GetInstance', instance_id))
+      return model_class.get_by_id(int(instance_id))
+
+    self.stubs.Set(model, 'GetKMLGeneration', GetKMLGeneration)
+    self.stubs.Set(util, 'GetInstance', GetInstance)
+
+    @mox.Func
+    def VerifyDivision(served_division):
+      self.assertEqual(served_division.key(), division.key())
+      return True
+
+    handler.request.get('resize', None).AndReturn(None)
+    handler.request.get('compress', None).AndReturn(None)
+    handler.request.arguments().AndReturn([])
+    model.GetKMLValidators(layer_id).AndReturn((None, None))
+    model.GetMemcachedKML('Division', division_id, layer_id).AndReturn(None)
+    handler.GetKML(VerifyDivision, True, False, 5, None)
+
+    self.mox.ReplayAll()
+    handler.get(str(layer_id), 'k', str(division_id))
+    self.assertEqual(calls, [('GetKMLGeneration', layer_id),
+                             ('GetInstance', str(division_id))])
+
+  def testGetMemcachedDivisionKML(self):
+    self.mox.StubOutWithMock(model, 'GetMemcachedKML')
+    self.mox.StubOutWithMock(model, 'GetKMLValidators')
+    handler = dump.DumpServer()
+    handler.request = self.mox.CreateMockAnything()
+    handler.request.headers = {}
+    handler.response = self.mox.CreateMockAnything()
+    handler.response.headers = {}
+    handler.response.out = StringIO.StringIO()
+
+    handler.request.get('resize', None).AndReturn(None)
+    handler.request.get('compress', None).AndReturn(None)
+    handler.request.arguments().AndReturn([])
+    model.GetKMLValidators(3).AndReturn((7, 1234))
+    model.GetMemcachedKML('Division', 42, 3).AndReturn(('dummy', True))
+
+    self.mox.ReplayAll()
+    handler.get('3', 'k', '42')
+    self.assertEqual(handler.response.headers, {
+        'Content-Type': settings.KMZ_MIME_TYPE,
+        'Cache-Control': 'public, max-age=%d' % settings.KML_MAX_AGE,
+        'ETag': '"7"',
+        'Last-Modified': 'Thu, 01 Jan 1970 00:20:34 GMT'
+    })
+    self.assertEqual(handler.response.out.getvalue(), 'dummy')
+
+  def testGetNotModifiedKML(self):
+    self.mox.StubOutWithMock(model, 'GetKMLValidators')
+    self.mox.StubOutWithMock(util, 'GetInstance')
+    handler = dump.DumpServer()
+    handler.request = self.mox.CreateMockAnything()
+    handler.response = self.mox.CreateMockAnything()
+    handler.response.out = StringIO.StringIO()
+
+    for _ in xrange(2):
+      handler.request.get('resize', None).AndReturn(None)
+      handler.request.get('compress', None).AndReturn(None)
+      handler.request.arguments().AndReturn([])
+      model.GetKMLValidators(12).AndReturn((7, 1234))
+      handler.response.set_status(httplib.NOT_MODIFIED)
+
+    self.mox.ReplayAll()
+    for headers in ({'If-None-Match': '"6", "7"'},
+                    {'If-Modified-Since': 'Thu, 01 Jan 1970 00:20:34 GMT'}):
+      handler.request.headers = headers
+      handler.response.headers = {}
+      handler.get('12', None, None)
+      self.assertEqual(handler.response.headers['ETag'], '"7"')
+    self.assertEqual(handler.response.out.getvalue(), '')
+
+  def testIsNotModified(self):
+    handler = dump.DumpServer()
+    handler.request = self.mox.CreateMockAnything()
+    handler.response = self.mox.CreateMockAnything()
+    handler.response.headers = {}
+
+    self.mox.ReplayAll()
+    self.assertFalse(handler.IsNotModified(None))
+    handler.request.headers = {'If-None-Match': '"6-kml"'}
+    self.assertFalse(handler.IsNotModified(('"6"', 1234)))
+    # If-None-Match takes precedence over If-Modified-Since.
+    handler.request.headers['If-Modified-Since'] = (
+        'Thu, 01 Jan 1970 00:20:34 GMT')
+    self.assertFalse(handler.IsNotModified(('"6"', 1234)))
+    del handler.request.headers['If-None-Match']
+    self.assertFalse(handler.IsNotModified(('"6"', 1235)))
+    self.assertFalse(handler.IsNotModified(('"6"', None)))
+    handler.request.headers['If-Modified-Since'] = 'garbage'
+    self.assertFalse(handler.IsNotModified(('"6"', 1234)))
 
   def testGetLayerKML(self):
     self.mox.StubOutWithMock(util, 'GetInstance')
     handler = dump.DumpServer()
     handler.request = self.mox.CreateMockAnything()
     handler.GetKML = self.mox.CreateMockAnything()
+    handler.request.headers = {}
+    self.mox.StubOutWithMock(model, 'GetMemcachedKML')
+    self.mox.StubOutWithMock(model, 'GetKMLGeneration')
+    self.mox.StubOutWithMock(model, 'GetKMLValidators')
     mock_layer = self.mox.CreateMockAnything()
     mock_layer.auto_managed = False
     mock_layer.compressed = object()
-    dummy_layer_id = object()
     dummy_size = object()
+    dummy_generation = object()
 
     handler.request.get('resize', None).AndReturn(dummy_size)
     handler.request.arguments().AndReturn([])
-    util.GetInstance(model.Layer, dummy_layer_id).AndReturn(mock_layer)
-    handler.GetKML(mock_layer, mock_layer.compressed, False)
+    model.GetKMLValidators(12).AndReturn((5, None))
+    model.GetMemcachedKML('Layer', 12, None).AndReturn(None)
+    model.GetKMLGeneration(12).AndReturn(dummy_generation)
+    util.GetInstance(model.Layer, '12').AndReturn(mock_layer)
+    handler.GetKML(mock_layer, mock_layer.compressed, False, dummy_generation,
+                   ('"5"', None))
 
     self.mox.ReplayAll()
-    handler.get(dummy_layer_id, None, None)
+    handler.get('12', None, None)
 
   def testGetFailsOnUnbakedKML(self):
     handler = dump.DumpServer()
     handler.request = self.mox.CreateMockAnything()
+    handler.request.headers = {}
     handler.error = self.mox.CreateMockAnything()
     handler.response = self.mox.CreateMockAnything()
     handler.response.out = self.mox.CreateMockAnything()
@@ -134,31 +326,76 @@ class DumpServerTest(mox.MoxTestBase):
                      {'Content-Type': settings.KML_MIME_TYPE})
 
   def testShowRawCompressedLayer(self):
-    self.mox.StubOutWithMock(zipfile, 'ZipFile', use_mock_anything=True)
     handler = dump.DumpServer()
     handler.response = self.mox.CreateMockAnything()
     handler.response.headers = {}
-    handler.response.out = object()
+    handler.response.out = StringIO.StringIO()
     mock_layer = self.mox.CreateMock(model.Layer)
     mock_layer.compressed = True
-    mock_zipper = self.mox.CreateMockAnything()
+    mock_layer.uncacheable = False
 
-    @mox.Func
-    def VerifyZipInfo(zip_info):
-      self.assertEqual(zip_info.filename, 'doc.kml')
-      self.assertEqual(zip_info.external_attr, 0644 << 16)
-      return True
+    mock_layer.IterKMZ(mox.IgnoreArg()).AndReturn(iter(['a_dummy', '_kmz']))
+
+    self.mox.ReplayAll()
+    handler.GetKML(mock_layer, True, False, None, ('"3"', None))
+    self.assertEqual(handler.response.headers, {
+        'Content-Type': settings.KMZ_MIME_TYPE,
+        'Cache-Control': 'public, max-age=%d' % settings.KML_MAX_AGE,
+        'ETag': '"3"'
+    })
+    self.assertEqual(handler.response.out.getvalue(), 'a_dummy_kmz')
+
+  def testShowRawUncompressedLayer(self):
+    handler = dump.DumpServer()
+    handler.response = self.mox.CreateMockAnything()
+    handler.response.headers = {}
+    handler.response.out = self.mox.CreateMockAnything()
+    mock_layer = self.mox.CreateMock(model.Layer)
+    mock_layer.uncacheable = True
 
-    mock_layer.GenerateKML(mox.IgnoreArg()).AndReturn('a_dummy_string')
-    zipfile.ZipFile(
-        handler.response.out, 'w', zipfile.ZIP_DEFLATED).AndReturn(mock_zipper)
-    mock_zipper.writestr(VerifyZipInfo, 'a_dummy_string')
-    mock_zipper.close()
+    mock_layer.IterKML(mox.IgnoreArg()).AndReturn(iter(['a', 'b', 'c']))
+    handler.response.out.write('a')
+    handler.response.out.write('b')
+    handler.response.out.write('c')
 
     self.mox.ReplayAll()
-    handler.GetKML(mock_layer, True, False)
-    self.assertEqual(handler.response.headers,
-                     {'Content-Type': settings.KMZ_MIME_TYPE})
+    handler.GetKML(mock_layer, False, False, None, ('"3"', 1234))
+    # Uncacheable layers are never sent with validators.
+    self.assertEqual(handler.response.headers, {
+        'Content-Type': settings.KML_MIME_TYPE,
+        'Cache-Control': 'no-cache'
+    })
+
+  def testGetKMLStoresInMemcache(self):
+    self.mox.StubOutWithMock(model, 'SetMemcachedKML')
+    handler = dump.DumpServer()
+    handler.response = self.mox.CreateMockAnything()
+    handler.response.headers = {}
+    handler.response.out = StringIO.StringIO()
+    layer = model.Layer(name='a', world='earth')
+    layer.put()
+    division = model.Division(layer=layer, south=0.1, north=2.3, west=4.5,
+                              east=6.7, baked=True)
+    division.put()
+
+    model.SetMemcachedKML('Division', division.key().id(), layer.key().id(),
+                          123, mox.IgnoreArg(), False)
+    # Divisions with quad paths are stored under their layer and path.
+    named_division = model.Division(
+        key_name=model.Division.GetKeyName(layer, 1, 'r0'), layer=layer,
+        south=0.1, north=2.3, west=4.5, east=6.7, baked=True)
+    named_division.put()
+    model.SetMemcachedKML('Division', '%d:r0' % layer.key().id(),
+                          layer.key().id(), 123, mox.IgnoreArg(), False)
+
+    self.mox.ReplayAll()
+    handler.GetKML(division, False, False, 123)
+    handler.GetKML(named_division, False, False, 123)
+    # Nothing is stored without a generation or for uncacheable layers.
+    handler.GetKML(division, False, False)
+    layer.uncacheable = True
+    layer.put()
+    handler.GetKML(model.Division.get(division.key()), False, False, 123)
 
   def testGetResourceFailsWithNoResource(self):
     self.mox.StubOutWithMock(util, 'GetInstance')
@@ -256,7 +493,6 @@ class DumpServerTest(mox.MoxTestBase):
   def testGetThumbnail(self):
     self.mox.StubOutWithMock(util, 'GetInstance')
     self.mox.StubOutWithMock(blobstore, 'get')
-    self.mox.StubOutWithMock(images, 'Image')
     server = dump.DumpServer()
     server.error = self.mox.CreateMockAnything()
     server.send_blob = self.mox.CreateMockAnything()
@@ -265,7 +501,6 @@ class DumpServerTest(mox.MoxTestBase):
     server.response.out = self.mox.CreateMockAnything()
     mock_resource = self.mox.CreateMockAnything()
     mock_resource.blob = self.mox.CreateMockAnything()
-    mock_image = self.mox.CreateMockAnything()
     dummy_id = object()
     dummy_key = object()
     cache_headers = {
@@ -279,13 +514,11 @@ class DumpServerTest(mox.MoxTestBase):
     blobstore.get(dummy_key).AndReturn(object())
     server.send_blob(dummy_key, content_type=settings.COLLADA_MIME_TYPE)
 
-    # Size equal to the original; execute_transforms() returns an empty string.
+    # Size equal to the original; the thumbnail is an empty string.
     util.GetInstance(model.Resource, dummy_id).AndReturn(mock_resource)
     mock_resource.blob.key().AndReturn('abc')
     blobstore.get('abc').AndReturn(object())
-    images.Image(blob_key='abc').AndReturn(mock_image)
-    mock_image.resize(settings.MAX_THUMBNAIL_SIZE, settings.MAX_THUMBNAIL_SIZE)
-    mock_image.execute_transforms(output_encoding=images.PNG).AndReturn('')
+    mock_resource.GetThumbnail(settings.MAX_THUMBNAIL_SIZE).AndReturn('')
     server.send_blob('abc')
 
     # Invalid size, then overly large size.
@@ -294,13 +527,11 @@ class DumpServerTest(mox.MoxTestBase):
       mock_resource.blob.key().AndReturn(dummy_key)
       blobstore.get(dummy_key).AndReturn(object())
 
-    # Valid size and type; generate and write thumbnail.
+    # Valid size and type; write the thumbnail.
     util.GetInstance(model.Resource, dummy_id).AndReturn(mock_resource)
     mock_resource.blob.key().AndReturn('abc')
     blobstore.get('abc').AndReturn(object())
-    images.Image(blob_key='abc').AndReturn(mock_image)
-    mock_image.resize(settings.MAX_THUMBNAIL_SIZE, settings.MAX_THUMBNAIL_SIZE)
-    mock_image.execute_transforms(output_encoding=images.PNG).AndReturn('defgh')
+    mock_resource.GetThumbnail(settings.MAX_THUMBNAIL_SIZE).AndReturn('defgh')
     server.response.out.write('defgh')
 
     self.mox.ReplayAll()
@@ -329,3 +560,125 @@ class DumpServerTest(mox.MoxTestBase):
     server.GetResource(dummy_id, str(settings.MAX_THUMBNAIL_SIZE))
     cache_headers.update({'Content-Type': 'image/png'})
     self.assertEqual(server.response.headers, cache_headers)
+
+
+class ViewServerTest(mox.MoxTestBase):
+
+  def _CreateLayer(self, **kwargs):
+    layer = model.Layer(name='a', world='earth', auto_managed=True,
+                        dynamic_viewport=True, **kwargs)
+    layer.put()
+    for name, latitude, longitude in (('b', 3, 2), ('c', -30, -40)):
+      entity = model.Entity(layer=layer, name=name)
+      entity.put()
+      point = model.Point(location=db.GeoPt(latitude, longitude),
+                          parent=entity)
+      entity.geometries = [point.put().id()]
+      entity.UpdateLocation(point)
+      entity.put()
+    return layer
+
+  def _CreateHandler(self, bbox, compress=None):
+    handler = dump.ViewServer()
+    handler.request = self.mox.CreateMockAnything()
+    handler.request.headers = {}
+    handler.response = self.mox.CreateMockAnything()
+    handler.response.headers = {}
+    handler.response.out = StringIO.StringIO()
+    handler.request.get('compress', None).AndReturn(compress)
+    handler.request.get('BBOX').AndReturn(bbox)
+    return handler
+
+  def testGetViewKML(self):
+    self.mox.StubOutWithMock(model, 'GetKMLValidators')
+    self.mox.StubOutWithMock(model, 'GetMemcachedKML')
+    self.mox.StubOutWithMock(model, 'GetKMLGeneration')
+    self.mox.StubOutWithMock(model, 'SetMemcachedKML')
+    layer = self._CreateLayer(compressed=False)
+    layer_id = layer.key().id()
+    memcache_id = '%d:1.0,2.0,3.0,4.0' % layer_id
+    handler = self._CreateHandler('1.1,2,2.9,4')
+
+    model.GetKMLValidators(layer_id).AndReturn((7, None))
+    model.GetMemcachedKML('View', memcache_id, layer_id).AndReturn(None)
+    model.GetKMLGeneration(layer_id).AndReturn(8)
+    model.SetMemcachedKML('View', memcache_id, layer_id, 8, mox.IgnoreArg(),
+                          False)
+
+    self.mox.ReplayAll()
+    handler.get(str(layer_id))
+    self.assertEqual(handler.response.headers, {
+        'Content-Type': settings.KML_MIME_TYPE,
+        'Cache-Control': 'public, max-age=%d' % settings.KML_MAX_AGE,
+        'ETag': '"7"'
+    })
+    kml = handler.response.out.getvalue()
+    self.assertTrue('<name>b</name>' in kml)
+    self.assertFalse('<name>c</name>' in kml)
+
+  def testGetMemcachedViewKML(self):
+    self.mox.StubOutWithMock(model, 'GetKMLValidators')
+    self.mox.StubOutWithMock(model, 'GetMemcachedKML')
+    handler = self._CreateHandler('-180,-90,180,90')
+
+    model.GetKMLValidators(3).AndReturn((None, None))
+    model.GetMemcachedKML('View', '3:-180.0,-90.0,180.0,90.0', 3).AndReturn(
+        ('dummy', True))
+
+    self.mox.ReplayAll()
+    handler.get('3')
+    self.assertEqual(handler.response.headers, {
+        'Content-Type': settings.KMZ_MIME_TYPE,
+        'Cache-Control': 'public, max-age=%d' % settings.KML_MAX_AGE
+    })
+    self.assertEqual(handler.response.out.getvalue(), 'dummy')
+
+  def testGetUncompressedViewKML(self):
+    self.mox.StubOutWithMock(model, 'SetMemcachedKML')
+    layer = self._CreateLayer(compressed=True, uncacheable=True)
+    handler = self._CreateHandler('-180,-90,180,90', 'no')
+
+    # Neither looked up in nor stored to memcache.
+    self.mox.ReplayAll()
+    handler.get(str(layer.key().id()))
+    self.assertEqual(handler.response.headers, {
+        'Content-Type': settings.KML_MIME_TYPE,
+        'Cache-Control': 'no-cache'
+    })
+    kml = handler.response.out.getvalue()
+    self.assertTrue('<name>b</name>' in kml)
+    self.assertTrue('<name>c</name>' in kml)
+
+  def testGetViewKMLFailures(self):
+    layer = self._CreateLayer()
+    static_layer = model.Layer(name='d', world='earth', auto_managed=True,
+                               baked=True)
+    static_layer.put()
+    handlers = []
+    for bbox in ('', '1,2,3', '1,2,3,x', '1,5,3,4', '1,2,3,95'):
+      handlers.append((self._CreateHandler(bbox), layer,
+                       'Invalid bounding box specified.'))
+    handlers.append((self._CreateHandler('1,2,3,4'), static_layer,
+                     'This layer is not served by viewport.'))
+    for handler, _, _ in handlers:
+      handler.error = self.mox.CreateMockAnything()
+      handler.error(httplib.BAD_REQUEST)
+
+    self.mox.ReplayAll()
+    for handler, served_layer, message in handlers:
+      handler.get(str(served_layer.key().id()))
+      self.assertEqual(handler.response.out.getvalue(), message)
+
+  def testSnapViewport(self):
+    self.stubs.Set(settings, 'VIEW_GRID_STEPS', 8)
+    self.assertEqual(dump._SnapViewport(1.1, 2, 2.9, 4), (1, 2, 3, 4))
+    self.assertEqual(dump._SnapViewport(-16, -8, 16, 8), (-16, -8, 16, 8))
+    # Nearby viewports of about the same size snap to the same grid.
+    self.assertEqual(dump._SnapViewport(-15, -7, 17, 9), (-16, -8, 20, 12))
+    self.assertEqual(dump._SnapViewport(-180, -90, 180, 90),
+                     (-180, -90, 180, 90))
+    self.assertEqual(dump._SnapViewport(1, 1, 1, 1), (1, 1, 1, 1))
+    # Across the 180th meridian.
+    self.assertEqual(dump._SnapViewport(170, 0, -170, 10), (168, 0, -168, 12))
+    self.assertEqual(dump._SnapViewport(-100, 0, -110, 10),
+                     (-180, 0, 180, 64))
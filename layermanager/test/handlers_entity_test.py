@@ -20,11 +20,14 @@
 import StringIO
 from django.utils import simplejson as json
 from google.appengine import runtime
+from google.appengine.api import datastore
+from google.appengine.api.labs import taskqueue
 from google.appengine.ext import db
 from handlers import base
 from handlers import entity
 from lib.mox import mox
 import model
+import settings
 import util
 
 
@@ -72,9 +75,11 @@ class EntityHandlerTest(mox.MoxTestBase):
 
   def testDelete(self):
     self.mox.StubOutWithMock(util, 'GetInstance')
+    self.mox.StubOutWithMock(model, 'UpdateGeocellCounts')
     handler = entity.EntityHandler()
     handler.request = self.mox.CreateMockAnything()
     mock_entity = self.mox.CreateMock(model.Entity)
+    mock_entity.baked = True
     mock_layer = self.mox.CreateMockAnything()
     dummy_id = object()
 
@@ -82,6 +87,8 @@ class EntityHandlerTest(mox.MoxTestBase):
     handler.request.get('entity_id').AndReturn(dummy_id)
     util.GetInstance(model.Entity, dummy_id, mock_layer).AndReturn(mock_entity)
     mock_entity.SafeDelete()
+    model.UpdateGeocellCounts(mock_layer, removed=[mock_entity])
+    mock_entity.RemoveFromDivisions()
 
     handler.request.get('entity_id').AndReturn(dummy_id)
     util.GetInstance(model.Entity, dummy_id, mock_layer).AndRaise(
@@ -95,6 +102,7 @@ class EntityHandlerTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(entity, '_ValidateEntityArguments')
     self.mox.StubOutWithMock(entity, '_CreateEntityAndGeometry')
     self.mox.StubOutWithMock(model, 'Entity', use_mock_anything=True)
+    self.mox.StubOutWithMock(model, 'UpdateGeocellCounts')
     handler = entity.EntityHandler()
     request = {'a': 'b', 'c': 'd', 'e': 'f'}
     handler.request = self.mox.CreateMockAnything()
@@ -116,6 +124,7 @@ class EntityHandlerTest(mox.MoxTestBase):
         mock_layer, dummy_fields, dummy_geometries).AndReturn(dummy_id)
     handler.response.out.write(dummy_id)
     model.Entity.get_by_id(dummy_id).AndReturn(mock_entity)
+    model.UpdateGeocellCounts(mock_layer, [mock_entity])
     mock_entity.GenerateKML()
 
     # Failure during validation.
@@ -140,6 +149,8 @@ class EntityHandlerTest(mox.MoxTestBase):
     self.assertRaises(util.BadRequest, handler.BulkCreate, None)
 
   def testBulkCreateSuccess(self):
+    self.mox.StubOutWithMock(model.Entity, 'get_by_id')
+    self.mox.StubOutWithMock(model, 'UpdateGeocellCounts')
     handler = entity.EntityHandler()
     handler.request = {'entities': '["123", "456", "789"]'}
     handler.response = self.mox.CreateMockAnything()
@@ -161,7 +172,11 @@ class EntityHandlerTest(mox.MoxTestBase):
       return int('999' + args[1][-3:])
     self.stubs.Set(entity, '_CreateEntityAndGeometry', MockCreate)
 
+    dummy_entities = object()
+
     mock_layer.ClearCache()
+    model.Entity.get_by_id([999123, 999456, 999789]).AndReturn(dummy_entities)
+    model.UpdateGeocellCounts(mock_layer, dummy_entities)
 
     self.mox.ReplayAll()
     handler.BulkCreate(mock_layer)
@@ -175,6 +190,9 @@ class EntityHandlerTest(mox.MoxTestBase):
     self.assertEqual(handler.response.out.getvalue(), '999123,999456,999789\n')
 
   def testBulkCreateInterrupt(self):
+    self.mox.StubOutWithMock(model.Entity, 'get_by_id')
+    self.mox.StubOutWithMock(model, 'UpdateGeocellCounts')
+    self.stubs.Set(entity, '_COUNT_BATCH_SIZE', 1)
     handler = entity.EntityHandler()
     handler.request = {'entities': '["123", "456", "789"]'}
     handler.response = self.mox.CreateMockAnything()
@@ -197,7 +215,18 @@ class EntityHandlerTest(mox.MoxTestBase):
       return int('999' + args[1][-3:])
     self.stubs.Set(entity, '_CreateEntityAndGeometry', MockCreate)
 
+    dummy_entities = [object(), object()]
+
     mock_layer.ClearCache()
+    # Counted one batch at a time, so only what was created is counted.
+    model.Entity.get_by_id([999123]).AndReturn(dummy_entities[0])
+    model.UpdateGeocellCounts(mock_layer, dummy_entities[0])
+    model.Entity.get_by_id([999456]).AndReturn(dummy_entities[1])
+    model.UpdateGeocellCounts(mock_layer, dummy_entities[1]).AndRaise(
+        runtime.DeadlineExceededError())
+    # The batch cut short is counted again before answering.
+    model.Entity.get_by_id([999456]).AndReturn(dummy_entities[1])
+    model.UpdateGeocellCounts(mock_layer, dummy_entities[1])
 
     self.mox.ReplayAll()
     handler.BulkCreate(mock_layer)
@@ -293,6 +322,7 @@ class EntityHandlerTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(entity, '_ValidateEntityArguments')
     self.mox.StubOutWithMock(entity, '_UpdateEntityAndGeometry')
     self.mox.StubOutWithMock(model, 'Entity', use_mock_anything=True)
+    self.mox.StubOutWithMock(model, 'UpdateGeocellCounts')
     handler = entity.EntityHandler()
     request = {'a': 'b', 'c': 'd', 'entity_id': '123'}
     handler.request = self.mox.CreateMockAnything()
@@ -300,6 +330,9 @@ class EntityHandlerTest(mox.MoxTestBase):
     handler.request.arguments = request.keys
     fields = {'x': 'y'}
     mock_entity = self.mox.CreateMockAnything()
+    mock_entity.baked = None
+    mock_baked_entity = self.mox.CreateMockAnything()
+    mock_baked_entity.baked = True
     dummy_layer = object()
     dummy_geometries = object()
 
@@ -310,8 +343,23 @@ class EntityHandlerTest(mox.MoxTestBase):
     mock_entity.ClearCache()
     entity._UpdateEntityAndGeometry(123, fields, dummy_geometries, True)
     model.Entity.get_by_id(123).AndReturn(mock_entity)
+    model.UpdateGeocellCounts(dummy_layer, [mock_entity], [mock_entity])
     mock_entity.GenerateKML()
 
+    # Success on a baked entity, which is unbaked and removed from divisions.
+    util.GetInstance(model.Entity, '123', dummy_layer).AndReturn(
+        mock_baked_entity)
+    entity._ValidateEntityArguments(dummy_layer, request, True).AndReturn((
+        {'x': 'y'}, dummy_geometries))
+    mock_baked_entity.ClearCache()
+    entity._UpdateEntityAndGeometry(123, {'x': 'y', 'baked': None},
+                                    dummy_geometries, True)
+    mock_baked_entity.RemoveFromDivisions()
+    model.Entity.get_by_id(123).AndReturn(mock_baked_entity)
+    model.UpdateGeocellCounts(dummy_layer, [mock_baked_entity],
+                              [mock_baked_entity])
+    mock_baked_entity.GenerateKML()
+
     # Failure during validation.
     util.GetInstance(model.Entity, '123', dummy_layer).AndReturn(mock_entity)
     entity._ValidateEntityArguments(dummy_layer, request, True).AndRaise(
@@ -327,6 +375,7 @@ class EntityHandlerTest(mox.MoxTestBase):
 
     self.mox.ReplayAll()
     handler.Update(dummy_layer)
+    handler.Update(dummy_layer)
     self.assertRaises(util.BadRequest, handler.Update, dummy_layer)
     self.assertRaises(util.BadRequest, handler.Update, dummy_layer)
 
@@ -644,3 +693,53 @@ class EntityUtilTest(mox.MoxTestBase):
         'view_range': 'xyz',
         'geometries': '[{"type":"Point",fields":{"location":[1.23,4.56]}}]'
     }, False)
+
+
+class GeometryMigrationHandlerTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs.Set(settings, 'PACK_GEOMETRY_COORDINATES', False)
+    layer = model.Layer(name='a', world='earth')
+    layer.put()
+    entity_object = model.Entity(layer=layer, name='b')
+    entity_object.put()
+    self.keys = []
+    for _ in xrange(3):
+      self.keys.append(model.LineString(
+          points=[db.GeoPt(1, 2), db.GeoPt(3, 4)], altitudes=[5.0, 6.0],
+          parent=entity_object).put())
+      self.keys.append(model.Polygon(
+          outer_points=[db.GeoPt(1, 2), db.GeoPt(3, 4), db.GeoPt(5, 6)],
+          parent=entity_object).put())
+    self.stubs.Set(settings, 'PACK_GEOMETRY_COORDINATES', True)
+    self.handler = entity.GeometryMigrationHandler()
+    self.handler.request = {}
+
+  def _IsPacked(self, key):
+    raw = datastore.Get(key)
+    return isinstance(raw.get('points', raw.get('outer_points')), db.Blob)
+
+  def testMigrate(self):
+    self.handler.BATCH_SIZE = 2
+    self.handler.Migrate(None)
+    self.assertEqual([self._IsPacked(i) for i in self.keys], [True] * 6)
+    self.assertEqual(model.LineString.get(self.keys[0]).points,
+                     [db.GeoPt(1, 2), db.GeoPt(3, 4)])
+    self.assertEqual(model.LineString.get(self.keys[0]).altitudes, [5.0, 6.0])
+
+  def testMigrateContinuation(self):
+    self.mox.StubOutWithMock(db, 'put')
+    self.mox.StubOutWithMock(taskqueue, 'add')
+    db.put(mox.IgnoreArg()).AndRaise(db.Timeout())
+    taskqueue.add(url='/entity-continue-migrate/0',
+                  params={'model': 'Polygon', 'cursor': 'xyz'})
+
+    self.mox.ReplayAll()
+    self.handler.request = {'model': 'Polygon', 'cursor': 'xyz'}
+    self.stubs.Set(db.Query, 'with_cursor', lambda *_: None)
+    self.handler.Migrate(None)
+
+  def testMigrateInvalidModel(self):
+    self.handler.request = {'model': 'Point'}
+    self.assertRaises(util.BadRequest, self.handler.Migrate, None)
@@ -108,11 +108,34 @@ class KMLHandlerTest(mox.MoxTestBase):
       i.put()
 
     util.GetURL('/serve/%d/root.kml' % layer_id).AndReturn('spam')
-    util.GetURL('/serve/0/k%d.kml' % division_ids[0]).AndReturn('eggs')
-    util.GetURL('/serve/0/k%d.kml' % division_ids[2]).AndReturn('sausage')
+    util.GetURL('/serve/%d/k%d.kml' % (layer_id, division_ids[0])).AndReturn(
+        'eggs')
+    util.GetURL('/serve/%d/k%d.kml' % (layer_id, division_ids[2])).AndReturn(
+        'sausage')
     handler.response.out.write('spam\neggs\nsausage')
 
     self.mox.ReplayAll()
 
     handler.ShowList(layer)
     self.assertEqual(handler.response.headers, {'Content-Type': 'text/plain'})
+
+  def testShowListOfDynamicViewportLayer(self):
+    self.mox.StubOutWithMock(util, 'GetURL')
+    handler = kml.KMLHandler()
+    handler.request = self.mox.CreateMockAnything()
+    handler.request.arguments = lambda: []
+    handler.response = self.mox.CreateMockAnything()
+    handler.response.headers = {}
+    handler.response.out = self.mox.CreateMockAnything()
+
+    layer = model.Layer(name='a', world='earth', auto_managed=True,
+                        dynamic_viewport=True)
+    layer_id = layer.put().id()
+
+    # Served without being baked. The view KML is not listed.
+    util.GetURL('/serve/%d/root.kml' % layer_id).AndReturn('spam')
+    handler.response.out.write('spam')
+
+    self.mox.ReplayAll()
+
+    handler.ShowList(layer)
@@ -23,6 +23,7 @@ from google.appengine import runtime
 from google.appengine.api import users
 from google.appengine.api.labs import taskqueue
 from google.appengine.ext import db
+from handlers import baker
 from handlers import base
 from handlers import layer
 from lib.mox import mox
@@ -133,6 +134,9 @@ class LayerHandlerTest(mox.MoxTestBase):
         'division_lod_min_fade': '55',
         'division_lod_max': '789',
         'division_lod_max_fade': '285',
+        'division_split': 'median',
+        'division_clusters': '1',
+        'dynamic_viewport': '1',
         'compressed': 'true',
         'uncacheable': 'no'
     }
@@ -157,6 +161,9 @@ class LayerHandlerTest(mox.MoxTestBase):
     self.assertEqual(result.division_lod_min_fade, 55)
     self.assertEqual(result.division_lod_max, 789)
     self.assertEqual(result.division_lod_max_fade, 285)
+    self.assertEqual(result.division_split, 'median')
+    self.assertEqual(result.division_clusters, True)
+    self.assertEqual(result.dynamic_viewport, True)
     self.assertEqual(result.permission_set.count(999),
                      len(model.Permission.TYPES))
     for permission in result.permission_set:
@@ -187,6 +194,8 @@ class LayerHandlerTest(mox.MoxTestBase):
     self.assertEqual(result.division_lod_min_fade, None)
     self.assertEqual(result.division_lod_max, None)
     self.assertEqual(result.division_lod_max_fade, None)
+    self.assertEqual(result.division_clusters, False)
+    self.assertEqual(result.dynamic_viewport, False)
     self.assertEqual(result.permission_set.count(999),
                      len(model.Permission.TYPES))
     for permission in result.permission_set:
@@ -269,6 +278,9 @@ class LayerHandlerTest(mox.MoxTestBase):
         'division_lod_min_fade': '789',
         'division_lod_max': '264',
         'division_lod_max_fade': '0',
+        'division_split': 'center',
+        'division_clusters': 'yes',
+        'dynamic_viewport': 'on',
         'baked': 'True'  # Shouldn't be settable!
     }
     handler.Update(test_layer)
@@ -289,6 +301,9 @@ class LayerHandlerTest(mox.MoxTestBase):
     self.assertEqual(updated_layer.division_lod_min_fade, 789)
     self.assertEqual(updated_layer.division_lod_max, 264)
     self.assertEqual(updated_layer.division_lod_max_fade, 0)
+    self.assertEqual(updated_layer.division_split, 'center')
+    self.assertEqual(updated_layer.division_clusters, True)
+    self.assertEqual(updated_layer.dynamic_viewport, True)
 
   def testUpdateNoOpSuccess(self):
     test_layer = model.Layer(name='x', world='earth', description='y',
@@ -412,9 +427,11 @@ class LayerDeleteTest(mox.MoxTestBase):
   def testDeleteSuccess(self):
     handler = layer.LayerQueueHandler()
     self.mox.StubOutWithMock(handler, '_DeleteAllInQuery')
+    self.mox.StubOutWithMock(baker, 'DeleteBakeRecords')
     mock_layer = self.mox.CreateMock(model.Layer)
     for set_name in ('style_set', 'division_set', 'folder_set', 'link_set',
-                     'region_set', 'entity_set', 'schema_set'):
+                     'region_set', 'entity_set', 'schema_set',
+                     'geocellcount_set'):
       setattr(mock_layer, set_name, object())
     mock_layer.resource_set = [self.mox.CreateMockAnything() for _ in xrange(2)]
     mock_layer.resource_set[0].blob = None
@@ -427,9 +444,13 @@ class LayerDeleteTest(mox.MoxTestBase):
     handler._DeleteAllInQuery(mock_layer.region_set)
     handler._DeleteAllInQuery(mock_layer.schema_set, model.Schema.SafeDelete)
     handler._DeleteAllInQuery(mock_layer.entity_set, model.Entity.SafeDelete)
+    handler._DeleteAllInQuery(mock_layer.geocellcount_set)
+    mock_layer.resource_set[0].DeleteThumbnails()
     mock_layer.resource_set[0].delete()
+    mock_layer.resource_set[1].DeleteThumbnails()
     mock_layer.resource_set[1].delete()
     mock_layer.resource_set[1].blob.delete()
+    baker.DeleteBakeRecords(mock_layer)
     mock_layer.SafeDelete()
 
     self.mox.ReplayAll()
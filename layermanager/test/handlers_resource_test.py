@@ -145,11 +145,13 @@ class ResourceHandlerTest(mox.MoxTestBase):
     util.GetInstance(model.Resource, dummy_id, dummy_layer).AndReturn(
         mock_resource1)
     resource._IsResourceReferenced(mock_resource1).AndReturn(False)
+    mock_resource1.DeleteThumbnails()
     mock_resource1.delete()
 
     util.GetInstance(model.Resource, dummy_id, dummy_layer).AndReturn(
         mock_resource2)
     resource._IsResourceReferenced(mock_resource2).AndReturn(False)
+    mock_resource2.DeleteThumbnails()
     mock_resource2.delete()
     mock_resource2.blob.delete()
 
@@ -370,6 +372,8 @@ class ResourceHandlerTest(mox.MoxTestBase):
     self.stubs.Set(resource, '_IsImage', lambda _: True)
     self.stubs.Set(resource, '_TryGetImageSize',
                    lambda _: (settings.MAX_ICON_SIZE - 1,) * 2)
+    pregenerated = []
+    self.stubs.Set(resource, '_PregenerateThumbnails', pregenerated.append)
     resource_id = create(layer, 'icon', 'def', None, mock_blob)
     result = model.Resource.get_by_id(resource_id)
     self.assertEqual(result.layer.key().id(), layer_id)
@@ -377,6 +381,7 @@ class ResourceHandlerTest(mox.MoxTestBase):
     self.assertEqual(result.filename, 'def')
     self.assertEqual(result.external_url, None)
     self.assertTrue(result.blob)  # We get *something* back.
+    self.assertEqual([i.key() for i in pregenerated], [result.key()])
 
 
 class ResourceUtilTest(mox.MoxTestBase):
@@ -406,6 +411,20 @@ class ResourceUtilTest(mox.MoxTestBase):
     self.assertTrue(resource._IsImage(mock_blob))  # Image too large.
     self.assertFalse(resource._IsImage(mock_blob))  # Bad image.
 
+  def testPregenerateThumbnails(self):
+    self.stubs.Set(settings, 'PREGENERATED_THUMBNAIL_SIZES',
+                   {'image': [12, 34, 56]})
+    mock_resource = self.mox.CreateMock(model.Resource)
+
+    mock_resource.GetThumbnail(12)
+    mock_resource.GetThumbnail(34).AndRaise(images.LargeImageError)
+
+    self.mox.ReplayAll()
+    mock_resource.type = 'image'
+    resource._PregenerateThumbnails(mock_resource)
+    mock_resource.type = 'raw'
+    resource._PregenerateThumbnails(mock_resource)
+
   def testTryGetImageSize(self):
     self.mox.StubOutWithMock(images, 'Image')
     mock_blob = self.mox.CreateMockAnything()
@@ -17,18 +17,32 @@
 """Tests for the KML generation in the layer manager models."""
 
 
+import collections
+import logging
+import random
 import re
+import StringIO
+import time
 import unittest
+import zipfile
 from xml.etree import ElementTree
+from google.appengine.api import memcache
 from google.appengine.ext import db
 import model
 import settings
+import util
 
 
 def _GetRidOfNamespace(kml_text):
   return re.sub('xmlns(:gx)?=".*?"', '', kml_text)
 
 
+def _Unzip(kmz):
+  archive = zipfile.ZipFile(StringIO.StringIO(kmz))
+  assert archive.namelist() == ['doc.kml']
+  return archive.read('doc.kml')
+
+
 class PointKMLGenerationTest(unittest.TestCase):
 
   def testGenerateCompleteKML(self):
@@ -115,6 +129,88 @@ class LineStringKMLGenerationTest(unittest.TestCase):
     self.assertEqual(tree.find('coordinates').text, '4.2,3.1')
 
 
+class CompiledGeometrySerializerTest(unittest.TestCase):
+  """Compares the hand-written geometry serializers against the templates."""
+
+  SAMPLES = 200
+
+  def setUp(self):
+    self.random = random.Random(42)
+    self.original_setting = settings.USE_COMPILED_GEOMETRY_SERIALIZERS
+
+  def tearDown(self):
+    settings.USE_COMPILED_GEOMETRY_SERIALIZERS = self.original_setting
+
+  def _RandomFloat(self, limit):
+    return self.random.choice([
+        0.0, -0.0, 1.0, -limit, limit, round(self.random.uniform(-1, 1), 2),
+        self.random.uniform(-limit, limit)])
+
+  def _RandomPoints(self, count):
+    return [db.GeoPt(self._RandomFloat(90), self._RandomFloat(180))
+            for _ in xrange(count)]
+
+  def _RandomAltitudes(self, count):
+    return self.random.choice([[], [self._RandomFloat(1e4)
+                                    for _ in xrange(count)]])
+
+  def _RandomOptions(self, *names):
+    options = {'altitude_mode': self.random.choice([None] +
+                                                   model._ALTITUDE_MODES)}
+    for name in names:
+      options[name] = self.random.choice([None, True, False])
+    return options
+
+  def _AssertIdenticalKML(self, geometry):
+    settings.USE_COMPILED_GEOMETRY_SERIALIZERS = False
+    template_kml = geometry.GenerateKML()
+    settings.USE_COMPILED_GEOMETRY_SERIALIZERS = True
+    compiled_kml = geometry.GenerateKML()
+    self.assertEqual(type(template_kml), type(compiled_kml))
+    self.assertEqual(template_kml, compiled_kml)
+
+  def testPoint(self):
+    for _ in xrange(self.SAMPLES):
+      altitude = self.random.choice([None, self._RandomFloat(1e4)])
+      self._AssertIdenticalKML(model.Point(
+          location=self._RandomPoints(1)[0], altitude=altitude,
+          **self._RandomOptions('extrude')))
+
+  def testLineString(self):
+    for _ in xrange(self.SAMPLES):
+      count = self.random.randint(1, 20)
+      self._AssertIdenticalKML(model.LineString(
+          points=self._RandomPoints(count),
+          altitudes=self._RandomAltitudes(count),
+          **self._RandomOptions('extrude', 'tessellate')))
+
+  def testPolygon(self):
+    for _ in xrange(self.SAMPLES):
+      outer_count = self.random.randint(1, 20)
+      inner_count = self.random.randint(0, 10)
+      self._AssertIdenticalKML(model.Polygon(
+          outer_points=self._RandomPoints(outer_count),
+          outer_altitudes=self._RandomAltitudes(outer_count),
+          inner_points=self._RandomPoints(inner_count),
+          inner_altitudes=self._RandomAltitudes(inner_count),
+          **self._RandomOptions('extrude', 'tessellate')))
+
+  def testEmptyLinearRing(self):
+    self.assertEqual(model._SerializeLinearRing(util.CoordinateArray(), []),
+                     u'')
+    ring = util.CoordinateArray.FromPoints([db.GeoPt(1, 2)])
+    self.assertEqual(model._SerializeLinearRing(ring, []),
+                     u'<LinearRing><coordinates>2.0,1.0 2.0,1.0'
+                     u'</coordinates></LinearRing>')
+
+  def testMismatchedAltitudes(self):
+    line_string = model.LineString(points=self._RandomPoints(3),
+                                   altitudes=[1.0, 2.0])
+    for compiled in (False, True):
+      settings.USE_COMPILED_GEOMETRY_SERIALIZERS = compiled
+      self.assertRaises(ValueError, line_string.GenerateKML)
+
+
 class ModelKMLGenerationTest(unittest.TestCase):
 
   def testGenerateCompleteKML(self):
@@ -840,6 +936,70 @@ class LayerKMLGenerationTest(unittest.TestCase):
     self.assertEqual(placemarks[0].get('id'), 'id%d' % entity_ids[0])
     self.assertEqual(placemarks[1].get('id'), 'id%d' % entity_ids[2])
 
+  def testIterKMLMatchesGenerateKML(self):
+    layer = model.Layer(name='a', description='bc', world='mars',
+                        custom_kml='<address>dummy</address>')
+    layer.put()
+    for name in ('j', 'k'):
+      entity = model.Entity(layer=layer, name=name)
+      entity.put()
+      point_id = model.Point(location=db.GeoPt(1, 2), parent=entity).put().id()
+      entity.geometries = [point_id]
+      entity.put()
+    model.Style(layer=layer, name='def').put()
+
+    kml = ''.join(layer.IterKML())
+    self.assertEqual(model.Layer.get(layer.key()).cached_kml.encode('utf8'),
+                     kml)
+    layer.cached_kml = None
+    self.assertEqual(layer.GenerateKML().encode('utf8'), kml)
+    # Served from the cache the second time around.
+    self.assertEqual(list(layer.IterKML()), [kml])
+
+  def testUncacheableIterKML(self):
+    layer = model.Layer(name='a', world='earth', uncacheable=True)
+    layer.put()
+    kml = ''.join(layer.IterKML())
+    self.assertEqual(layer.GenerateKML().encode('utf8'), kml)
+    self.assertEqual(model.Layer.get(layer.key()).cached_kml, None)
+
+  def testIterKMZ(self):
+    layer = model.Layer(name='a', world='earth')
+    layer.put()
+    model.Style(layer=layer, name='b').put()
+
+    memcache.flush_all()
+    kmz = ''.join(layer.IterKMZ())
+    stored = model.Layer.get(layer.key())
+    self.assertEqual(_Unzip(kmz), stored.cached_kml.encode('utf8'))
+
+    # Kept in memcache rather than in the layer, and served as is from there,
+    # without being compressed again.
+    key = 'kmz:%s' % layer.key()
+    digest, cached_kmz = memcache.get(key)
+    self.assertEqual(cached_kmz, kmz)
+    memcache.set(key, (digest, 'cached'))
+    self.assertEqual(list(stored.IterKMZ()), ['cached'])
+
+    # Rebuilt from the cached KML when it is missing from memcache.
+    memcache.flush_all()
+    self.assertEqual(list(stored.IterKMZ()), [kmz])
+    self.assertEqual(memcache.get(key), (digest, kmz))
+
+    # Not served once the KML it was built from is replaced.
+    stored.name = 'b'
+    stored.ClearCache()
+    kml = stored.GenerateKML()
+    self.assertEqual(_Unzip(''.join(stored.IterKMZ())), kml.encode('utf8'))
+
+  def testUncacheableIterKMZ(self):
+    layer = model.Layer(name='a', world='earth', uncacheable=True)
+    layer.put()
+    kmz = ''.join(layer.IterKMZ())
+    self.assertEqual(_Unzip(kmz), layer.GenerateKML().encode('utf8'))
+    self.assertEqual(model.Layer.get(layer.key()).cached_kml, None)
+    self.assertEqual(memcache.get('kmz:%s' % layer.key()), None)
+
   def testKMLGenerationFailures(self):
     layer = model.Layer(name='abc', world='earth')
     self.assertRaises(db.NotSavedError, layer.GenerateKML)
@@ -849,6 +1009,93 @@ class LayerKMLGenerationTest(unittest.TestCase):
     self.assertRaises(model.KMLGenerationError, layer.GenerateKML)
 
 
+  def _CreateLocatedEntity(self, layer, name, latitude, longitude,
+                           priority=None):
+    entity = model.Entity(layer=layer, name=name, priority=priority)
+    entity.put()
+    point = model.Point(location=db.GeoPt(latitude, longitude), parent=entity)
+    entity.geometries = [point.put().id()]
+    entity.UpdateLocation(point)
+    entity.put()
+    return entity
+
+  def testGenerateDynamicViewportKML(self):
+    layer = model.Layer(name='a', world='earth', auto_managed=True,
+                        dynamic_viewport=True, compressed=True)
+    layer.put()
+    self._CreateLocatedEntity(layer, 'b', 1, 2)
+
+    # Served without being baked, and only through the view link.
+    kml = _GetRidOfNamespace(layer.GenerateKML())
+    document = ElementTree.fromstring(kml).find('Document')
+    self.assertEqual([i.tag for i in document.getchildren()],
+                     ['name', 'NetworkLink'])
+    link = document.find('NetworkLink/Link')
+    self.assertEqual(link.find('href').text, 'view.kmz')
+    self.assertEqual(link.find('refreshMode').text, 'onInterval')
+    self.assertEqual(link.find('refreshInterval').text,
+                     str(settings.VIEW_REFRESH_INTERVAL))
+    self.assertEqual(link.find('viewRefreshMode').text, 'onStop')
+    self.assertEqual(link.find('viewRefreshTime').text,
+                     str(settings.VIEW_REFRESH_TIME))
+    self.assertEqual(link.find('viewFormat').text,
+                     'BBOX=[bboxWest],[bboxSouth],[bboxEast],[bboxNorth]')
+
+  def testGetViewEntities(self):
+    layer = model.Layer(name='a', world='earth', auto_managed=True,
+                        dynamic_viewport=True)
+    layer.put()
+    low = self._CreateLocatedEntity(layer, 'b', 10, 10, 1.0)
+    high = self._CreateLocatedEntity(layer, 'c', 11, 11, 5.0)
+    unprioritized = self._CreateLocatedEntity(layer, 'd', 12, 12)
+    east = self._CreateLocatedEntity(layer, 'e', 10, 170, 3.0)
+    west = self._CreateLocatedEntity(layer, 'f', 10, -170, 4.0)
+    other_layer = model.Layer(name='g', world='earth')
+    other_layer.put()
+    self._CreateLocatedEntity(other_layer, 'h', 10, 10, 9.0)
+
+    def GetIds(*viewport):
+      return [i.key().id() for i in layer.GetViewEntities(*viewport)]
+
+    self.assertEqual(GetIds(20, 0, 20, 0), [high.key().id(), low.key().id(),
+                                            unprioritized.key().id()])
+    self.assertEqual(GetIds(11.5, 10.5, 11.5, 10.5), [high.key().id()])
+    # Viewports across the 180th meridian.
+    self.assertEqual(GetIds(20, 0, -160, 160), [west.key().id(),
+                                                east.key().id()])
+    original_limit = settings.VIEW_MAX_ENTITIES
+    try:
+      settings.VIEW_MAX_ENTITIES = 2
+      self.assertEqual(GetIds(20, 0, 20, 0), [high.key().id(),
+                                              low.key().id()])
+      self.assertEqual(GetIds(20, 0, -160, 160), [west.key().id(),
+                                                  east.key().id()])
+      self.assertEqual(GetIds(20, 0, 180, -180), [high.key().id(),
+                                                  west.key().id()])
+    finally:
+      settings.VIEW_MAX_ENTITIES = original_limit
+
+  def testIterViewKML(self):
+    layer = model.Layer(name='a', world='earth', auto_managed=True,
+                        dynamic_viewport=True)
+    layer.put()
+    inside = self._CreateLocatedEntity(layer, 'b', 1, 2)
+    self._CreateLocatedEntity(layer, 'c', -30, -40)
+
+    kml = ''.join(layer.IterViewKML(10, 0, 10, 0, False))
+    document = ElementTree.fromstring(_GetRidOfNamespace(kml)).find('Document')
+    self.assertEqual([i.tag for i in document.getchildren()], ['Placemark'])
+    self.assertEqual(document.find('Placemark/name').text, 'b')
+    # The entity KML is cached and reused.
+    inside = model.Entity.get(inside.key())
+    self.assertTrue(inside.cached_kml)
+    self.assertTrue(inside.cached_kml.strip() in kml.decode('utf8'))
+
+    kmz = ''.join(layer.IterViewKML(10, 0, 10, 0, True))
+    self.assertEqual(_Unzip(kmz), kml)
+    # Nothing is cached in the layer itself.
+    self.assertEqual(model.Layer.get(layer.key()).cached_kml, None)
+
 class DivisionKMLGenerationTest(unittest.TestCase):
 
   def testGenerateCompleteKML(self):
@@ -923,9 +1170,157 @@ class DivisionKMLGenerationTest(unittest.TestCase):
     self.assertEqual(document.find('Region/Lod/maxLodPixels').text, '-1')
     self.assertEqual(document.find('Region/Lod/maxFadeExtent').text, '128')
 
+  def testIterKMLMatchesGenerateKML(self):
+    layer = model.Layer(name='a', world='earth')
+    layer.put()
+    entity = model.Entity(layer=layer, name='b')
+    entity.put()
+    point_id = model.Point(location=db.GeoPt(1, 2), parent=entity).put().id()
+    entity.geometries = [point_id]
+    entity.put()
+    division = model.Division(layer=layer, south=0.1, north=2.3, west=4.5,
+                              east=6.7, baked=True,
+                              entities=[entity.key().id()])
+    division.put()
+    model.Division(layer=layer, south=1.0, north=2.0, west=5.0, east=6.0,
+                   baked=True, parent_division=division).put()
+
+    kml = ''.join(division.IterKML())
+    self.assertEqual(model.Division.get(division.key()).cached_kml, kml)
+    division.cached_kml = None
+    self.assertEqual(division.GenerateKML().encode('utf8'), kml)
+
+  def testIterKMZ(self):
+    layer = model.Layer(name='a', world='earth')
+    layer.put()
+    division = model.Division(layer=layer, south=0.1, north=2.3, west=4.5,
+                              east=6.7, baked=True)
+    division.put()
+
+    memcache.flush_all()
+    kmz = ''.join(division.IterKMZ())
+    stored = model.Division.get(division.key())
+    self.assertEqual(memcache.get('kmz:%s' % division.key())[1], kmz)
+    self.assertEqual(_Unzip(kmz), stored.cached_kml.encode('utf8'))
+    self.assertEqual(list(stored.IterKMZ()), [kmz])
+
+    # Invalidated together with the KML when the layer changes.
+    layer.ClearCache()
+    stored = model.Division.get(division.key())
+    self.assertFalse(stored.HasValidKMLCache())
+    new_kmz = ''.join(stored.IterKMZ())
+    self.assertEqual(_Unzip(new_kmz), stored.GenerateKML().encode('utf8'))
+    self.assertTrue(model.Division.get(division.key()).HasValidKMLCache())
+
+  def testGenerateKMLFromPrefetchedEntities(self):
+    layer = model.Layer(name='a', world='earth')
+    layer.put()
+    divisions = []
+    for _ in xrange(2):
+      entity = model.Entity(layer=layer, name='b')
+      entity.put()
+      point_id = model.Point(location=db.GeoPt(1, 2), parent=entity).put().id()
+      entity.geometries = [point_id]
+      entity.put()
+      division = model.Division(layer=layer, south=0.1, north=2.3, west=4.5,
+                                east=6.7, baked=True,
+                                entities=[entity.key().id()])
+      division.put()
+      divisions.append(division)
+    expected = [i.GenerateKML() for i in divisions]
+    for division in divisions:
+      division.cached_kml = None
+    for entity in model.Entity.all():
+      entity.cached_kml = None
+      entity.put()
+
+    cache = collections.defaultdict(dict)
+    model.PrefetchDivisionEntities(divisions, cache, [layer])
+    try:
+      # The entities are not loaded again.
+      model.Entity.get_by_id = None
+      self.assertEqual([i.GenerateKML(cache) for i in divisions], expected)
+    finally:
+      del model.Entity.get_by_id
+
+  def testGenerateClusterKML(self):
+    layer = model.Layer(name='a', world='earth', division_lod_min=123)
+    layer.put()
+    cell = model.geocell.compute(db.GeoPt(1.5, 5.5), 3)
+    division = model.Division(layer=layer, south=0.1, north=2.3, west=4.5,
+                              east=6.7, baked=True, cluster_cells=[cell],
+                              cluster_counts=[42],
+                              cluster_locations=[db.GeoPt(1.25, 5.75)])
+    division.put()
+    box = model.geocell.compute_box(cell)
+
+    kml = _GetRidOfNamespace(division.GenerateKML())
+    document = ElementTree.fromstring(kml).find('Document')
+    self.assertEqual([i.tag for i in document.getchildren()],
+                     ['Placemark', 'Region'])
+    placemark = document.find('Placemark')
+    self.assertEqual(placemark.find('name').text, '42')
+    self.assertEqual(placemark.find('Point/coordinates').text, '5.75,1.25,0')
+    region = placemark.find('Region')
+    self.assertEqual(float(region.find('LatLonAltBox/north').text), box.north)
+    self.assertEqual(float(region.find('LatLonAltBox/south').text), box.south)
+    self.assertEqual(float(region.find('LatLonAltBox/east').text), box.east)
+    self.assertEqual(float(region.find('LatLonAltBox/west').text), box.west)
+    self.assertEqual(region.find('Lod/minLodPixels').text, '-1')
+    self.assertEqual(region.find('Lod/maxLodPixels').text, '123')
+
+    division.cluster_cells = []
+    division.cluster_counts = []
+    division.cluster_locations = []
+    self.assertEqual(division.GenerateClusterKML(), u'')
+
   def testUnbakedKMLGenerationFailure(self):
     layer = model.Layer(name='a', world='earth')
     layer.put()
     division = model.Division(layer=layer, south=0.1, north=2.3, west=4.5,
                               east=6.7, baked=False)
     self.assertRaises(model.KMLGenerationError, division.GenerateKML)
+    self.assertRaises(model.KMLGenerationError, list, division.IterKML())
+    self.assertRaises(model.KMLGenerationError, list, division.IterKMZ())
+
+
+class DocumentKMLBenchmarkTest(unittest.TestCase):
+  """Logs how document assembly scales with the number of entities.
+
+  The timings depend on the machine running the tests, so they are only
+  logged for comparison, never asserted on.
+  """
+
+  ENTITY_COUNTS = (100, 1000, 10000)
+  REPETITIONS = 3
+
+  def _Time(self, function):
+    best = None
+    for _ in xrange(self.REPETITIONS):
+      start = time.time()
+      function()
+      elapsed = time.time() - start
+      if best is None or elapsed < best: best = elapsed
+    return best
+
+  def testRenderTimeAgainstEntityCount(self):
+    layer = model.Layer(name='a', world='earth', description='b')
+    layer.put()
+    entity = model.Entity(layer=layer, name='c', snippet='d\ne')
+    entity.put()
+    point_id = model.Point(location=db.GeoPt(1, 2), parent=entity).put().id()
+    entity.geometries = [point_id]
+    entity.put()
+    fragment = entity.GenerateKML()
+
+    for count in self.ENTITY_COUNTS:
+      fragments = [fragment] * count
+      streamed = self._Time(
+          lambda: u''.join(model._IterDocumentKML(layer, [], fragments)))
+      templated = self._Time(
+          lambda: model._RenderKMLTemplate('layer.kml', {'layer': layer,
+                                                         'contents': fragments,
+                                                         'styles': []}))
+      logging.info('%6d entities: %.4fs assembled (%.2fus per entity), '
+                   '%.4fs templated.', count, streamed,
+                   streamed / count * 1e6, templated)
@@ -17,13 +17,20 @@
 """Small tests for utility functions related to the models."""
 
 
+import collections
 import datetime
 import operator
+import time
+from google.appengine.api import datastore
+from google.appengine.api import images
+from google.appengine.api import memcache
+from google.appengine.ext import blobstore
 from google.appengine.ext import db
 from google.appengine.ext.webapp import template
 from lib.geo import geomodel
 from lib.mox import mox
 import model
+import settings
 import util
 
 
@@ -168,6 +175,52 @@ class LayerUtilTest(mox.MoxTestBase):
     self.assertEqual(model.Layer.GetSortedContents(mock_layer), sorted_list)
 
 
+  def testGetRootDivision(self):
+    layer = model.Layer(name='a', world='earth', auto_managed=True, baked=True)
+    layer.put()
+    self.assertEqual(layer.GetRootDivision(), None)
+    roots = {}
+    for generation in (None, 1, 2):
+      root = model.Division(layer=layer, north=90.0, south=-90.0, east=180.0,
+                            west=-180.0, baked=True, generation=generation)
+      root.put()
+      model.Division(layer=layer, north=90.0, south=0.0, east=180.0, west=0.0,
+                     baked=True, generation=generation,
+                     parent_division=root).put()
+      roots[generation] = root.key()
+
+    self.assertEqual(layer.GetRootDivision().key(), roots[None])
+    layer.division_generation = 2
+    self.assertEqual(layer.GetRootDivision().key(), roots[2])
+    layer.division_generation = 3
+    self.assertEqual(layer.GetRootDivision(), None)
+
+    # Divisions with key names are looked up by their quad paths.
+    root = model.Division(key_name=model.Division.GetKeyName(layer, 4, 'r'),
+                          layer=layer, north=90.0, south=-90.0, east=180.0,
+                          west=-180.0, baked=True, generation=4)
+    root.put()
+    layer.division_generation = 4
+    self.assertEqual(layer.GetRootDivision().key(), root.key())
+    self.assertEqual(layer.GetDivision('r').key(), root.key())
+    self.assertEqual(layer.GetDivision('r0'), None)
+
+  def testGetDivisionPath(self):
+    layer = model.Layer(name='a', world='earth', auto_managed=True)
+    layer_id = layer.put().id()
+    key_name = model.Division.GetKeyName(layer, 3, 'r0-2')
+    self.assertEqual(key_name, '%d:3:r0-2' % layer_id)
+    division = model.Division(key_name=key_name, layer=layer, north=1.0,
+                              south=0.0, east=1.0, west=0.0, baked=True)
+    self.assertEqual(division.GetPath(), 'r0-2')
+    self.assertEqual(division.GetServedId(), 'r0-2')
+    division = model.Division(layer=layer, north=1.0, south=0.0, east=1.0,
+                              west=0.0, baked=True)
+    division_id = division.put().id()
+    self.assertEqual(division.GetPath(), None)
+    self.assertEqual(division.GetServedId(), str(division_id))
+
+
 class ResourceUtilTest(mox.MoxTestBase):
 
   def testGetURL(self):
@@ -251,6 +304,34 @@ class ResourceUtilTest(mox.MoxTestBase):
                      'dummy-url?resize=15')
 
 
+  def testGetThumbnail(self):
+    self.mox.StubOutWithMock(images, 'Image')
+    layer = model.Layer(name='a', world='earth')
+    layer.put()
+    resource = model.Resource(layer=layer, filename='b', type='image',
+                              blob=blobstore.BlobKey('abc'))
+    resource.put()
+    mock_image = self.mox.CreateMockAnything()
+
+    images.Image(blob_key='abc').AndReturn(mock_image)
+    mock_image.resize(16, 16)
+    mock_image.execute_transforms(output_encoding=images.PNG).AndReturn('def')
+    images.Image(blob_key='abc').AndReturn(mock_image)
+    mock_image.resize(32, 32)
+    mock_image.execute_transforms(output_encoding=images.PNG).AndReturn('')
+
+    self.mox.ReplayAll()
+    self.assertEqual(resource.GetThumbnail(16), 'def')
+    # Stored thumbnails are not generated again.
+    self.assertEqual(resource.GetThumbnail(16), 'def')
+    self.assertEqual(resource.GetThumbnail(32), '')
+    self.assertEqual(resource.GetThumbnail(32), '')
+    self.assertEqual(model.Thumbnail.all().ancestor(resource).count(), 2)
+
+    resource.DeleteThumbnails()
+    self.assertEqual(model.Thumbnail.all().ancestor(resource).count(), 0)
+
+
 class FolderUtilTest(mox.MoxTestBase):
 
   def testGetSortedContents(self):
@@ -590,6 +671,513 @@ class EntityUtilTest(mox.MoxTestBase):
     mock_entity.geometries = []
     self.assertRaises(ValueError, model.Entity.UpdateLocation, mock_entity)
 
+  def testDropsObsoleteProperties(self):
+    layer = model.Layer(name='a', world='earth')
+    layer.put()
+    entity = model.Entity(layer=layer, name='b',
+                          layer_timestamp=datetime.datetime(2010, 1, 1),
+                          region_timestamp=datetime.datetime(2010, 1, 2))
+    entity.put()
+
+    entity = model.Entity.get(entity.key())
+    self.assertEqual(entity.dynamic_properties(), [])
+    entity.put()
+    stored = datastore.Get(entity.key())
+    self.assertFalse('layer_timestamp' in stored)
+    self.assertFalse('region_timestamp' in stored)
+
+  def testRemoveFromDivisions(self):
+    layer = model.Layer(name='a', world='earth', auto_managed=True)
+    layer.put()
+    entity = model.Entity(layer=layer, name='b', baked=True)
+    entity_id = entity.put().id()
+    division = model.Division(layer=layer, north=1.0, south=0.0, east=1.0,
+                              west=0.0, baked=True, entities=[3, entity_id],
+                              cached_kml=u'<Document/>')
+    division.put()
+    other_division = model.Division(layer=layer, north=1.0, south=0.0,
+                                    east=1.0, west=0.0, baked=True,
+                                    entities=[5], cached_kml=u'<Document/>')
+    other_division.put()
+
+    entity.RemoveFromDivisions()
+    division = model.Division.get(division.key())
+    self.assertEqual(division.entities, [3])
+    self.assertEqual(division.cached_kml, None)
+    other_division = model.Division.get(other_division.key())
+    self.assertEqual(other_division.cached_kml, u'<Document/>')
+
+
+class ReferencePrefetchTest(mox.MoxTestBase):
+
+  def testPrefetchReferencesSharesInstances(self):
+    layer = model.Layer(name='a', world='earth')
+    layer.put()
+    style = model.Style(layer=layer, name='b')
+    style.put()
+    region = model.Region(layer=layer, north=1.0, south=0.0, east=1.0,
+                          west=0.0)
+    region.put()
+    entity_ids = []
+    for _ in xrange(3):
+      entity = model.Entity(layer=layer, name='c', style=style, region=region)
+      entity_ids.append(entity.put().id())
+    folder_id = model.Folder(layer=layer, name='d', region=region).put().id()
+    items = model.Entity.get_by_id(entity_ids) + [model.Folder.get_by_id(
+        folder_id)]
+    more_items = model.Entity.get_by_id(entity_ids)
+    cache = collections.defaultdict(dict)
+    batches = []
+
+    def RecordingGet(keys):
+      batches.append(keys)
+      return real_get(keys)
+    real_get = db.get
+    self.stubs.Set(db, 'get', RecordingGet)
+
+    model.PrefetchReferences(items, cache, [layer])
+
+    self.assertEqual(len(batches), 1)
+    self.assertEqual(set(batches[0]), set([style.key(), region.key()]))
+    for item in items:
+      self.assertTrue(item.layer is layer)
+      self.assertTrue(item.region is items[0].region)
+    self.assertTrue(items[1].style is items[0].style)
+    self.assertTrue(items[0].style.layer is layer)
+    self.assertTrue(items[0].region.layer is layer)
+
+    # A second prefetch over the same objects is served from the cache.
+    model.PrefetchReferences(more_items, cache)
+    self.assertEqual(len(batches), 1)
+    self.assertTrue(more_items[0].style is items[0].style)
+
+
+class GeometryPrefetchTest(mox.MoxTestBase):
+
+  def _CreateEntity(self, layer, geometry_count):
+    entity = model.Entity(layer=layer, name='a')
+    entity.put()
+    for _ in xrange(geometry_count):
+      point = model.Point(location=db.GeoPt(1, 2), parent=entity)
+      entity.geometries.append(point.put().id())
+    entity.put()
+    return entity
+
+  def testPrefetchGeometriesBatchesGets(self):
+    layer = model.Layer(name='a', world='earth')
+    layer.put()
+    entities = [self._CreateEntity(layer, 2) for _ in xrange(3)]
+    entities[2].GenerateKML()  # Has a valid cache, so should be skipped.
+    cache = collections.defaultdict(dict)
+    model.PrefetchKMLDependencies(entities, cache)
+    real_get = db.get
+    self.mox.StubOutWithMock(db, 'get')
+
+    keys = entities[0].GetGeometryKeys() + entities[1].GetGeometryKeys()
+    db.get(keys).AndReturn(real_get(keys))
+
+    self.mox.ReplayAll()
+    model.PrefetchGeometries(entities + [object()], cache)
+    self.assertEqual(set(cache['geometries'].keys()), set(keys))
+    # Served entirely from the cache; a further db.get() would fail.
+    geometries = entities[1].GetGeometries(cache)
+    self.assertEqual([i.key() for i in geometries],
+                     entities[1].GetGeometryKeys())
+    self.assertTrue(isinstance(geometries[0], model.Point))
+
+  def testGetGeometriesWithoutCache(self):
+    layer = model.Layer(name='a', world='earth')
+    layer.put()
+    entity = self._CreateEntity(layer, 3)
+    geometries = entity.GetGeometries()
+    self.assertEqual([i.key().id() for i in geometries], entity.geometries)
+
+
+class PackedCoordinateStorageTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs.Set(settings, 'PACK_GEOMETRY_COORDINATES', True)
+    self.entity = model.Entity(layer=model.Layer(name='a', world='earth').put(),
+                               name='b')
+    self.entity.put()
+
+  def testStoresBlobs(self):
+    points = [db.GeoPt(1.5, 2.5), db.GeoPt(-3.25, 4.125)]
+    polygon = model.Polygon(outer_points=points, outer_altitudes=[7.0, 8.5],
+                            parent=self.entity)
+    key = polygon.put()
+
+    raw = datastore.Get(key)
+    self.assertTrue(isinstance(raw['outer_points'], db.Blob))
+    self.assertEqual(raw['outer_points'],
+                     util.PackDoubles([2.5, 1.5, 4.125, -3.25]))
+    self.assertEqual(raw['outer_altitudes'], util.PackDoubles([7.0, 8.5]))
+    self.assertEqual(raw.get('inner_points'), None)
+
+    polygon = model.Polygon.get(key)
+    self.assertTrue(isinstance(polygon.outer_points, util.CoordinateArray))
+    self.assertEqual(polygon.outer_points, points)
+    self.assertEqual(polygon.outer_altitudes, [7.0, 8.5])
+    self.assertEqual(polygon.inner_points, [])
+    self.assertEqual(polygon.inner_altitudes, [])
+
+  def testReadsUnpackedGeometries(self):
+    points = [db.GeoPt(1.5, 2.5), db.GeoPt(-3.25, 4.125)]
+    self.stubs.Set(settings, 'PACK_GEOMETRY_COORDINATES', False)
+    key = model.LineString(points=points, altitudes=[7.0, 8.5],
+                           parent=self.entity).put()
+    raw = datastore.Get(key)
+    self.assertEqual(raw['points'], points)
+    self.assertEqual(raw['altitudes'], [7.0, 8.5])
+
+    self.stubs.Set(settings, 'PACK_GEOMETRY_COORDINATES', True)
+    line_string = model.LineString.get(key)
+    self.assertEqual(line_string.points, points)
+    self.assertEqual(line_string.altitudes, [7.0, 8.5])
+    line_string.put()
+    self.assertTrue(isinstance(datastore.Get(key)['points'], db.Blob))
+    self.assertEqual(model.LineString.get(key).points, points)
+
+  def testValidation(self):
+    self.assertRaises(db.BadValueError, model.LineString, points=None)
+    self.assertRaises(db.BadValueError, model.LineString, points=[(1, 2)])
+    self.assertRaises(db.BadValueError, model.LineString,
+                      points=[db.GeoPt(1, 2)], altitudes=['a'])
+
+
+class MemcachedKMLTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    memcache.flush_all()
+    self.stubs.Set(settings, 'MEMCACHE_CHUNK_SIZE', 4)
+
+  def testSetAndGetChunkedKML(self):
+    generation = model.GetKMLGeneration(1)
+    self.assertEqual(model.GetKMLGeneration(1), generation)
+    model.SetMemcachedKML('Division', 2, 1, generation, 'abcdefghij', True)
+
+    self.assertEqual(memcache.get('kml:Division:2:%d:2' % generation), 'ij')
+    self.assertEqual(model.GetMemcachedKML('Division', 2), ('abcdefghij', True))
+    self.assertEqual(model.GetMemcachedKML('Division', 3), None)
+    self.assertEqual(model.GetMemcachedKMLStats(), {'hits': 1, 'misses': 1})
+
+  def testInvalidation(self):
+    layer = model.Layer(name='a', world='earth')
+    layer_id = layer.put().id()
+    division = model.Division(layer=layer, south=0.1, north=2.3, west=4.5,
+                              east=6.7, baked=True)
+    division_id = division.put().id()
+
+    model.SetMemcachedKML('Layer', layer_id, layer_id,
+                          model.GetKMLGeneration(layer_id), 'a', False)
+    self.assertEqual(model.GetMemcachedKML('Layer', layer_id), ('a', False))
+    layer.ClearCache()
+    self.assertEqual(model.GetMemcachedKML('Layer', layer_id), None)
+
+    model.SetMemcachedKML('Division', division_id, layer_id,
+                          model.GetKMLGeneration(layer_id), 'b', False)
+    self.assertEqual(model.GetMemcachedKML('Division', division_id),
+                     ('b', False))
+    division.ClearCache()
+    self.assertEqual(model.GetMemcachedKML('Division', division_id), None)
+
+    # A stale generation is never served, even if its chunks are still there.
+    stale_generation = model.GetKMLGeneration(layer_id) - 1
+    model.SetMemcachedKML('Layer', layer_id, layer_id, stale_generation, 'c',
+                          False)
+    self.assertEqual(model.GetMemcachedKML('Layer', layer_id), None)
+
+  def testValidators(self):
+    generation, last_modified = model.GetKMLValidators(1)
+    self.assertEqual(generation, model.GetKMLGeneration(1))
+    self.assertTrue(abs(last_modified - time.time()) < 5)
+    model.ClearMemcachedKML(1)
+    self.assertEqual(model.GetKMLValidators(1)[0], generation + 1)
+    # The modification time of an evicted generation is unknown.
+    memcache.flush_all()
+    memcache.set('kml-generation:1', generation)
+    self.assertEqual(model.GetKMLValidators(1), (generation, None))
+
+  def testEvictedGeneration(self):
+    generation = model.GetKMLGeneration(1)
+    model.SetMemcachedKML('Layer', 1, 1, generation, 'abc', False)
+    memcache.delete('kml-generation:1')
+    self.assertEqual(model.GetMemcachedKML('Layer', 1), None)
+    self.assertTrue(model.GetKMLGeneration(1) >= generation)
+
+
+class CacheFillTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.layer = model.Layer(name='a', world='earth')
+    self.layer.put()
+    self.region = model.Region(layer=self.layer, north=1.0, south=0.0,
+                               east=1.0, west=0.0)
+    self.region.put()
+    self.entities = []
+    for _ in xrange(3):
+      entity = model.Entity(layer=self.layer, name='b', region=self.region)
+      entity.put()
+      point = model.Point(location=db.GeoPt(1, 2), parent=entity)
+      entity.geometries.append(point.put().id())
+      entity.put()
+      self.entities.append(entity)
+
+  def testFillsAreBatched(self):
+    cache = collections.defaultdict(dict)
+    model.PrefetchReferences(self.entities, cache, [self.layer])
+    batches = []
+
+    def RecordingPut(models):
+      batches.append(models)
+      return real_put(models)
+    real_put = db.put
+    self.stubs.Set(db, 'put', RecordingPut)
+    self.stubs.Set(model, '_MAX_PUT_BATCH_SIZE', 3)
+
+    for entity in self.entities:
+      entity.GenerateKML(cache)
+    self.assertEqual(batches, [])
+    self.assertEqual(model.Entity.get(self.entities[0].key()).cached_kml, None)
+
+    model.FlushCacheFills(cache)
+    self.assertEqual(len(batches), 2)
+    self.assertEqual(set(i.key() for i in batches[0] + batches[1]),
+                     set([self.region.key()] +
+                         [i.key() for i in self.entities]))
+    self.assertEqual(model.Entity.get(self.entities[0].key()).cached_kml,
+                     self.entities[0].cached_kml)
+    self.assertTrue(model.Region.get(self.region.key()).cached_kml)
+
+    # Nothing is left to flush.
+    model.FlushCacheFills(cache)
+    self.assertEqual(len(batches), 2)
+
+  def testFillsWithoutCacheArePutImmediately(self):
+    self.entities[0].GenerateKML()
+    entity = model.Entity.get(self.entities[0].key())
+    self.assertEqual(entity.cached_kml, self.entities[0].cached_kml)
+
+  def testFailedFlushIsIgnored(self):
+    cache = collections.defaultdict(dict)
+    self.entities[0].GenerateKML(cache)
+    self.mox.StubOutWithMock(db, 'put')
+    db.put(mox.IgnoreArg()).AndRaise(db.Timeout())
+
+    self.mox.ReplayAll()
+    model.FlushCacheFills(cache)
+    self.assertFalse('pending_puts' in cache)
+    self.assertEqual(model.Entity.get(self.entities[0].key()).cached_kml, None)
+
+
+class KMLDependencyTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.layer = model.Layer(name='a', world='earth')
+    self.layer.put()
+    self.region = model.Region(layer=self.layer, north=1.0, south=0.0,
+                               east=1.0, west=0.0)
+    self.region.put()
+    schema = model.Schema(layer=self.layer, name='b')
+    schema.put()
+    self.template = model.Template(schema=schema, name='c', text='d',
+                                   parent=schema)
+    self.template.put()
+    self.entity = model.Entity(layer=self.layer, name='e', region=self.region,
+                               template=self.template)
+    self.entity.put()
+    point = model.Point(location=db.GeoPt(1, 2), parent=self.entity)
+    self.entity.geometries.append(point.put().id())
+    self.entity.put()
+    self.folder = model.Folder(layer=self.layer, name='f')
+    self.folder.put()
+    self.entity.GenerateKML()
+    self.folder.GenerateKML()
+
+  def _IsValid(self, model_class, instance):
+    return model_class.get(instance.key()).HasValidKMLCache()
+
+  def testGenerationNames(self):
+    self.assertEqual(model.GetKMLDependencyName(self.layer.key()),
+                     'Layer:%d' % self.layer.key().id())
+    self.assertEqual(model.GetKMLDependencyName(self.layer.key(), 'contents'),
+                     'Layer:%d/contents' % self.layer.key().id())
+    self.assertEqual(self.entity.GetKMLDependencies(), [
+        'Layer:%d' % self.layer.key().id(),
+        'Region:%d' % self.region.key().id(),
+        'Schema:%d:Template:%d' % (self.template.parent_key().id(),
+                                   self.template.key().id())])
+
+  def testGenerations(self):
+    name = model.GetKMLDependencyName(self.region.key())
+    self.assertEqual(model.GetKMLGenerations([name, 'x']), {name: 0, 'x': 0})
+    model.BumpKMLGeneration(name)
+    model.BumpKMLGeneration(name)
+    self.assertEqual(model.GetKMLGenerations([name]), {name: 2})
+
+  def testBumpUpdatesCache(self):
+    name = model.GetKMLDependencyName(self.region.key())
+    cache = collections.defaultdict(dict)
+    self.assertTrue(self.entity.HasValidKMLCache(cache))
+    self.assertEqual(cache['kml_generations'][name], 0)
+    self.region.ClearCache(cache)
+    self.assertEqual(cache['kml_generations'][name], 1)
+    self.assertFalse(self.entity.HasValidKMLCache(cache))
+
+  def testLayerEditKeepsEntityCache(self):
+    self.assertTrue(self._IsValid(model.Entity, self.entity))
+    self.assertTrue(self._IsValid(model.Folder, self.folder))
+    self.layer.description = 'g'
+    self.layer.ClearCache()
+    self.assertTrue(self._IsValid(model.Entity, self.entity))
+    self.assertFalse(self._IsValid(model.Folder, self.folder))
+
+  def testSettingsEditClearsEntityCache(self):
+    self.layer.dynamic_balloons = True
+    self.layer.ClearSettingsCache()
+    self.assertFalse(self._IsValid(model.Entity, self.entity))
+    self.assertFalse(self._IsValid(model.Folder, self.folder))
+
+  def testReferenceEditsClearEntityCache(self):
+    self.region.ClearCache()
+    self.assertFalse(self._IsValid(model.Entity, self.entity))
+    model.Entity.get(self.entity.key()).GenerateKML()
+    self.assertTrue(self._IsValid(model.Entity, self.entity))
+    self.template.ClearCache()
+    self.assertFalse(self._IsValid(model.Entity, self.entity))
+
+  def testPrefetchBatchesLookups(self):
+    entities = [model.Entity.get(self.entity.key()) for _ in xrange(3)]
+    cache = collections.defaultdict(dict)
+    model.PrefetchReferences(entities, cache, [self.layer])
+    self.mox.StubOutWithMock(model.KMLDependency, 'get_by_key_name')
+    # Nothing has been bumped yet, so all three generations are missing.
+    model.KMLDependency.get_by_key_name(mox.IgnoreArg()).AndReturn(
+        [None, None, None])
+
+    self.mox.ReplayAll()
+    model.PrefetchKMLDependencies(entities, cache)
+    for entity in entities:
+      self.assertTrue(entity.HasValidKMLCache(cache))
+
+
+class CounterTest(mox.MoxTestBase):
+
+  def testShardedCounter(self):
+    self.stubs.Set(settings, 'COUNTER_SHARDS', 3)
+    self.assertEqual(model.GetCounter('a'), 0)
+    for _ in xrange(10):
+      model.IncrementCounter('a')
+    model.IncrementCounter('a', -3)
+    model.IncrementCounter('b', 5)
+    self.assertEqual(model.GetCounter('a'), 7)
+    self.assertEqual(model.GetCounter('b'), 5)
+    self.assertTrue(model.CounterShard.all().count() <= 6)
+
+    model.ResetCounter('a')
+    self.assertEqual(model.GetCounter('a'), 0)
+    self.assertEqual(model.GetCounter('b'), 5)
+
+  def testGetCounters(self):
+    self.stubs.Set(settings, 'COUNTER_SHARDS', 3)
+    for _ in xrange(4):
+      model.IncrementCounter('a')
+    model.IncrementCounter('c', 2)
+    self.assertEqual(model.GetCounters(['a', 'b', 'c']), [4, 0, 2])
+    self.assertEqual(model.GetCounters([]), [])
+
+
+class GeocellCountTest(mox.MoxTestBase):
+
+  def _CreateEntity(self, layer, latitude, longitude):
+    entity = model.Entity(layer=layer, name='a',
+                          location=db.GeoPt(latitude, longitude))
+    entity.update_location()
+    return entity
+
+  def testUpdateGeocellCounts(self):
+    self.stubs.Set(settings, 'GEOCELL_COUNT_RESOLUTION', 2)
+    layer = model.Layer(name='a', world='earth')
+    layer.put()
+    other_layer = model.Layer(name='b', world='earth')
+    other_layer.put()
+    first = self._CreateEntity(layer, 10, 10)
+    second = self._CreateEntity(layer, 10.1, 10.1)
+    moved = self._CreateEntity(layer, -50, -50)
+    unlocated = model.Entity(layer=layer, name='a')
+    cells = first.location_geocells[:3] + moved.location_geocells[:2]
+
+    model.UpdateGeocellCounts(layer, [first, second, moved, unlocated])
+    model.UpdateGeocellCounts(other_layer, [first])
+    self.assertEqual(model.GetGeocellCounts(layer, cells), [2, 2, 0, 1, 1])
+    self.assertEqual(model.GeocellCount.all().filter('layer', layer).count(),
+                     4)
+
+    # Moving and deleting entities only updates the cells they left.
+    moved_to = self._CreateEntity(layer, 10, 10)
+    model.UpdateGeocellCounts(layer, [moved_to], [moved])
+    model.UpdateGeocellCounts(layer, removed=[second])
+    self.assertEqual(model.GetGeocellCounts(layer, cells), [2, 2, 0, 0, 0])
+    self.assertEqual(model.GetGeocellCounts(other_layer, cells[:2]), [1, 1])
+    self.assertEqual(model.GetGeocellCounts(layer, []), [])
+
+  def testGetGeocellAggregates(self):
+    self.stubs.Set(settings, 'GEOCELL_COUNT_RESOLUTION', 2)
+    layer = model.Layer(name='a', world='earth')
+    layer.put()
+    first = self._CreateEntity(layer, 10, 10)
+    second = self._CreateEntity(layer, 11, 12)
+    cells = first.location_geocells[:1] + ['f']
+
+    model.UpdateGeocellCounts(layer, [first, second])
+    self.assertEqual(model.GetGeocellAggregates(layer, cells),
+                     [(2, db.GeoPt(10.5, 11)), (0, None)])
+
+    # The centroid follows removed entities and is dropped with the last one.
+    model.UpdateGeocellCounts(layer, removed=[first])
+    self.assertEqual(model.GetGeocellAggregates(layer, cells[:1]),
+                     [(1, db.GeoPt(11, 12))])
+    model.UpdateGeocellCounts(layer, removed=[second])
+    self.assertEqual(model.GetGeocellAggregates(layer, cells[:1]),
+                     [(0, None)])
+
+  def testUnbakedGeocellCounts(self):
+    self.stubs.Set(settings, 'GEOCELL_COUNT_RESOLUTION', 2)
+    layer = model.Layer(name='a', world='earth')
+    layer.put()
+    first = self._CreateEntity(layer, 10, 10)
+    second = self._CreateEntity(layer, 10.1, 10.1)
+    baked = self._CreateEntity(layer, 10.2, 10.2)
+    baked.baked = True
+    cells = first.location_geocells[:2] + ['f']
+
+    model.UpdateGeocellCounts(layer, [first, second, baked])
+    self.assertEqual(model.GetUnbakedGeocellCounts(layer, cells), [2, 2, 0])
+    self.assertEqual(model.GetGeocellCounts(layer, cells), [3, 3, 0])
+
+    # Placed entities are taken off the unbaked counts only, and geocells that
+    # have never been counted are not created.
+    model.MarkGeocellsBaked(layer, [first.location, None,
+                                    db.GeoPt(-50, -50)])
+    self.assertEqual(model.GetUnbakedGeocellCounts(layer, cells), [1, 1, 0])
+    self.assertEqual(model.GetGeocellCounts(layer, cells), [3, 3, 0])
+    self.assertEqual(model.GeocellCount.all().filter('layer', layer).count(),
+                     2)
+    counts = model.GeocellCount.all().filter('layer', layer)
+    self.assertEqual(sorted(i.GetCell() for i in counts), sorted(cells[:2]))
+
+    # An unbaked entity that moves takes its unbaked count along.
+    moved = self._CreateEntity(layer, -50, -50)
+    model.UpdateGeocellCounts(layer, [moved], [second])
+    self.assertEqual(model.GetUnbakedGeocellCounts(layer, cells), [0, 0, 0])
+    self.assertEqual(
+        model.GetUnbakedGeocellCounts(layer, moved.location_geocells[:1]),
+        [1])
+
 
 class GeometryCenterCalculationTest(mox.MoxTestBase):
   # Testing with real numbers here is far from perfect, but I see no way to
@@ -18,8 +18,11 @@
 
 
 import os
+import StringIO
+import zipfile
 from google.appengine.ext import db
 from lib.mox import mox
+from template_functions import kml
 import util
 
 
@@ -168,3 +171,82 @@ class UtilTest(mox.MoxTestBase):
     self.assertEqual(util.GetRequestSourceType(mock_request), 'normal')
     self.assertEqual(util.GetRequestSourceType(mock_request), 'unknown')
     self.assertEqual(util.GetRequestSourceType(mock_request), 'unknown')
+
+  def testKMZWriter(self):
+    out = StringIO.StringIO()
+    data = ''.join('<a>%d</a>' % i for i in xrange(10000))
+    writer = util.KMZWriter(out, 'doc.kml')
+    for i in xrange(0, len(data), 1000):
+      writer.write(data[i:i + 1000])
+    writer.close()
+
+    archive = zipfile.ZipFile(StringIO.StringIO(out.getvalue()))
+    self.assertEqual(archive.testzip(), None)
+    self.assertEqual(archive.namelist(), ['doc.kml'])
+    info = archive.getinfo('doc.kml')
+    self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+    self.assertEqual(info.external_attr, 0644 << 16)
+    self.assertEqual(info.file_size, len(data))
+    self.assertEqual(archive.read('doc.kml'), data)
+
+  def testChunkBuffer(self):
+    buffer = util.ChunkBuffer()
+    self.assertEqual(buffer.Drain(), '')
+    buffer.write('ab')
+    buffer.write('c')
+    self.assertEqual(buffer.Drain(), 'abc')
+    self.assertEqual(buffer.Drain(), '')
+
+  def testHTTPDates(self):
+    self.assertEqual(util.FormatHTTPDate(1234), 'Thu, 01 Jan 1970 00:20:34 GMT')
+    self.assertEqual(util.ParseHTTPDate('Thu, 01 Jan 1970 00:20:34 GMT'), 1234)
+    self.assertEqual(util.ParseHTTPDate('Thu, 01 Jan 1970 01:20:34 +0100'),
+                     1234)
+    self.assertEqual(util.ParseHTTPDate('garbage'), None)
+    self.assertEqual(util.ParseHTTPDate(None), None)
+
+  def testPackDoubles(self):
+    values = [0.0, -0.0, 1.5, -123.456789, 1e300]
+    packed = util.PackDoubles(values)
+    self.assertEqual(packed[:16], '\0' * 8 + '\0' * 7 + '\x80')
+    self.assertEqual(len(packed), 8 * len(values))
+    self.assertEqual(util.UnpackDoubles(packed).tolist(), values)
+    self.assertEqual(util.UnpackDoubles('').tolist(), [])
+
+  def testCoordinateArray(self):
+    points = [db.GeoPt(1.5, 2.25), db.GeoPt(-89.123456789, 179.5),
+              db.GeoPt(0, -0.1)]
+    coordinates = util.CoordinateArray.FromPoints(points)
+
+    self.assertEqual(len(coordinates), 3)
+    self.assertEqual(coordinates, points)
+    self.assertEqual(list(coordinates), points)
+    self.assertEqual(coordinates[1], points[1])
+    self.assertEqual(coordinates[-1], points[-1])
+    self.assertEqual(coordinates[1:], points[1:])
+    self.assertRaises(IndexError, coordinates.__getitem__, 3)
+    self.assertRaises(TypeError, coordinates.__getitem__, '0')
+    self.assertEqual(coordinates.GetLatitudes(), [1.5, -89.123456789, 0.0])
+    self.assertEqual(coordinates.GetLongitudes(), [2.25, 179.5, -0.1])
+    self.assertEqual(util.CoordinateArray.FromBlob(coordinates.ToBlob()),
+                     coordinates)
+    self.assertNotEqual(coordinates, points[:2])
+    self.assertFalse(util.CoordinateArray())
+    self.assertRaises(ValueError, util.CoordinateArray, [1.0])
+
+  def testCoordinateArrayFormatKML(self):
+    points = [db.GeoPt(1.5, 2.25), db.GeoPt(-89.123456789, 179.5),
+              db.GeoPt(0, -0.1)]
+    altitudes = [1.0, -2.5, 3]
+    coordinates = util.CoordinateArray.FromPoints(points)
+
+    self.assertEqual(coordinates.FormatKML(),
+                     kml.FormatCoordinates(points))
+    self.assertEqual(coordinates.FormatKML([]),
+                     kml.FormatCoordinates(points, []))
+    self.assertEqual(coordinates.FormatKML(altitudes),
+                     kml.FormatCoordinates(points, altitudes))
+    self.assertEqual(kml.FormatCoordinates(coordinates, altitudes),
+                     kml.FormatCoordinates(points, altitudes))
+    self.assertEqual(util.CoordinateArray().FormatKML(), '')
+    self.assertRaises(ValueError, coordinates.FormatKML, [1.0])
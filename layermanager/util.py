@@ -17,8 +17,13 @@
 """A collection of utility functions and classes."""
 
 
+import array
+import email.utils
 import os
+import struct
+import sys
 import urlparse
+import zlib
 from google.appengine.ext import db
 
 
@@ -122,3 +127,251 @@ def GetRequestSourceType(request):
       return 'normal'
     else:
       return 'unknown'
+
+
+def FormatHTTPDate(seconds):
+  """Formats a number of seconds since the epoch as an HTTP date string."""
+  return email.utils.formatdate(seconds, usegmt=True)
+
+
+def ParseHTTPDate(date_string):
+  """Parses an HTTP date string, e.g. from an If-Modified-Since header.
+
+  Args:
+    date_string: The string to parse. May be None.
+
+  Returns:
+    The number of seconds since the epoch, or None if the string is missing or
+    could not be parsed.
+  """
+  parsed = date_string and email.utils.parsedate_tz(date_string)
+  if parsed:
+    return email.utils.mktime_tz(parsed)
+  else:
+    return None
+
+
+class ChunkBuffer(object):
+  """A file-like object that collects what is written until it is drained."""
+
+  def __init__(self):
+    self._chunks = []
+
+  def write(self, data):  # pylint: disable-msg=C6409
+    """Buffers a chunk of data."""
+    self._chunks.append(data)
+
+  def Drain(self):
+    """Returns everything written since the last call and empties the buffer."""
+    data = ''.join(self._chunks)
+    self._chunks = []
+    return data
+
+
+class KMZWriter(object):
+  """Writes a single-file zip archive incrementally to a file-like object.
+
+  Unlike zipfile.ZipFile.writestr(), which needs the whole uncompressed file in
+  memory, this deflates the data as it is written and only keeps the running
+  CRC and sizes around. The sizes are written in a data descriptor after the
+  compressed data, as allowed by the zip format for streamed entries.
+  """
+
+  # The MS-DOS time and date of 1980-01-01 00:00:00, the zipfile.ZipInfo
+  # default.
+  _DOS_TIME = 0
+  _DOS_DATE = (1 << 5) | 1
+  # Version 2.0 of the zip spec, made on Unix (so external_attr is honored).
+  _VERSION_NEEDED = 20
+  _VERSION_MADE_BY = (3 << 8) | 20
+  # General purpose flag 3: sizes and CRC follow in a data descriptor.
+  _FLAGS = 1 << 3
+  _DEFLATED = 8
+  # Owner read/write, group/others read.
+  _EXTERNAL_ATTR = 0644 << 16
+
+  def __init__(self, out, filename='doc.kml', level=6):
+    """Initializes the writer and writes out the local file header.
+
+    Args:
+      out: A file-like object to write the archive to.
+      filename: The name of the single file in the archive.
+      level: The zlib compression level to use.
+    """
+    self._out = out
+    self._filename = filename
+    self._compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    self._crc = 0
+    self._size = 0
+    self._compressed_size = 0
+    self._offset = 0
+    self._Write(struct.pack(
+        '<IHHHHHIIIHH', 0x04034b50, self._VERSION_NEEDED, self._FLAGS,
+        self._DEFLATED, self._DOS_TIME, self._DOS_DATE, 0, 0, 0,
+        len(filename), 0))
+    self._Write(filename)
+    self._data_offset = self._offset
+
+  def write(self, data):  # pylint: disable-msg=C6409
+    """Compresses and writes out a chunk of the file's data."""
+    if not data: return
+    self._crc = zlib.crc32(data, self._crc)
+    self._size += len(data)
+    self._Write(self._compressor.compress(data))
+
+  def close(self):  # pylint: disable-msg=C6409
+    """Flushes the compressor and writes out the archive trailers."""
+    self._Write(self._compressor.flush())
+    self._compressed_size = self._offset - self._data_offset
+    crc = self._crc & 0xffffffff
+    self._Write(struct.pack('<IIII', 0x08074b50, crc,
+                            self._compressed_size, self._size))
+    directory_offset = self._offset
+    self._Write(struct.pack(
+        '<IHHHHHHIIIHHHHHII', 0x02014b50, self._VERSION_MADE_BY,
+        self._VERSION_NEEDED, self._FLAGS, self._DEFLATED, self._DOS_TIME,
+        self._DOS_DATE, crc, self._compressed_size, self._size,
+        len(self._filename), 0, 0, 0, 0, self._EXTERNAL_ATTR, 0))
+    self._Write(self._filename)
+    directory_size = self._offset - directory_offset
+    self._Write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, 1, 1,
+                            directory_size, directory_offset, 0))
+
+  def _Write(self, data):
+    self._out.write(data)
+    self._offset += len(data)
+
+
+def PackDoubles(values):
+  """Packs a sequence of floats into a string of little-endian doubles."""
+  packed = array.array('d', values)
+  if sys.byteorder != 'little': packed.byteswap()
+  return packed.tostring()
+
+
+def UnpackDoubles(data):
+  """Unpacks a string produced by PackDoubles() into an array of floats."""
+  unpacked = array.array('d')
+  unpacked.fromstring(data)
+  if sys.byteorder != 'little': unpacked.byteswap()
+  return unpacked
+
+
+class CoordinateArray(object):
+  """A read-only sequence of db.GeoPt objects packed into an array of doubles.
+
+  The coordinates are kept in KML order, i.e. the longitude followed by the
+  latitude of each point. db.GeoPt objects are only created when individual
+  points are accessed; packing, unpacking and KML formatting work on the whole
+  array at once.
+  """
+
+  def __init__(self, values=()):
+    """Initializes the sequence.
+
+    Args:
+      values: A flat sequence of floats alternating between the longitude and
+          the latitude of each point.
+
+    Raises:
+      ValueError: If an odd number of values is passed.
+    """
+    if isinstance(values, array.array) and values.typecode == 'd':
+      self._values = values
+    else:
+      self._values = array.array('d', values)
+    if len(self._values) % 2:
+      raise ValueError('Coordinates must come in longitude, latitude pairs.')
+
+  @classmethod
+  def FromPoints(cls, points):
+    """Creates a CoordinateArray from an iterable of db.GeoPt objects."""
+    values = []
+    for point in points:
+      values.append(point.lon)
+      values.append(point.lat)
+    return cls(values)
+
+  @classmethod
+  def FromBlob(cls, data):
+    """Creates a CoordinateArray from the output of ToBlob()."""
+    return cls(UnpackDoubles(data))
+
+  def ToBlob(self):
+    """Returns the coordinates as a string of little-endian doubles."""
+    return PackDoubles(self._values)
+
+  def GetLatitudes(self):
+    """Returns a list of the latitudes of all points."""
+    return self._values.tolist()[1::2]
+
+  def GetLongitudes(self):
+    """Returns a list of the longitudes of all points."""
+    return self._values.tolist()[::2]
+
+  def FormatKML(self, altitudes=None):
+    """Formats the points into a KML coordinates string.
+
+    Produces exactly the same output as the FormatCoordinates template filter
+    does for a list of db.GeoPt objects, with a single formatting operation.
+
+    Args:
+      altitudes: An optional list of altitude values. If specified and
+          non-empty, must be of the same length as this sequence.
+
+    Returns:
+      A string of the points in the KML coordinates format.
+
+    Raises:
+      ValueError: If the number of the altitudes is not equal to the number of
+          points.
+    """
+    count = len(self)
+    values = self._values.tolist()
+    if altitudes:
+      if len(altitudes) != count:
+        raise ValueError('Received %d altitudes. Expected %d.' %
+                         (len(altitudes), count))
+      coordinates = [None] * (count * 3)
+      coordinates[0::3] = values[0::2]
+      coordinates[1::3] = values[1::2]
+      coordinates[2::3] = list(altitudes)
+      return ' '.join(['%s,%s,%s'] * count) % tuple(coordinates)
+    else:
+      return ' '.join(['%s,%s'] * count) % tuple(values)
+
+  def __len__(self):
+    return len(self._values) // 2
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in xrange(*index.indices(len(self)))]
+    elif not isinstance(index, (int, long)):
+      raise TypeError('Point indices must be integers.')
+    if index < 0: index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError('Point index out of range.')
+    return db.GeoPt(self._values[index * 2 + 1], self._values[index * 2])
+
+  def __iter__(self):
+    values = self._values.tolist()
+    for i in xrange(0, len(values), 2):
+      yield db.GeoPt(values[i + 1], values[i])
+
+  def __eq__(self, other):
+    if isinstance(other, CoordinateArray):
+      return self._values == other._values
+    elif isinstance(other, (list, tuple)):
+      return list(self) == list(other)
+    else:
+      return NotImplemented
+
+  def __ne__(self, other):
+    equal = self.__eq__(other)
+    if equal is NotImplemented:
+      return equal
+    else:
+      return not equal
+
+  def __repr__(self):
+    return 'CoordinateArray(%r)' % list(self)